@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+datagen.py: synthetic registry catalogs for benchmarks
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import random
+import sqlite3
+import argparse
+
+from confloader import ConfDict
+
+from registry.utils.databases import (init_databases, close_databases,
+                                      get_database_path)
+
+
+PKGDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULTS_PATH = os.path.join(PKGDIR, 'registry', 'config.ini')
+
+CLIENT_NAME = 'bench'
+CLIENT_KEY = b'benchmark key 16'
+CATEGORIES = ('core', 'news', 'weather', 'wikipedia', 'books', 'video')
+FILES_PER_DIR = 1000
+FILE_SIZE = 4096
+BATCH_SIZE = 10000
+
+CONFIG_TEMPLATE = """[config]
+defaults =
+    {defaults}
+
+[server]
+host = 127.0.0.1
+port = {port}
+debug = no
+
+[registry]
+root_path = {root}/content
+
+[ratelimit]
+enabled = {ratelimit}
+
+[logging]
+output = {root}/registry.log
+
+[database]
+path = {root}/
+"""
+
+
+def write_config(root, port=8090, ratelimit=False):
+    """
+    Writes configuration for a registry which stores its database and
+    content in ``root`` and returns the path of the configuration file
+    """
+    path = os.path.join(root, 'bench.ini')
+    with open(path, 'w') as f:
+        f.write(CONFIG_TEMPLATE.format(defaults=DEFAULTS_PATH, root=root,
+                                       port=port,
+                                       ratelimit='yes' if ratelimit else 'no'))
+    return path
+
+
+def serve_path(n):
+    return 'dir{:04d}/file{:08d}.bin'.format(n // FILES_PER_DIR, n)
+
+
+def content_rows(root_path, rows, seed=0):
+    """
+    Generates ``rows`` content rows. Rows are generated the same way for the
+    same ``seed``, so that catalogs of the same size are comparable.
+    """
+    rnd = random.Random(seed)
+    now = int(time.time())
+    start = now - rows
+    for n in range(1, rows + 1):
+        uploaded = start + n
+        yield (os.path.join(root_path, serve_path(n)),
+               rnd.randint(1, 10 * 1024 * 1024),
+               uploaded,
+               uploaded,
+               rnd.choice(CATEGORIES),
+               now + rnd.randint(-86400, 30 * 86400),
+               serve_path(n),
+               rnd.random() < 0.5,
+               rnd.random() >= 0.05)
+
+
+def create_files(root_path, count):
+    """
+    Creates files for the first ``count`` rows so that they can be
+    downloaded, and a file used as the source of added entries
+    """
+    data = b'\0' * FILE_SIZE
+    paths = [serve_path(n) for n in range(1, count + 1)] + ['add/source.bin']
+    for path in paths:
+        path = os.path.join(root_path, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def count_rows(db_path):
+    if not os.path.exists(db_path):
+        return None
+    db = sqlite3.connect(db_path)
+    try:
+        return db.execute('SELECT count(*) FROM content;').fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        db.close()
+
+
+def generate(root, rows, files=100, seed=0, force=False):
+    """
+    Creates a registry database in ``root`` with ``rows`` content entries
+    and a client used by the benchmarks. An existing database of the same
+    size is reused unless ``force`` is set. Returns the configuration.
+    """
+    root = os.path.abspath(root)
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    config = ConfDict.from_file(write_config(root))
+    db_path = get_database_path(config, 'registry')
+    if count_rows(db_path) == rows and not force:
+        return config
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    # Create the schema using the registry migrations
+    close_databases(init_databases(config))
+    db = sqlite3.connect(db_path)
+    db.execute('PRAGMA synchronous = OFF;')
+    db.execute('PRAGMA journal_mode = MEMORY;')
+    db.execute('INSERT INTO clients (name, description, maintainer, email, '
+               'created, active) VALUES (?, ?, ?, ?, ?, 1);',
+               (CLIENT_NAME, 'benchmarks', 'benchmarks', None,
+                int(time.time())))
+    db.execute('INSERT INTO client_keys (client_name, cipher, key) '
+               'VALUES (?, ?, ?);',
+               (CLIENT_NAME, 'AES_CBC', sqlite3.Binary(CLIENT_KEY)))
+    query = ('INSERT INTO content (path, size, uploaded, modified, '
+             'category, expiration, serve_path, aired, alive) '
+             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);')
+    batch = []
+    root_path = config['registry.root_path']
+    for row in content_rows(root_path, rows, seed):
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            db.executemany(query, batch)
+            batch = []
+    db.executemany(query, batch)
+    db.commit()
+    db.close()
+    create_files(root_path, min(files, rows))
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic registry catalog')
+    parser.add_argument('--root', default='/tmp/registry-bench',
+                        help='directory in which the catalog is created')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='number of content entries')
+    parser.add_argument('--files', type=int, default=100,
+                        help='number of entries which have files on disk')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true',
+                        help='recreate the catalog even if one exists')
+    args = parser.parse_args()
+    start = time.time()
+    generate(args.root, args.rows, args.files, args.seed, args.force)
+    print('Generated {} rows in {:.1f}s'.format(args.rows,
+                                                time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
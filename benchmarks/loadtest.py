@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+loadtest.py: load tests of the registry API
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import print_function
+
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import os
+import sys
+import json
+import time
+import socket
+import httplib
+import argparse
+import platform
+import itertools
+import subprocess
+
+import gevent
+from Crypto.Cipher import AES
+
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+from . import datagen
+
+
+PKGDIR = datagen.PKGDIR
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+SCENARIOS = ('auth', 'list', 'list_serve_path', 'get', 'add')
+
+
+class Client(object):
+    """
+    HTTP client holding a persistent connection and a session with the
+    registry
+    """
+
+    def __init__(self, host, port):
+        self.conn = httplib.HTTPConnection(host, port, timeout=60)
+        self.token = None
+
+    def request(self, method, url, params=None):
+        body = urlencode(params) if params is not None else None
+        headers = FORM_HEADERS if params is not None else {}
+        try:
+            self.conn.request(method, url, body, headers)
+            resp = self.conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # The server closed the connection, so it is reopened once
+            self.conn.close()
+            self.conn.request(method, url, body, headers)
+            resp = self.conn.getresponse()
+        return resp.status, resp.read()
+
+    def authenticate(self):
+        status, body = self.request('POST', '/auth',
+                                    {'client_name': datagen.CLIENT_NAME})
+        if status != 200:
+            return status
+        challenge = json.loads(body)['challenge']
+        cipher = AES.new(datagen.CLIENT_KEY, AES.MODE_CBC,
+                         challenge['cipher_iv'])
+        encrypted = cipher.encrypt(challenge['text'])
+        status, body = self.request('POST', '/auth_verify', {
+            'client_name': datagen.CLIENT_NAME,
+            'id': challenge['id'],
+            'encrypted_text': encrypted,
+            'duration': 3600,
+        })
+        if status == 200:
+            self.token = json.loads(body)['session']['token']
+        return status
+
+
+def run_auth(client, n, options):
+    return client.authenticate()
+
+
+def run_list(client, n, options):
+    return client.request('GET', '/?' + urlencode({
+        'session_token': client.token,
+        'count': 100}))[0]
+
+
+def run_list_serve_path(client, n, options):
+    directory = n % max(options.rows // datagen.FILES_PER_DIR, 1)
+    return client.request('GET', '/?' + urlencode({
+        'session_token': client.token,
+        'serve_path': '^dir{:04d}/file0*{}'.format(directory, n % 10)}))[0]
+
+
+def run_get(client, n, options):
+    id = n % min(options.files, options.rows) + 1
+    return client.request('GET', '/{}?{}'.format(id, urlencode({
+        'session_token': client.token})))[0]
+
+
+def run_add(client, n, options):
+    path = os.path.join(options.config['registry.root_path'], 'add',
+                        'source.bin')
+    return client.request('POST', '/', {
+        'session_token': client.token,
+        'path': path,
+        'serve_path': 'add/{}/{}'.format(options.run_id, n)})[0]
+
+
+RUNNERS = {
+    'auth': run_auth,
+    'list': run_list,
+    'list_serve_path': run_list_serve_path,
+    'get': run_get,
+    'add': run_add,
+}
+
+
+def percentile(values, pct):
+    """
+    Returns the ``pct`` percentile of sorted ``values`` using the nearest
+    rank method
+    """
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'rps': count / elapsed if elapsed else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+    }
+
+
+def run_scenario(name, options):
+    """
+    Runs scenario ``name`` with ``options.concurrency`` clients for
+    ``options.duration`` seconds, after a warm-up period whose requests are
+    not measured
+    """
+    runner = RUNNERS[name]
+    counter = itertools.count()
+    latencies = []
+    errors = [0]
+    host = options.config['server.host']
+    port = options.config['server.port']
+    warmup_end = time.time() + options.warmup
+    end = warmup_end + options.duration
+
+    def worker():
+        client = Client(host, port)
+        if name != 'auth' and client.authenticate() != 200:
+            raise RuntimeError('Could not authenticate')
+        while True:
+            start = time.time()
+            if start >= end:
+                return
+            status = runner(client, next(counter), options)
+            if start < warmup_end:
+                continue
+            latencies.append(time.time() - start)
+            if status >= 400:
+                errors[0] += 1
+
+    greenlets = [gevent.spawn(worker) for _ in range(options.concurrency)]
+    gevent.joinall(greenlets, raise_error=True)
+    return summarize(latencies, errors[0], options.duration)
+
+
+def wait_for_server(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except socket.error:
+            gevent.sleep(0.1)
+    raise RuntimeError('Server did not start in {}s'.format(timeout))
+
+
+def start_server(config_path, workers):
+    cmd = [sys.executable, '-m', 'registry.app', '--conf', config_path,
+           '--workers', str(workers)]
+    output_path = os.path.join(os.path.dirname(config_path), 'server.out')
+    with open(output_path, 'w') as output:
+        return subprocess.Popen(cmd, cwd=PKGDIR, stdout=output,
+                                stderr=subprocess.STDOUT)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PKGDIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results, tolerance):
+    """
+    Compares ``results`` with ``baseline`` and returns a list of regressions
+    where throughput dropped or p95 latency grew by more than ``tolerance``
+    """
+    regressions = []
+    for name, current in sorted(results['results'].items()):
+        previous = baseline['results'].get(name)
+        if not previous:
+            continue
+        if current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append('{}: rps {:.1f} -> {:.1f}'.format(
+                name, previous['rps'], current['rps']))
+        if current['p95'] > previous['p95'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f}ms -> {:.2f}ms'.format(
+                name, previous['p95'] * 1000, current['p95'] * 1000))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run load tests against a local registry')
+    parser.add_argument('--root', default='/tmp/registry-bench',
+                        help='directory in which the catalog is created')
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='number of content entries in the catalog')
+    parser.add_argument('--files', type=int, default=100,
+                        help='number of entries which have files on disk')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server worker processes')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds each scenario is measured for')
+    parser.add_argument('--warmup', type=float, default=1,
+                        help='seconds each scenario runs before measuring')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run (default: all)')
+    parser.add_argument('--output', metavar='PATH',
+                        help='write results to PATH instead of stdout')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='compare results with results stored in PATH')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change considered a regression')
+    return parser.parse_args()
+
+
+def main():
+    options = parse_args()
+    datagen.generate(options.root, options.rows, options.files)
+    config_path = datagen.write_config(options.root, options.port)
+    options.config = datagen.ConfDict.from_file(config_path)
+    options.run_id = int(time.time())
+    server = start_server(config_path, options.workers)
+    try:
+        wait_for_server(options.config['server.host'], options.port)
+        results = {}
+        for name in options.scenario or SCENARIOS:
+            results[name] = run_scenario(name, options)
+            print('{}: {:.1f} rps, p50 {:.2f}ms, p99 {:.2f}ms'.format(
+                name, results[name]['rps'], results[name]['p50'] * 1000,
+                results[name]['p99'] * 1000), file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+    report = {
+        'meta': {
+            'commit': get_commit(),
+            'timestamp': int(time.time()),
+            'python': platform.python_version(),
+            'rows': options.rows,
+            'workers': options.workers,
+            'concurrency': options.concurrency,
+            'duration': options.duration,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True,
+                        separators=(',', ': '))
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(json.load(f), report, options.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+microbench.py: microbenchmarks of per-row and per-request hot paths
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+
+from squery_lite.squery import Database
+
+from registry.content.api import LIST_SERIALIZER
+from registry.content.content import RAW_LIST_COLS, ContentRecord
+from registry.content.filters import FilterBase, OneOrManyFilterBase
+from registry.content.serializer import iter_listing
+from registry.content.manager import ContentManager
+from registry.utils.bottleconf import json_dumps
+from registry.utils.databases import row_to_dict, regexp_operator
+
+from . import datagen
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baselines', 'microbench.json')
+
+ROWS = 1000
+ROOT_PATH = '/var/lib/registry/content'
+MIGRATIONS = 'registry.migrations.registry'
+
+
+def load_database(count=ROWS):
+    """
+    Returns an in-memory database with ``count`` content rows
+    """
+    db = Database(Database.connect(':memory:'))
+    Database.migrate(db, MIGRATIONS)
+    db.executemany(
+        'INSERT INTO content (path, size, uploaded, modified, category, '
+        'expiration, serve_path, aired, alive) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);',
+        list(datagen.content_rows(ROOT_PATH, count)))
+    return db
+
+
+class Case(object):
+    """
+    Benchmark case which measures ``func``. When ``items`` is set, ``func``
+    processes that many items per call, and the cost per item is reported.
+    """
+
+    def __init__(self, name, func, items=1):
+        self.name = name
+        self.func = func
+        self.items = items
+
+    def measure(self, repeat=7, min_time=0.5):
+        # Calibrate the number of calls so that a single timing takes at
+        # least ``min_time`` seconds
+        timer = timeit.Timer(self.func)
+        number = 1
+        while timer.timeit(number) < min_time:
+            number *= 2
+        best = min(timer.repeat(repeat, number)) / number
+        return {'per_call': best,
+                'per_item': best / self.items,
+                'items': self.items}
+
+
+def get_cases():
+    db = load_database()
+    db.query('SELECT * FROM content;')
+    rows = db.results
+    dicts = [row_to_dict(row) for row in rows]
+    manager = ContentManager(config={'registry.root_path': ROOT_PATH},
+                             db=None)
+    filters = {'ids': '1,2,3', 'alive': 'yes', 'serve_path': '^dir0000/',
+               'count': 100}
+    id_list = ','.join(str(n) for n in range(10000))
+    serve_paths = [row['serve_path'] for row in rows]
+    response = {'success': True, 'results': dicts[:100], 'count': 100}
+
+    def regexp():
+        for path in serve_paths:
+            regexp_operator(r'^dir0000/file0*1', path)
+
+    def to_dicts():
+        for row in rows:
+            row_to_dict(row)
+
+    def to_records():
+        for row in rows:
+            ContentRecord(row)
+
+    def process():
+        for data in dicts:
+            manager._process_entry(data)
+
+    def list_dicts():
+        # Listing through dicts, including conversion of timestamps
+        db.query('SELECT * FROM content;')
+        files = [manager._process_entry(row_to_dict(row))
+                 for row in db.results]
+        json_dumps({'success': True, 'results': files, 'count': len(files)})
+
+    def list_rows():
+        db.query(db.Select(sets='content', what=RAW_LIST_COLS))
+        ''.join(iter_listing(LIST_SERIALIZER, [db.results]))
+
+    return [
+        Case('get_filters', lambda: FilterBase.get_filters(**filters)),
+        Case('get_multi_10000', lambda: OneOrManyFilterBase.get_multi(
+            id_list), items=10000),
+        Case('regexp_operator', regexp, items=len(serve_paths)),
+        Case('row_to_dict', to_dicts, items=len(rows)),
+        Case('content_record', to_records, items=len(rows)),
+        Case('process_entry', process, items=len(dicts)),
+        Case('json_dumps_100', lambda: json_dumps(response), items=100),
+        Case('list_dicts', list_dicts, items=len(rows)),
+        Case('list_rows', list_rows, items=len(rows)),
+    ]
+
+
+def compare(baseline, results, tolerance):
+    """
+    Returns a list of cases which got slower per item than in ``baseline``
+    by more than ``tolerance``
+    """
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        ratio = current['per_item'] / previous['per_item']
+        if ratio > 1 + tolerance:
+            regressions.append('{}: {:.0f}% slower'.format(
+                name, (ratio - 1) * 100))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run microbenchmarks of registry hot paths')
+    parser.add_argument('--case', action='append',
+                        help='case to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=7,
+                        help='number of timings of which the best is used')
+    parser.add_argument('--baseline', metavar='PATH', default=BASELINE_PATH,
+                        help='baseline results to compare with')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown considered a regression')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    results = {}
+    for case in get_cases():
+        if args.case and case.name not in args.case:
+            continue
+        results[case.name] = result = case.measure(args.repeat)
+        line = '{:<20} {:>12.3f}us/item'.format(case.name,
+                                                 result['per_item'] * 1e6)
+        if case.name in baseline:
+            ratio = result['per_item'] / baseline[case.name]['per_item']
+            line += '  {:>+6.1f}% vs baseline'.format((ratio - 1) * 100)
+        print(line)
+    if args.save:
+        directory = os.path.dirname(args.baseline)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        report = {
+            'meta': {
+                'timestamp': int(time.time()),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+            },
+            'results': results,
+        }
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+        return
+    regressions = compare(baseline, results, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression, file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+api.py: administration and monitoring api
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+from bottle import request
+
+from ..utils import metrics
+from ..auth.utils import check_auth
+
+
+def get_metrics():
+    return metrics.export()
+
+
+@check_auth
+def get_queries():
+    query_log = request.app.config['database.query_log']
+    try:
+        count = int(request.query.get('count', 20))
+    except ValueError:
+        return {'success': False, 'error': '`count` must be a number'}
+    return {'success': True, 'results': query_log.top(count)}
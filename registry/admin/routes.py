@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+routes.py: administration and monitoring routes
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+
+from .api import get_metrics, get_queries
+
+
+def routes(config):
+    return (
+        ('admin:metrics', get_metrics, 'GET', '/metrics', {}),
+        ('admin:queries', get_queries, 'GET', '/admin/queries', {}),
+    )
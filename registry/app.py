@@ -18,16 +18,42 @@ import gevent.hub
 gevent.hub.Hub.NOT_ERROR = (Exception,)
 
 import os
+import argparse
 
 from .application import Application
+from .supervisor import Supervisor
 
 
 PKGDIR = os.path.dirname(os.path.abspath(__file__))
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the registry server')
+    parser.add_argument('--conf', metavar='PATH',
+                        help='path to the configuration file')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='number of worker processes (overrides '
+                        'server.workers setting)')
+    parser.add_argument('--follow', metavar='URL',
+                        help='run as a read-only replica of the registry at '
+                        'URL (overrides replication.primary setting)')
+    args, _ = parser.parse_known_args()
+    return args
+
+
 def main():
-    app = Application(PKGDIR)
-    app.start()
+    args = parse_args()
+    overrides = {}
+    if args.follow:
+        overrides['replication.primary'] = args.follow
+    workers = args.workers
+    if workers is None:
+        workers = Application.load_config(PKGDIR).get('server.workers', 1)
+    if workers > 1:
+        Supervisor(PKGDIR, workers, overrides).start()
+    else:
+        app = Application(PKGDIR, overrides)
+        app.start()
 
 
 if __name__ == '__main__':
@@ -12,16 +12,18 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 from __future__ import unicode_literals
 
 import os
-import gevent
 import logging
 import importlib
 
 from bottle import Bottle
 from gevent import pywsgi
+from gevent.pool import Pool
 from confloader import get_config_path, ConfDict
 
 from .utils.logs import configure_logging
-from .utils.system import on_interrupt
+from .utils.concurrency import ConcurrencyLimiter
+from .utils.scheduler import Scheduler, Task
+from .utils.system import on_interrupt, make_listener
 
 
 def import_obj(name):
@@ -37,36 +39,59 @@ class Application(object):
         'autojson': True
     }
 
-    LOOP_INTERVAL = 5  # seconds
-
-    def __init__(self, root_dir):
+    def __init__(self, root_dir, overrides=None):
         self.server = None
+        self.limiter = None
+        self.scheduler = None
         self.app = Bottle()
         self.background_hooks = []
+        self.worker_background_hooks = []
         self.stop_hooks = []
 
         # Configure the application
-        self.configure(root_dir)
+        self.configure(root_dir, overrides)
 
         # Register application hooks
         self.pre_init(self.config['stack.pre_init'])
         self.add_plugins(self.config['stack.plugins'])
         self.add_routes(self.config['stack.routes'])
         self.add_background(self.config['stack.background'])
+        self.add_background(self.config.get('stack.worker_background', []),
+                            self.worker_background_hooks)
         self.add_stop_hooks(self.config['stack.pre_stop'])
 
         # Register interrupt handler
         on_interrupt(self.stop)
 
-    def configure(self, root_dir):
-        default_path = os.path.join(root_dir, self.DEFAULT_CONFIG_FILENAME)
-        self.config_path = get_config_path(default=default_path)
-        config = ConfDict.from_file(self.config_path,
-                                    defaults=self.CONFIG_DEFAULTS)
+    @classmethod
+    def load_config(cls, root_dir, overrides=None):
+        """
+        Loads the configuration file specified on the command line, or the
+        default one found in ``root_dir``. Values in ``overrides`` take
+        precedence over the ones in the file.
+        """
+        default_path = os.path.join(root_dir, cls.DEFAULT_CONFIG_FILENAME)
+        config_path = get_config_path(default=default_path)
+        config = ConfDict.from_file(config_path, defaults=cls.CONFIG_DEFAULTS)
         config['root_dir'] = root_dir
+        config['config_path'] = config_path
+        config.update(overrides or {})
+        return config
+
+    def configure(self, root_dir, overrides=None):
+        config = self.load_config(root_dir, overrides)
+        self.config_path = config['config_path']
         self.config = self.app.config = config
         configure_logging(self.config)
 
+    @property
+    def is_leader(self):
+        """
+        Whether this process runs the background hooks which should only run
+        once for the whole server
+        """
+        return self.config.get('server.worker_id', 0) == 0
+
     def pre_init(self, pre_init):
         for hook in pre_init:
             hook = import_obj(hook)
@@ -84,36 +109,66 @@ class Application(object):
                 (name, handler, method, path, kwargs) = route
                 self.app.route(path, method, handler, name=name, **kwargs)
 
-    def add_background(self, background_calls):
+    def add_background(self, background_calls, hooks=None):
+        if hooks is None:
+            hooks = self.background_hooks
         for hook in background_calls:
             hook = import_obj(hook)
-            self.background_hooks.append(hook)
+            hooks.append(hook)
 
     def add_stop_hooks(self, pre_stop):
         for hook in pre_stop:
             hook = import_obj(hook)
             self.stop_hooks.append(hook)
 
+    def get_wsgi_app(self):
+        concurrency = self.config['server.concurrency']
+        if not concurrency:
+            return self.app
+        self.limiter = ConcurrencyLimiter(
+            self.app,
+            concurrency=concurrency,
+            queue_size=self.config['server.queue_size'],
+            queue_timeout=self.config['server.queue_timeout'])
+        self.config['server.limiter'] = self.limiter
+        return self.limiter
+
+    def get_listener(self):
+        host = self.config['server.host']
+        port = self.config['server.port']
+        if self.config.get('server.reuse_port'):
+            # Workers bind their own sockets to the same port, and the kernel
+            # distributes incoming connections between them
+            return make_listener(host, port, reuse_port=True)
+        return (host, port)
+
     def start(self):
         host = self.config['server.host']
         port = self.config['server.port']
-        self.server = pywsgi.WSGIServer((host, port), self.app, log=None)
+        pool = Pool(self.config['server.max_connections'])
+        self.server = pywsgi.WSGIServer(self.get_listener(),
+                                        self.get_wsgi_app(),
+                                        spawn=pool, log=None)
         self.server.start()
         logging.info('Started server on http://{host}:{port}'.format(
             host=host, port=port))
-        self._loop_background()
-
-    def _loop_background(self):
-        while True:
-            gevent.sleep(self.LOOP_INTERVAL)
-            for hook in self.background_hooks:
-                try:
-                    hook(self.app, self.config)
-                except:
-                    logging.exception('Error while running background hook')
+        self.start_background()
+        self.server.serve_forever()
+
+    def start_background(self):
+        hooks = list(self.worker_background_hooks)
+        if self.is_leader:
+            hooks.extend(self.background_hooks)
+        self.scheduler = Scheduler(args=(self.app, self.config))
+        for hook in hooks:
+            self.scheduler.add(Task.from_hook(hook, self.config))
+        self.config['background.scheduler'] = self.scheduler
+        self.scheduler.start()
 
     def stop(self):
         logging.info('Stopping the application')
+        if self.scheduler:
+            self.scheduler.stop()
         self.server.stop(5)
         logging.info('Running pre-stop hooks')
         for hook in self.stop_hooks:
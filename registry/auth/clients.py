@@ -11,10 +11,24 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 
 import time
 
+from ..utils.cache import TTLCache
 from ..utils.databases import row_to_dict
 
 
+MISSING = object()
+
+
 class ClientManager(object):
+    """
+    This class provides access to registered clients and their keys. Clients
+    and keys are cached process-wide for ``CACHE_TTL`` seconds, and the
+    cached entries of a client are invalidated whenever it is modified
+    through this class.
+    """
+    CACHE_SIZE = 4096
+    CACHE_TTL = 300  # seconds
+
+    cache = TTLCache(size=CACHE_SIZE, ttl=CACHE_TTL)
 
     def __init__(self, db):
         self.db = db
@@ -23,14 +37,15 @@ class ClientManager(object):
         """
         Returns a dict which contains the client properties with the name
         ``name`` or None. If ``active`` is true, only an active client is
-        returned.
+        returned. The returned dict is shared with the cache and should not
+        be modified.
         """
-        query = self.db.Select(sets='clients', what='*',
-                               where='name = :name and active = :active')
-        self.db.execute(query, dict(name=name, active=int(active)))
-        row = self.db.result
-        if row:
-            return self._process_client(row_to_dict(row))
+        key = ('client', name, bool(active))
+        client = self.cache.get(key, MISSING)
+        if client is MISSING:
+            client = self._fetch_client(name, active)
+            self.cache.set(key, client)
+        return client
 
     def get_client_keys(self, name):
         """
@@ -39,6 +54,30 @@ class ClientManager(object):
         The returned dict will have the cipher types as keys and the encryption
         key as the values
         """
+        key = ('keys', name)
+        keys = self.cache.get(key)
+        if keys is None:
+            keys = self._fetch_client_keys(name)
+            self.cache.set(key, keys)
+        return keys
+
+    def invalidate(self, name):
+        """
+        Removes cached entries of the client with name ``name``
+        """
+        self.cache.invalidate(('client', name, True))
+        self.cache.invalidate(('client', name, False))
+        self.cache.invalidate(('keys', name))
+
+    def _fetch_client(self, name, active):
+        query = self.db.Select(sets='clients', what='*',
+                               where='name = :name and active = :active')
+        self.db.execute(query, dict(name=name, active=int(active)))
+        row = self.db.result
+        if row:
+            return self._process_client(row_to_dict(row))
+
+    def _fetch_client_keys(self, name):
         query = self.db.Select(sets='client_keys', what='*',
                                where='client_name = :client_name')
         self.db.execute(query, dict(client_name=name))
@@ -46,7 +85,7 @@ class ClientManager(object):
         for row in map(row_to_dict, self.db.results):
             cipher = row['cipher']
             key = row['key']
-            keys[cipher] = key
+            keys[cipher] = bytes(key)
         return keys
 
     def add_client(self, name, description, maintainer, email):
@@ -66,6 +105,7 @@ class ClientManager(object):
         }
         query = self.db.Insert('clients', cols=data.keys())
         self.db.execute(query, data)
+        self.invalidate(name)
 
     def set_client_key(self, name, cipher, key):
         """
@@ -82,6 +122,7 @@ class ClientManager(object):
         }
         query = self.db.Replace('client_keys', cols=data.keys())
         self.db.execute(query, data)
+        self.invalidate(name)
 
     def remove_client_key(self, name, cipher):
         """
@@ -90,6 +131,7 @@ class ClientManager(object):
         query = self.db.Delete(
             'client_keys', where='client_name = :name and cipher = :cipher')
         self.db.execute(query, dict(name=name, cipher=cipher))
+        self.invalidate(name)
 
     def deactivate_client(self, name):
         """
@@ -107,6 +149,7 @@ class ClientManager(object):
         query = self.db.Update(
             'clients', where='name = :name', active=':active')
         self.db.execute(query, dict(name=name, active=int(active)))
+        self.invalidate(name)
 
     def _process_client(self, row):
         row['active'] = bool(row['active'])
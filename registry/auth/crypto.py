@@ -10,18 +10,52 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+
+from ..utils.cache import TTLCache
+
+
+# Prepared ciphers keyed by encryption key. ECB cipher objects carry no state
+# between calls, so they can be shared by all handshakes using the same key.
+CIPHER_CACHE = TTLCache(size=4096, ttl=3600)
 
 
 def aes_make_iv():
     return 'This is an IV456'
 
 
+def aes_get_cipher(key):
+    """
+    Returns an AES cipher in ECB mode for ``key``, reusing the cipher (and
+    with it the expanded key schedule) prepared for earlier calls.
+    """
+    cipher = CIPHER_CACHE.get(key)
+    if cipher is None:
+        cipher = AES.new(key, AES.MODE_ECB)
+        CIPHER_CACHE.set(key, cipher)
+    return cipher
+
+
 def aes_encrypt(message, key, iv):
+    """
+    Encrypts ``message`` with AES in CBC mode. The CBC chaining is done here
+    on top of a cached ECB cipher, because CBC cipher objects are stateful
+    and cannot be reused across messages.
+    """
     if not isinstance(message, bytes):
         raise TypeError('message must be a byte string')
-    if not isinstance(message, bytes):
+    if not isinstance(key, bytes):
         raise TypeError('key must be a byte string')
-    if not isinstance(message, bytes):
-        raise TypeError('message must be a byte string')
-    cipher = AES.new(key, AES.MODE_CBC, iv)
-    return cipher.encrypt(message)
+    if not isinstance(iv, bytes):
+        raise TypeError('iv must be a byte string')
+    if len(message) % AES.block_size:
+        raise ValueError('message length must be a multiple of {}'.format(
+            AES.block_size))
+    cipher = aes_get_cipher(key)
+    blocks = []
+    previous = iv
+    for start in range(0, len(message), AES.block_size):
+        block = message[start:start + AES.block_size]
+        previous = cipher.encrypt(strxor(block, previous))
+        blocks.append(previous)
+    return b''.join(blocks)
@@ -11,10 +11,15 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 
 
 import os
+import hmac
 import uuid
+import heapq
+import hashlib
+import collections
 import binascii
 import time
 
+from ..utils.string import to_bytes
 from .clients import ClientManager
 from .crypto import aes_make_iv, aes_encrypt
 
@@ -26,30 +31,232 @@ class SessionException(Exception):
     pass
 
 
-class TimedObject(dict):
+class TimedObject(object):
     """
-    This is a wrapper class for `dict` objects, which provides a simple check
-    for expiration based on the presence of `initiated` and `duration` keys.
+    This is a base class for compact records, which provides a simple check
+    for expiration based on `initiated` and `duration` fields. Subclasses
+    list their fields in `FIELDS` and declare matching `__slots__`, so that
+    tens of thousands of records can be held without a per-record dict.
+
+    For compatibility with code that treats records as dicts, the fields can
+    also be read using item access.
     """
+    __slots__ = ('initiated', 'duration')
+
+    FIELDS = ('initiated', 'duration')
+
+    def __init__(self, **kwargs):
+        for key in self.FIELDS:
+            setattr(self, key, kwargs.get(key))
+
+    @property
+    def expires(self):
+        """
+        Timestamp after which the object is no longer valid, or `None` if the
+        object does not expire.
+        """
+        if self.initiated is None or self.duration is None:
+            return None
+        return self.initiated + self.duration
 
-    def is_valid(self):
+    def is_valid(self, now=None):
         """
         Checks if the object data is valid based on `initiated` and `duration`
-        keys.
-        If the keys are present, it returns if current time is in the range
-        [initiated, initiated + duration]. If they keys are not present,
+        fields.
+        If both are set, it returns if current time is in the range
+        [initiated, initiated + duration]. If either of them is not set,
         returns `True`.
         """
-        if 'initiated' in self and 'duration' in self:
-            elapsed = time.time() - self['initiated']
-            return 0 <= elapsed <= self['duration']
-        return True
+        if self.initiated is None or self.duration is None:
+            return True
+        if now is None:
+            now = time.time()
+        elapsed = now - self.initiated
+        return 0 <= elapsed <= self.duration
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+
+class Handshake(TimedObject):
+    """
+    Pending challenge issued to the client named `client_name`
+    """
+    __slots__ = ('id', 'text', 'client_name', 'cipher', 'cipher_iv')
+
+    FIELDS = ('id', 'text', 'duration', 'client_name', 'initiated', 'cipher',
+              'cipher_iv')
+
+
+class Session(TimedObject):
+    """
+    Authenticated session of the client named `client_name`
+    """
+    __slots__ = ('token', 'client_name')
+
+    FIELDS = ('token', 'client_name', 'duration', 'initiated')
+
+
+class ExpiryIndex(object):
+    """
+    Min-heap of `(expires, key)` pairs which allows expired entries of a table
+    to be found without scanning the whole table.
+
+    Entries are not removed from the index when the matching record is
+    removed from the table before it expires. Such entries simply come up
+    once they expire, and the caller is expected to skip keys which are no
+    longer present in the table.
+    """
+
+    def __init__(self):
+        self.heap = []
+
+    def add(self, key, expires):
+        heapq.heappush(self.heap, (expires, key))
+
+    def pop_expired(self, now=None):
+        """
+        Removes and yields keys of all entries which expired before `now`
+        """
+        if now is None:
+            now = time.time()
+        heap = self.heap
+        while heap and heap[0][0] < now:
+            yield heapq.heappop(heap)[1]
+
+    def clear(self):
+        del self.heap[:]
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class HandshakeStore(object):
+    """
+    Capacity-bounded table of pending handshakes keyed by
+    `(client_name, handshake_id)`.
+
+    At most `client_capacity` handshakes may be pending for a single client.
+    When a client reaches that limit, its oldest handshake is evicted to make
+    room for the new one, and when the table holds `capacity` handshakes, the
+    oldest handshakes of any client are evicted. The number of evicted
+    handshakes is tracked in `evicted`, and their keys are kept until they
+    are collected with `pop_evicted`.
+
+    Since all handshakes last equally long, insertion order is also the order
+    in which they expire, which allows expired handshakes to be removed from
+    the front of the table.
+    """
+
+    def __init__(self, capacity=10000, client_capacity=16):
+        self.capacity = capacity
+        self.client_capacity = client_capacity
+        self.handshakes = collections.OrderedDict()
+        self.pending = {}
+        self.evicted = 0
+        self.evicted_keys = []
+
+    def add(self, key, handshake):
+        """
+        Stores `handshake` under `key`, evicting older handshakes if the
+        client or the table is full
+        """
+        client_name = key[0]
+        # Handshake ids of a client are listed in insertion order
+        pending = self.pending.get(client_name, ())
+        while len(pending) >= self.client_capacity:
+            self.evict((client_name, pending[0]))
+        while len(self.handshakes) >= self.capacity:
+            self.evict(next(iter(self.handshakes)))
+        self.handshakes[key] = handshake
+        self.pending.setdefault(client_name, []).append(key[1])
+
+    def evict(self, key):
+        self.remove(key)
+        self.evicted += 1
+        self.evicted_keys.append(key)
+
+    def get(self, key):
+        return self.handshakes.get(key)
+
+    def pop_evicted(self):
+        """
+        Returns the keys of handshakes evicted since the last call
+        """
+        keys, self.evicted_keys = self.evicted_keys, []
+        return keys
+
+    def remove(self, key):
+        handshake = self.handshakes.pop(key, None)
+        if handshake is None:
+            return None
+        client_name, handshake_id = key
+        pending = self.pending[client_name]
+        pending.remove(handshake_id)
+        if not pending:
+            del self.pending[client_name]
+        return handshake
+
+    def purge_expired(self, now=None):
+        """
+        Removes handshakes which expired before `now` and returns their number
+        """
+        if now is None:
+            now = time.time()
+        count = 0
+        while self.handshakes:
+            key, handshake = next(iter(self.handshakes.items()))
+            if handshake.is_valid(now):
+                break
+            self.remove(key)
+            count += 1
+        return count
+
+    def stats(self):
+        return {
+            'size': len(self.handshakes),
+            'capacity': self.capacity,
+            'evicted': self.evicted,
+        }
+
+    def __contains__(self, key):
+        return key in self.handshakes
+
+    def __len__(self):
+        return len(self.handshakes)
 
 
 class SessionManager(object):
     """
     This class is responsible for maintaining client sessions and handling
     client authentication challenge-response flow
+
+    Handshake ids and session tokens are signed with `secret` and carry
+    everything needed to recreate the handshake or session they identify.
+    This allows processes which share the secret, such as workers of the same
+    server, to accept handshakes and sessions created by one another. A
+    session created by another process is added to the local table the first
+    time it is seen.
+
+    Handshakes which were completed or evicted, and sessions which were
+    invalidated, are revoked so that they are not recreated from their ids.
+    Revoked ids are kept in `revoked`. When several processes share the
+    secret, they are also recorded in the revoked table of `db`, and ids
+    revoked by other processes are read from it at most once every
+    `REVOKED_REFRESH` seconds.
     """
     HANDSHAKE_TEXT_LENGTH = 64  # characters
     HANDSHAKE_DURATION = 30  # seconds
@@ -61,13 +268,43 @@ class SessionManager(object):
     SESSION_DEFAULT_DURATION = 3600  # seconds
     SESSION_MAX_DURATION = 3600 * 24  # seconds
 
-    handshakes = {}
+    SIGNATURE_LENGTH = 32  # characters
+
+    REVOKED_REFRESH = 1  # seconds
+
+    secret = os.urandom(32)
+    handshakes = HandshakeStore()
     sessions = {}
+    session_expiry = ExpiryIndex()
+    # Revoked ids mapped to the time after which they are invalid anyway
+    revoked = {}
+    # Whether revocations are shared with other processes through the
+    # revoked table
+    share_revoked = False
+    # Position of the last revocation read from the revoked table, and time
+    # when the table was last read
+    revoked_seq = 0
+    revoked_checked = 0
+    # Time when expired revocations were last removed
+    revoked_purged = 0
 
     def __init__(self, db):
         self.db = db
         self.client_manager = ClientManager(db)
 
+    @classmethod
+    def configure(cls, config):
+        """
+        Sets up the process-wide handshake table using limits from `config`
+        and the signing secret if one is configured
+        """
+        cls.handshakes = HandshakeStore(
+            capacity=config['auth.max_handshakes'],
+            client_capacity=config['auth.max_client_handshakes'])
+        if config.get('auth.secret'):
+            cls.secret = to_bytes(config['auth.secret'])
+        cls.share_revoked = config.get('server.workers', 1) > 1
+
     def start_handshake(self, client_name):
         """
         Initiates handshake challenge-response state for client
@@ -97,25 +334,48 @@ class SessionManager(object):
         duration = self.calculate_session_duration(response)
         session = self._create_session(client, duration)
         self.invalidate_handshake(client_name, response['id'])
-        return session['token'], session['duration']
+        return session.token, session.duration
 
     def create_handshake(self, client):
         """
         Creates and stores a new handshake object for client ``client``,
         populating it with challenge parameters.
         """
-        handshake = TimedObject({
-            'id': self.generate_handshake_id(),
-            'text': self.generate_handshake_text(),
-            'duration': self.HANDSHAKE_DURATION,
-            'client': client,
-            'initiated': time.time(),
-            'cipher': self.HANDSHAKE_CIPHER,
-            'cipher_iv': aes_make_iv()
-        })
+        initiated = int(time.time())
+        handshake = self._make_handshake(
+            client['name'], self.generate_handshake_id(client, initiated),
+            initiated)
         self.store_handshake(client, handshake)
         return handshake
 
+    def restore_handshake(self, client_name, handshake_id):
+        """
+        Recreates the handshake identified by `handshake_id` for client
+        `client_name`. Returns `None` if the handshake id was not issued using
+        the current secret, or if the handshake was revoked.
+        """
+        try:
+            nonce, initiated, signature = handshake_id.split('.')
+            initiated = int(initiated, 16)
+        except (ValueError, AttributeError):
+            return None
+        if not self.check_signature(signature, 'handshake', client_name,
+                                    nonce, initiated):
+            return None
+        if self.is_revoked(handshake_id):
+            return None
+        return self._make_handshake(client_name, handshake_id, initiated)
+
+    def _make_handshake(self, client_name, handshake_id, initiated):
+        return Handshake(
+            id=handshake_id,
+            text=self.generate_handshake_text(handshake_id),
+            duration=self.HANDSHAKE_DURATION,
+            client_name=client_name,
+            initiated=initiated,
+            cipher=self.HANDSHAKE_CIPHER,
+            cipher_iv=aes_make_iv())
+
     def validate_handshake_response(self, client, response):
         """
         Validates a handshake response for client ``client``, raising
@@ -127,7 +387,7 @@ class SessionManager(object):
             raise SessionException('No matching handshake found for response')
         if not handshake.is_valid():
             raise SessionException('Handshake timedout')
-        cipher = handshake['cipher']
+        cipher = handshake.cipher
         client_key = self.client_manager.get_client_keys(
             client['name']).get(cipher)
         if not client_key:
@@ -143,32 +403,101 @@ class SessionManager(object):
                 raise SessionException(msg)
 
     def validate_ciphertext(self, handshake, response, key):
-        plaintext = handshake['text']
-        enc_iv = handshake['cipher_iv']
+        plaintext = handshake.text
+        enc_iv = handshake.cipher_iv
         client_enc_text = response['encrypted_text']
         server_enc_text = aes_encrypt(plaintext, key, enc_iv)
         return client_enc_text == server_enc_text
 
     def store_handshake(self, client, handshake):
-        hid = handshake['id']
-        self.handshakes[(client['name'], hid)] = handshake
+        key = (client['name'], handshake.id)
+        self.handshakes.add(key, handshake)
+        # Evicted handshakes must not be recreated by other processes either
+        for _, evicted_id in self.handshakes.pop_evicted():
+            self.revoke(evicted_id, time.time() + self.HANDSHAKE_DURATION)
 
     def load_handshake(self, client, handshake_id):
-        return self.handshakes.get((client['name'], handshake_id))
+        key = (client['name'], handshake_id)
+        handshake = self.handshakes.get(key)
+        if handshake is None:
+            return self.restore_handshake(client['name'], handshake_id)
+        # The handshake may have been completed by another process
+        if self.is_revoked(handshake_id):
+            self.handshakes.remove(key)
+            return None
+        return handshake
 
     def invalidate_handshake(self, client_name, handshake_id):
-        self.handshakes.pop((client_name, handshake_id), None)
+        self.handshakes.remove((client_name, handshake_id))
+        # Handshakes never last longer than this from now on
+        self.revoke(handshake_id, time.time() + self.HANDSHAKE_DURATION)
+
+    def revoke(self, key, expires):
+        """
+        Records that the handshake id or session token `key` may no longer be
+        used by any process. The record is kept until `expires`, after which
+        the handshake or session has timed out anyway.
+        """
+        self.revoked[key] = expires
+        if self.share_revoked:
+            query = self.db.Replace('revoked', cols=('id', 'expires'))
+            self.db.execute(query, dict(id=key, expires=expires))
+
+    def is_revoked(self, key):
+        if self.share_revoked:
+            self.refresh_revoked()
+        return key in self.revoked
+
+    def refresh_revoked(self):
+        """
+        Reads the ids revoked by other processes since the last read, unless
+        the revoked table was read less than `REVOKED_REFRESH` seconds ago
+        """
+        now = time.time()
+        if now - self.revoked_checked < self.REVOKED_REFRESH:
+            return
+        SessionManager.revoked_checked = now
+        query = self.db.Select(sets='revoked', what=('seq', 'id', 'expires'),
+                               where='seq > :seq', order='seq')
+        self.db.execute(query, dict(seq=self.revoked_seq))
+        for row in self.db.results:
+            self.revoked[row['id']] = row['expires']
+            SessionManager.revoked_seq = row['seq']
 
     def _create_session(self, client, duration):
-        session = TimedObject({
-            'token': self.generate_session_token(),
-            'client': client,
-            'duration': duration,
-            'initiated': time.time(),
-        })
+        initiated = int(time.time())
+        session = Session(
+            token=self.generate_session_token(client, duration, initiated),
+            client_name=client['name'],
+            duration=duration,
+            initiated=initiated)
         self._store_session(session)
         return session
 
+    def restore_session(self, token):
+        """
+        Recreates the session identified by `token` and adds it to the session
+        table if it is still valid. Returns `None` if the token was not issued
+        using the current secret, or if the session was invalidated.
+        """
+        try:
+            nonce, initiated, duration, name, signature = token.split('.')
+            initiated = int(initiated, 16)
+            duration = int(duration, 16)
+            client_name = binascii.unhexlify(name).decode('utf-8')
+        except (ValueError, TypeError, AttributeError):
+            return None
+        if not self.check_signature(signature, 'session', client_name, nonce,
+                                    initiated, duration):
+            return None
+        if self.is_revoked(token):
+            return None
+        session = Session(token=token, client_name=client_name,
+                          duration=duration, initiated=initiated)
+        if session.is_valid():
+            self._store_session(session)
+        return session
+
     def verify_session(self, session_token):
         """
         Returns a tuple, with the first member as `True` and the second member
@@ -191,36 +520,79 @@ class SessionManager(object):
 
     def invalidate_session(self, session_token):
         """ Invalidates the session with the token `session_token`. """
-        self.sessions.pop(session_token, None)
+        session = self.sessions.pop(session_token, None)
+        if session:
+            expires = session.expires
+        else:
+            expires = time.time() + self.SESSION_MAX_DURATION
+        self.revoke(session_token, expires)
 
     def _store_session(self, session):
-        token = session['token']
+        token = session.token
         self.sessions[token] = session
+        self.session_expiry.add(token, session.expires)
 
     def _load_session(self, token):
-        return self.sessions.get(token)
-
-    def generate_session_token(self):
-        return uuid.uuid4().hex
-
-    def generate_handshake_id(self):
-        return uuid.uuid4().hex
+        session = self.sessions.get(token)
+        if session is None:
+            return self.restore_session(token)
+        # The session may have been invalidated by another process
+        if self.is_revoked(token):
+            self.sessions.pop(token, None)
+            return None
+        return session
 
-    def generate_handshake_text(self):
-        bytes = os.urandom(self.HANDSHAKE_TEXT_LENGTH / 2)
-        return binascii.hexlify(bytes)
+    def sign(self, *parts):
+        message = b'|'.join(to_bytes(part) for part in parts)
+        digest = hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+        return digest[:self.SIGNATURE_LENGTH]
+
+    def check_signature(self, signature, *parts):
+        return hmac.compare_digest(to_bytes(signature), self.sign(*parts))
+
+    def generate_session_token(self, client, duration, initiated):
+        nonce = uuid.uuid4().hex
+        name = binascii.hexlify(to_bytes(client['name']))
+        signature = self.sign('session', client['name'], nonce, initiated,
+                              duration)
+        return '{}.{:x}.{:x}.{}.{}'.format(nonce, initiated, duration, name,
+                                           signature)
+
+    def generate_handshake_id(self, client, initiated):
+        nonce = uuid.uuid4().hex
+        signature = self.sign('handshake', client['name'], nonce, initiated)
+        return '{}.{:x}.{}'.format(nonce, initiated, signature)
+
+    def generate_handshake_text(self, handshake_id):
+        # The text is derived from the id so that any process which shares
+        # the secret can verify the response to the challenge
+        digest = hmac.new(self.secret, b'text|' + to_bytes(handshake_id),
+                          hashlib.sha256).hexdigest()
+        return digest[:self.HANDSHAKE_TEXT_LENGTH]
 
     def cleanup(self):
-        count = 0
-        for key, handshake in self.handshakes.items():
-            if not handshake.is_valid():
-                self.invalidate_handshake(*key)
-                count += 1
-
-        for key, session in self.sessions.items():
-            if not session.is_valid():
-                self.invalidate_session(key)
+        """
+        Removes timed out handshakes and sessions and returns their number.
+        Only the entries which are due are looked at, so this is cheap enough
+        to run very often.
+        """
+        now = time.time()
+        count = self.handshakes.purge_expired(now)
+        for key in self.session_expiry.pop_expired(now):
+            session = self.sessions.get(key)
+            if session and not session.is_valid(now):
+                # Timed out sessions are rejected anyway, so they need not
+                # be revoked
+                del self.sessions[key]
                 count += 1
+        if now - self.revoked_purged >= self.HANDSHAKE_DURATION:
+            for key, expires in list(self.revoked.items()):
+                if expires < now:
+                    del self.revoked[key]
+            if self.share_revoked:
+                query = self.db.Delete('revoked', where='expires < :now')
+                self.db.execute(query, dict(now=now))
+            SessionManager.revoked_purged = now
         return count
 
     def strip_handshake(self, handshake):
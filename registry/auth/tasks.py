@@ -11,22 +11,15 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 
 from __future__ import unicode_literals
 
-import time
 import logging
 
-from .sessions import SessionManager
+from ..utils.scheduler import background_task
 
 
+@background_task(interval=1)
 def cleanup(app, config):
-    cleanup_time = config.get('auth.next_cleanup', 0)
-    if cleanup_time > time.time():
-        return
-
-    databases = config['database.connections']
-    session_mgr = SessionManager(databases.registry)
+    session_mgr = config['auth.sessions']
     count = session_mgr.cleanup()
     if count:
         logging.info('{} timed out sessions and handshakes cleaned up'.format(
             count))
-    next_cleanup = time.time() + config['auth.cleanup_interval']
-    config['auth.next_cleanup'] = next_cleanup
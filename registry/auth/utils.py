@@ -15,18 +15,22 @@ import functools
 
 from bottle import request, abort
 
+from ..utils.metrics import metrics, COUNTER, GAUGE
+from .clients import ClientManager
 from .sessions import SessionManager
 
 
 def get_session_manager():
-    db = request.db.registry
-    return SessionManager(db)
+    return request.app.config['auth.sessions']
 
 
 def check_auth(func):
     @functools.wraps(func)
     def decorator(*args, **kwargs):
-        token = request.params.get('session_token')
+        # Request bodies are only parsed as forms if the token is not in the
+        # query string, so that endpoints can read other bodies themselves
+        token = (request.query.get('session_token') or
+                 request.params.get('session_token'))
         sessions = get_session_manager()
         verified, session = sessions.verify_session(token)
         if verified:
@@ -35,3 +39,29 @@ def check_auth(func):
         else:
             raise abort(401, session)
     return decorator
+
+
+def collect_metrics():
+    handshakes = SessionManager.handshakes
+    cache = ClientManager.cache
+    yield ('registry_sessions', GAUGE, 'Number of active sessions',
+           [({}, len(SessionManager.sessions))])
+    yield ('registry_handshakes', GAUGE, 'Number of pending handshakes',
+           [({}, len(handshakes))])
+    yield ('registry_handshakes_dropped_total', COUNTER,
+           'Number of handshakes evicted to make room for new ones, because '
+           'the table or the client had too many pending handshakes',
+           [({'reason': 'evicted'}, handshakes.evicted)])
+    yield ('registry_client_cache_requests_total', COUNTER,
+           'Number of client cache lookups',
+           [({'result': 'hit'}, cache.hits),
+            ({'result': 'miss'}, cache.misses)])
+
+
+def pre_init(app, config):
+    # The session manager only holds references to process-wide state, so a
+    # single instance is shared by all requests.
+    databases = config['database.connections']
+    SessionManager.configure(config)
+    config['auth.sessions'] = SessionManager(databases.registry)
+    metrics.add_collector('auth', collect_metrics)
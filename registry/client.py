@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+client.py: client for the registry API, used by registries to talk to peers
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import json
+import gzip
+import socket
+import httplib
+
+try:
+    from urllib import urlencode
+    from urlparse import urlsplit
+except ImportError:
+    from urllib.parse import urlencode, urlsplit
+
+from .auth.crypto import aes_encrypt
+from .content.content import LIST_COLS
+from .content.merkle import LOOKUP_SIZE, MAX_NODES
+from .content.snapshot import SnapshotReader
+
+
+FORM_HEADERS = {str('Content-Type'): str('application/x-www-form-urlencoded')}
+
+
+class RegistryError(Exception):
+    pass
+
+
+def to_native(value):
+    # httplib concatenates request parts with the body, so they must not be
+    # unicode strings
+    return value.encode('utf8') if isinstance(value, unicode) else value
+
+
+class RegistryClient(object):
+    """
+    Client for the registry at ``url``, which authenticates as the client
+    named ``client_name`` using ``key``. A session is started on the first
+    request, and restarted when it expires.
+
+    The `root`, `children` and `rows` methods provide the remote Merkle tree
+    in the same form as `content.merkle.MerkleTree`.
+    """
+
+    def __init__(self, url, client_name, key, timeout=30):
+        parts = urlsplit(url)
+        self.name = url
+        self.host = to_native(parts.hostname)
+        self.port = parts.port
+        self.prefix = parts.path.rstrip('/')
+        self.client_name = client_name
+        self.key = to_native(key)
+        self.timeout = timeout
+        self.token = None
+        self.conn = None
+
+    @classmethod
+    def from_config(cls, url, config, section='sync'):
+        """
+        Creates a client using the credentials and timeout set in
+        ``section`` of ``config``
+        """
+        return cls(url, config[section + '.client_name'],
+                   config[section + '.client_key'],
+                   timeout=config[section + '.timeout'])
+
+    def send(self, method, path, params=None):
+        """
+        Sends a request and returns the response status and body. Connection
+        failures are retried once on a new connection, as the server may have
+        closed an idle one.
+        """
+        params = dict((to_native(k), to_native(v))
+                      for k, v in (params or {}).items())
+        url = to_native(self.prefix + path)
+        body = None
+        headers = {}
+        if method == 'GET':
+            if params:
+                url += b'?' + urlencode(params)
+        else:
+            body = urlencode(params)
+            headers = FORM_HEADERS
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = httplib.HTTPConnection(self.host, self.port,
+                                                   timeout=self.timeout)
+            try:
+                self.conn.request(str(method), url, body, headers)
+                resp = self.conn.getresponse()
+                return resp.status, resp.read()
+            except (httplib.HTTPException, socket.error):
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def authenticate(self):
+        status, body = self.send('POST', '/auth',
+                                 {'client_name': self.client_name})
+        challenge = self.parse(status, body)['challenge']
+        encrypted = aes_encrypt(to_native(challenge['text']), self.key,
+                                to_native(challenge['cipher_iv']))
+        status, body = self.send('POST', '/auth_verify', {
+            'client_name': self.client_name,
+            'id': challenge['id'],
+            'encrypted_text': encrypted,
+        })
+        self.token = self.parse(status, body)['session']['token']
+
+    def fetch(self, method, path, params=None):
+        """
+        Sends an authenticated request and returns the response status and
+        body
+        """
+        params = dict(params or {})
+        if not self.token:
+            self.authenticate()
+        params['session_token'] = self.token
+        status, body = self.send(method, path, params)
+        if status == 401:
+            self.authenticate()
+            params['session_token'] = self.token
+            status, body = self.send(method, path, params)
+        return status, body
+
+    def request(self, method, path, params=None):
+        """
+        Sends an authenticated request and returns the decoded JSON response
+        """
+        return self.parse(*self.fetch(method, path, params))
+
+    @staticmethod
+    def parse(status, body):
+        if status != 200:
+            raise RegistryError('Request failed with status {}'.format(status))
+        data = json.loads(body)
+        if not data.get('success'):
+            raise RegistryError(data.get('error') or data.get('message'))
+        return data
+
+    def root(self):
+        data = self.request('GET', '/merkle')
+        return data['depth'], data['hash']
+
+    def children(self, level, indices):
+        result = {}
+        for start in range(0, len(indices), MAX_NODES):
+            chunk = indices[start:start + MAX_NODES]
+            data = self.request('GET', '/merkle/{}'.format(level), {
+                'nodes': ','.join(str(index) for index in chunk)})
+            for index, children in data['children'].items():
+                result[int(index)] = dict((int(child), value)
+                                          for child, value in children.items())
+        return result
+
+    def rows(self, buckets):
+        for start in range(0, len(buckets), LOOKUP_SIZE):
+            chunk = buckets[start:start + LOOKUP_SIZE]
+            data = self.request('GET', '/merkle/rows', {
+                'buckets': ','.join(str(bucket) for bucket in chunk)})
+            yield [tuple(entry[col] for col in LIST_COLS)
+                   for entry in data['results']]
+
+    def changes(self, after, count):
+        return self.request('GET', '/changes', {'after': after,
+                                                'count': count})
+
+    def snapshot(self):
+        """
+        Returns a `SnapshotReader` for the registry's snapshot, or None if
+        it has none
+        """
+        status, body = self.fetch('GET', '/snapshot')
+        if status == 404:
+            return None
+        if status != 200:
+            raise RegistryError('Request failed with status {}'.format(status))
+        return SnapshotReader(gzip.GzipFile(fileobj=io.BytesIO(body)))
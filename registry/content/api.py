@@ -13,16 +13,44 @@ from __future__ import unicode_literals
 
 import os
 import logging
+import functools
 
-from bottle import request, abort, static_file, HTTP_CODES
+from bottle import (request, response, abort, redirect, static_file,
+                    HTTP_CODES)
 
 from ..utils.http import urldecode_params
+from ..utils.ratelimit import rate_limited, CHEAP, EXPENSIVE
+from ..utils.compression import serve_cached
 from .manager import ContentManager, ContentException
+from .content import LIST_COLS, ContentRecord
+from .serializer import RowSerializer, iter_listing
+from .reconcile import BloomFilter, DigestSet, MAX_SUMMARY_SIZE
+from .merkle import MerkleTree, LOOKUP_SIZE, MAX_NODES
+from .uploads import UploadManager, UploadException, OffsetMismatch
+from .verifier import Verifier
 from ..auth.utils import check_auth
 
 
 ADD_FILE_REQ_PARAMS = ('path', 'serve_path')
 
+# Parameters computed by the registry, which clients may not set
+COMPUTED_PARAMS = ('checksum',)
+
+LIST_SERIALIZER = RowSerializer(LIST_COLS, booleans=('alive',))
+
+
+def writable(func):
+    """
+    Rejects requests to modify content on a read-only replica
+    """
+    @functools.wraps(func)
+    def decorator(*args, **kwargs):
+        primary = request.app.config['replication.primary']
+        if primary:
+            abort(403, 'Read-only replica of {}'.format(primary))
+        return func(*args, **kwargs)
+    return decorator
+
 
 def get_manager():
     config = request.app.config
@@ -30,6 +58,30 @@ def get_manager():
     return ContentManager(config=config, db=db)
 
 
+def get_upload_manager():
+    return UploadManager(config=request.app.config, db=request.db.registry)
+
+
+def get_upload(upload_mgr, upload_id):
+    """
+    Returns the upload with ``upload_id``, which must have been started by
+    the client of the session
+    """
+    upload = upload_mgr.get(upload_id)
+    if upload is None:
+        abort(404, HTTP_CODES[404])
+    if upload['client_name'] != request.session.client_name:
+        abort(403, 'Upload was started by another client')
+    return upload
+
+
+def get_file_params():
+    params = urldecode_params(request.forms)
+    for key in COMPUTED_PARAMS:
+        params.pop(key, None)
+    return params
+
+
 def check_params(params, required_params):
     for p in required_params:
         val = params.get(p, None)
@@ -37,14 +89,68 @@ def check_params(params, required_params):
             abort(400, '`{}` must be specified'.format(p))
 
 
+def get_summary(params):
+    """
+    Returns the summary of the receiver catalog uploaded as either a Bloom
+    filter in the ``bloom`` field, along with the number of hash functions in
+    ``hashes``, or as a set of digests in the ``digests`` field
+    """
+    for name in ('bloom', 'digests'):
+        upload = request.files.get(name)
+        if upload is not None:
+            break
+    else:
+        raise ValueError('`bloom` or `digests` must be uploaded')
+    data = upload.file.read(MAX_SUMMARY_SIZE + 1)
+    if len(data) > MAX_SUMMARY_SIZE:
+        raise ValueError('`{}` exceeds {} bytes'.format(name,
+                                                         MAX_SUMMARY_SIZE))
+    if name == 'digests':
+        return DigestSet(data)
+    try:
+        hashes = int(params.get('hashes', ''))
+    except ValueError:
+        raise ValueError('`hashes` must be an integer')
+    return BloomFilter(data, hashes)
+
+
+def get_indices(name, limit):
+    """
+    Returns the list of comma separated integers in the query parameter
+    ``name``, of which there may be at most ``limit``
+    """
+    try:
+        indices = [int(value) for value in
+                   request.query.get(name, '').split(',') if value]
+    except ValueError:
+        raise ValueError('`{}` must be a list of integers'.format(name))
+    if not indices or len(indices) > limit:
+        raise ValueError('`{}` must list between 1 and {} values'.format(
+            name, limit))
+    return indices
+
+
+def list_kind():
+    # Regular expression matching runs against every row
+    return EXPENSIVE if 'serve_path' in request.query else CHEAP
+
+
 @check_auth
+@rate_limited(list_kind)
 def list_files():
     content_mgr = get_manager()
     params = urldecode_params(request.query)
     valid_params, _ = content_mgr.split_valid_filters(params)
     try:
-        files = content_mgr.list_files(**valid_params)
-        return {'success': True, 'results': files, 'count': len(files)}
+        key = content_mgr.listing_key(
+            content_mgr.get_list_filters(**valid_params), 'response')
+        # Rows are encoded directly, bypassing the JSON plugin, and the
+        # response is streamed as the rows are fetched
+        response.content_type = 'application/json'
+        return serve_cached(
+            request.app.config.get('compression.cache'), key,
+            lambda: iter_listing(LIST_SERIALIZER,
+                                 content_mgr.list_rows(**valid_params)))
     except (ContentException, ValueError) as exc:
         return {'success': False, 'error': str(exc)}
     except Exception as exc:
@@ -52,28 +158,131 @@ def list_files():
         return {'success': False, 'error': 'Unknown Error'}
 
 
+@check_auth
+@rate_limited(EXPENSIVE)
+def reconcile():
+    content_mgr = get_manager()
+    params = urldecode_params(request.forms)
+    valid_params, _ = content_mgr.split_valid_filters(params)
+    try:
+        summary = get_summary(params)
+        rows = content_mgr.reconcile_rows(summary, **valid_params)
+        response.content_type = 'application/json'
+        return iter_listing(LIST_SERIALIZER, rows)
+    except (ContentException, ValueError) as exc:
+        return {'success': False, 'error': str(exc)}
+    except Exception as exc:
+        logging.exception('Error while reconciling: {}'.format(exc))
+        return {'success': False, 'error': 'Unknown Error'}
+
+
+@check_auth
+@rate_limited(CHEAP)
+def merkle_root():
+    depth, root = MerkleTree(request.db.registry).root()
+    return {'success': True, 'depth': depth, 'hash': root}
+
+
+@check_auth
+@rate_limited(CHEAP)
+def merkle_children(level):
+    try:
+        nodes = get_indices('nodes', MAX_NODES)
+        children = MerkleTree(request.db.registry).children(level, nodes)
+        return {'success': True, 'children': children}
+    except ValueError as exc:
+        return {'success': False, 'error': str(exc)}
+
+
+@check_auth
+@rate_limited(EXPENSIVE)
+def merkle_rows():
+    try:
+        buckets = get_indices('buckets', LOOKUP_SIZE)
+    except ValueError as exc:
+        return {'success': False, 'error': str(exc)}
+    response.content_type = 'application/json'
+    return iter_listing(LIST_SERIALIZER,
+                        MerkleTree(request.db.registry).rows(buckets))
+
+
+@check_auth
+@rate_limited(CHEAP)
+def get_changes():
+    content_mgr = get_manager()
+    try:
+        after = int(request.query.get('after', 0))
+        count = int(request.query.get('count', content_mgr.MAX_LIST_COUNT))
+    except ValueError:
+        return {'success': False, 'error': '`after` and `count` must be '
+                                           'integers'}
+    # Negative counts would lift the limit
+    count = max(1, min(count, content_mgr.MAX_LIST_COUNT))
+    last, actions, rows = content_mgr.get_changes(after, count)
+    return {'success': True, 'last': last, 'actions': actions,
+            'results': [ContentRecord(row).to_dict() for row in rows]}
+
+
+@check_auth
+@rate_limited(CHEAP)
+def get_discrepancies():
+    try:
+        after = int(request.query.get('after', 0))
+        count = int(request.query.get('count', ContentManager.MAX_LIST_COUNT))
+    except ValueError:
+        return {'success': False, 'error': '`after` and `count` must be '
+                                           'integers'}
+    # Negative counts would lift the limit
+    count = max(1, min(count, ContentManager.MAX_LIST_COUNT))
+    verifier = Verifier(request.db.registry)
+    position, passes, started = verifier.state()
+    return {'success': True, 'position': position, 'passes': passes,
+            'started': started,
+            'results': verifier.discrepancies(after, count)}
+
+
 def get_file(id):
-    config = request.app.config
-    item = get_manager().get_file(id=id)
-    if item:
+    content_mgr = get_manager()
+    item = content_mgr.get_file(id=id)
+    volume = item and content_mgr.volumes.locate(item['path'])
+    primary = request.app.config['replication.primary']
+    if volume and (not primary or os.path.isfile(item['path'])):
         path = item['path']
-        root_dir = config['registry.root_path']
+        root_dir = volume.root
         rel_path = os.path.relpath(path, root_dir)
         return static_file(rel_path, root=root_dir,
-                           download=os.path.basename(path))
+                           download=os.path.basename(item['serve_path']))
+    elif item and primary:
+        # Replicas only copy entries, so files which are not on storage
+        # shared with the primary are downloaded from the primary
+        redirect('{}/{}'.format(primary.rstrip('/'), item['id']), 302)
     else:
         raise abort(404, HTTP_CODES[404])
 
 
 @check_auth
+@rate_limited(CHEAP)
+def get_snapshot():
+    config = request.app.config
+    if not config['snapshot.enabled']:
+        abort(404, HTTP_CODES[404])
+    path = config['snapshot.path']
+    # The snapshot is already compressed, and is served as is
+    return static_file(os.path.basename(path), root=os.path.dirname(path),
+                       mimetype='application/octet-stream')
+
+
+@check_auth
+@rate_limited(EXPENSIVE)
+@writable
 def add_file():
-    params = urldecode_params(request.forms)
+    params = get_file_params()
     check_params(params, ADD_FILE_REQ_PARAMS)
     path = params.get('path')
-    client = request.session['client']
+    client_name = request.session.client_name
     content_mgr = get_manager()
     try:
-        result = content_mgr.add_file(client, path, params)
+        result = content_mgr.add_file(client_name, path, params)
         return {'success': True, 'results': [result]}
     except ContentException as exc:
         return {'success': False, 'error': str(exc)}
@@ -83,12 +292,99 @@ def add_file():
 
 
 @check_auth
-def update_file(id):
+@rate_limited(CHEAP)
+@writable
+def start_upload():
+    params = urldecode_params(request.forms)
+    client_name = request.session.client_name
+    try:
+        upload = get_upload_manager().create(client_name, params)
+        return {'success': True, 'upload': upload}
+    except UploadException as exc:
+        return {'success': False, 'error': str(exc)}
+    except Exception as exc:
+        logging.exception('Error while starting upload: {}'.format(str(exc)))
+        return {'success': False, 'error': 'Unknown Error'}
+
+
+@check_auth
+@rate_limited(CHEAP)
+def upload_status(upload_id):
+    upload_mgr = get_upload_manager()
+    get_upload(upload_mgr, upload_id)
+    return {'success': True, 'upload': upload_mgr.status(upload_id)}
+
+
+@check_auth
+@rate_limited(CHEAP)
+@writable
+def upload_chunk(upload_id):
+    upload_mgr = get_upload_manager()
+    get_upload(upload_mgr, upload_id)
+    try:
+        offset = int(request.query.get('offset', ''))
+    except ValueError:
+        return {'success': False, 'error': '`offset` must be an integer'}
+    # The body is read from the input stream as it is written, instead of
+    # being buffered by bottle first
+    length = request.content_length
+    if length < 0:
+        length = None
+    try:
+        offset = upload_mgr.append(upload_id, offset,
+                                   request.environ['wsgi.input'], length)
+        return {'success': True,
+                'upload': {'id': upload_id, 'offset': offset}}
+    except OffsetMismatch as exc:
+        response.status = 409
+        return {'success': False, 'error': str(exc), 'offset': exc.offset}
+    except UploadException as exc:
+        return {'success': False, 'error': str(exc)}
+    except Exception as exc:
+        logging.exception('Error while uploading: {}'.format(str(exc)))
+        return {'success': False, 'error': 'Unknown Error'}
+
+
+@check_auth
+@rate_limited(EXPENSIVE)
+@writable
+def complete_upload(upload_id):
     params = urldecode_params(request.forms)
-    client = request.session['client']
+    upload_mgr = get_upload_manager()
+    get_upload(upload_mgr, upload_id)
+    try:
+        result = upload_mgr.complete(upload_id, params.get('checksum'))
+        return {'success': True, 'results': [result]}
+    except ContentException as exc:
+        return {'success': False, 'error': str(exc)}
+    except Exception as exc:
+        logging.exception('Error while completing upload: {}'.format(
+            str(exc)))
+        return {'success': False, 'error': 'Unknown Error'}
+
+
+@check_auth
+@rate_limited(CHEAP)
+@writable
+def cancel_upload(upload_id):
+    upload_mgr = get_upload_manager()
+    get_upload(upload_mgr, upload_id)
+    try:
+        upload_mgr.cancel(upload_id)
+        return {'success': True}
+    except UploadException as exc:
+        return {'success': False, 'error': str(exc)}
+
+
+@check_auth
+@rate_limited(CHEAP)
+@writable
+def update_file(id):
+    params = get_file_params()
+    client_name = request.session.client_name
     content_mgr = get_manager()
     try:
-        result = content_mgr.update_file(client, id, params)
+        result = content_mgr.update_file(client_name, id, params)
         return {'success': True, 'results': [result]}
     except ContentException as exc:
         return {'success': False, 'error': str(exc)}
@@ -98,11 +394,13 @@ def update_file(id):
 
 
 @check_auth
+@rate_limited(CHEAP)
+@writable
 def delete_file(id):
-    client = request.session['client']
+    client_name = request.session.client_name
     content_mgr = get_manager()
     try:
-        content_mgr.delete_file(client, id)
+        content_mgr.delete_file(client_name, id)
         return {'success': True}
     except ContentException as exc:
         return {'success': False, 'error': str(exc)}
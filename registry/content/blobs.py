@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+blobs.py: content-addressed storage of files under the root path
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import hashlib
+import logging
+
+from .volumes import Volumes
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_checksum(path, chunk_size=CHUNK_SIZE):
+    """
+    Returns the hex encoded SHA256 digest of the file at ``path``
+    """
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class BlobStore(object):
+    """
+    Stores files in blobs named after their checksum in the blob directory
+    of a storage volume, so that files with the same data share a single
+    blob. Entries of files stored this way have the path of the blob. New
+    blobs are stored on the volume of the file they are created from.
+
+    The number of live entries stored in each blob is counted in the blobs
+    table. Blobs which have not been referenced for ``grace`` seconds are
+    removed by `collect`. Blobs are stored and removed while holding the
+    database write lock, so a blob is never removed while it is referenced
+    again.
+    """
+
+    def __init__(self, config, db, volumes=None):
+        self.db = db
+        self.root_path = os.path.abspath(config['registry.root_path'])
+        self.directory = config.get('storage.directory', '.blobs')
+        self.volumes = volumes or Volumes.from_config(config, db)
+        self.grace = config.get('storage.gc_grace', 3600)
+
+    def blob_dir(self, root=None):
+        return os.path.join(root or self.root_path, self.directory)
+
+    def blob_path(self, checksum, root=None):
+        # Blobs are spread over two levels of directories, so that
+        # directories stay small
+        return os.path.join(self.blob_dir(root), checksum[:2], checksum[2:4],
+                            checksum)
+
+    def is_blob(self, path):
+        return bool(path) and any(
+            os.path.abspath(path).startswith(self.blob_dir(volume.root) +
+                                             os.sep)
+            for volume in self.volumes)
+
+    def locate(self, checksum):
+        """
+        Returns the root of the volume holding the blob with ``checksum``,
+        or None if there is no such blob
+        """
+        self.db.query('SELECT volume FROM blobs WHERE checksum = ?;',
+                      checksum)
+        row = self.db.result
+        if row is None:
+            return None
+        return row[0] or self.root_path
+
+    def store(self, path, checksum=None):
+        """
+        Stores the file at ``path`` in the blob matching its data, and
+        returns the checksum and the path of the blob. ``checksum`` is
+        computed if not specified. The file is moved to the blob if there is
+        no such blob yet, or removed if there is one already.
+        """
+        checksum = checksum or file_checksum(path)
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            root = self.locate(checksum)
+            if root is None or not os.path.exists(
+                    self.blob_path(checksum, root)):
+                # Renaming the file is only possible on its own volume
+                volume = self.volumes.locate(path)
+                root = volume.root if volume else self.root_path
+            blob_path = self.blob_path(checksum, root)
+            self.db.execute(
+                'INSERT OR IGNORE INTO blobs (checksum, size) VALUES (?, ?);',
+                (checksum, os.path.getsize(path)))
+            self.db.execute(
+                'UPDATE blobs SET refs = refs + 1, released = NULL, '
+                'volume = ? WHERE checksum = ?;', (root, checksum))
+            if os.path.abspath(path) != blob_path:
+                self.place(path, blob_path)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return checksum, blob_path
+
+    @staticmethod
+    def place(path, blob_path):
+        if os.path.exists(blob_path):
+            logging.debug('Data of {} is already stored in {}'.format(
+                path, blob_path))
+            os.remove(path)
+            return
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            os.makedirs(os.path.dirname(blob_path))
+        os.rename(path, blob_path)
+
+    def release(self, path):
+        """
+        Drops a reference to the blob at ``path``. Paths which are not in the
+        blob directory are ignored.
+        """
+        if not self.is_blob(path):
+            return
+        self.db.execute(
+            'UPDATE blobs SET refs = MAX(refs - 1, 0), released = ? '
+            'WHERE checksum = ?;', (time.time(), os.path.basename(path)))
+
+    def refs(self, checksum):
+        self.db.query('SELECT refs FROM blobs WHERE checksum = ?;', checksum)
+        row = self.db.result
+        return row[0] if row else None
+
+    def collect(self, limit=None, rate=None):
+        """
+        Removes at most ``limit`` blobs which have not been referenced for
+        the grace period, and at most ``rate`` blobs per second if
+        specified, and returns the number of bytes freed
+        """
+        self.db.query(
+            'SELECT checksum FROM blobs WHERE refs = 0 AND released < ? '
+            'ORDER BY released LIMIT ?;',
+            time.time() - self.grace, -1 if limit is None else limit)
+        candidates = [row[0] for row in self.db.results]
+        freed = 0
+        for checksum in candidates:
+            freed += self.remove(checksum)
+            if rate:
+                time.sleep(1.0 / rate)
+        if candidates:
+            logging.info('Removed {} unreferenced blobs, freeing {} '
+                         'bytes'.format(len(candidates), freed))
+        return freed
+
+    def remove(self, checksum):
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            self.db.query('SELECT size, volume FROM blobs WHERE '
+                          'checksum = ? AND refs = 0;', checksum)
+            row = self.db.result
+            if row is None:
+                # Referenced again in the meantime
+                self.db.rollback()
+                return 0
+            self.db.execute('DELETE FROM blobs WHERE checksum = ?;',
+                            (checksum,))
+            try:
+                os.remove(self.blob_path(checksum, row[1]))
+            except OSError:
+                pass
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return row[0]
@@ -10,14 +10,88 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 
+import time
+import itertools
+
 from .filters import to_filters
-from ..utils.databases import row_to_dict
+from ..utils.databases import BATCH_SIZE, iter_batches
 
 
 COLS = (
     'id', 'path', 'size', 'uploaded', 'modified', 'category', 'expiration',
-    'serve_path', 'alive'
+    'serve_path', 'alive', 'checksum'
+)
+
+# Columns of listings, in the order of the table columns
+LIST_COLS = (
+    'id', 'path', 'size', 'uploaded', 'modified', 'category', 'expiration',
+    'serve_path', 'aired', 'alive', 'checksum'
 )
+TIMESTAMP_COLS = ('uploaded', 'modified', 'expiration')
+
+
+class ContentRecord(object):
+    """
+    Compact record of a content entry with fields listed in `FIELDS`. Fields
+    are stored in slots, so that records take a fraction of the memory dicts
+    with the same keys would take.
+
+    For compatibility with code that treats content entries as dicts, fields
+    can also be read and set using item access.
+    """
+    __slots__ = LIST_COLS
+
+    FIELDS = LIST_COLS
+    SETTERS = ()
+
+    def __init__(self, values):
+        for set_field, value in zip(self.SETTERS, values):
+            set_field(self, value)
+
+    def keys(self):
+        return list(self.FIELDS)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.FIELDS]
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            return getattr(self, key)
+        return default
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+
+# Setting fields through the slot descriptors is faster than using setattr
+ContentRecord.SETTERS = tuple(getattr(ContentRecord, key).__set__
+                              for key in ContentRecord.FIELDS)
 
 
 def process_content_data(data):
@@ -32,26 +106,157 @@ def strip_extra(data, valid_keys):
     return stripped_data
 
 
-@to_filters
-def get_content(db, filters):
-    query = db.Select(sets='content', what='*')
+def raw_column(name):
+    # Casting prevents conversion of timestamps to datetime objects, as the
+    # result of an expression has no declared type
+    if name in TIMESTAMP_COLS:
+        return 'CAST({0} AS REAL) AS {0}'.format(name)
+    return name
+
+
+RAW_LIST_COLS = [raw_column(col) for col in LIST_COLS]
+
+
+def build_query(db, filters, what='*'):
+    query = db.Select(sets='content', what=what)
     params = []
     for filt in filters:
         query, params = filt.apply(query, params)
-    db.execute(query, params)
-    return [row_to_dict(row) for row in db.results]
+    return query, params
+
+
+def is_sharded(db):
+    return getattr(db, 'shards', None) is not None
+
+
+def query_batches(db, query, params, order=None, filters=(),
+                  size=BATCH_SIZE):
+    """
+    Executes ``query`` selecting `LIST_COLS` or `RAW_LIST_COLS` from the
+    content table, ordered by the columns listed in ``order`` if specified,
+    and returns an iterator over batches of results. If the content table of
+    ``db`` is sharded, the query is run on the shards which may hold entries
+    matching ``filters``.
+    """
+    if is_sharded(db):
+        return db.iter_batches(query, params, order, filters, size)
+    if order:
+        query.order = order
+    return iter_batches(db, query, params, size)
+
+
+def query_results(db, query, params, filters=()):
+    return itertools.chain.from_iterable(
+        query_batches(db, query, params, filters=filters))
+
+
+@to_filters
+def get_content(db, filters):
+    query, params = build_query(db, filters, what=LIST_COLS)
+    return map(ContentRecord, query_results(db, query, params, filters))
+
+
+@to_filters
+def iter_content(db, filters):
+    """
+    Returns an iterator over records of matching entries, which are fetched
+    from the database in batches as the iterator is consumed
+    """
+    query, params = build_query(db, filters, what=LIST_COLS)
+    return itertools.imap(ContentRecord,
+                          query_results(db, query, params, filters))
+
+
+@to_filters
+def iter_content_rows(db, filters):
+    """
+    Returns an iterator over batches of rows with values of `LIST_COLS`
+    columns, where timestamps are seconds since epoch instead of datetime
+    objects
+    """
+    query, params = build_query(db, filters, what=RAW_LIST_COLS)
+    return query_batches(db, query, params, filters=filters)
+
+
+class Generation(object):
+    """
+    Identifies the state of the catalog, so that data derived from it can be
+    discarded once it changes. Changes made by this process are counted in
+    `changes`, and changes committed by other processes are detected with
+    sqlite's `data_version` pragma, which only reflects the latter. The
+    pragma is queried at most once every `CHECK_INTERVAL` seconds, so changes
+    made by other processes are noticed with that much delay. It is queried
+    on each shard of sharded databases as well.
+    """
+    CHECK_INTERVAL = 1  # seconds
+
+    changes = 0
+    version = None
+    checked = 0
+
+    @classmethod
+    def bump(cls):
+        cls.changes += 1
+
+    @classmethod
+    def get(cls, db):
+        now = time.time()
+        if now - cls.checked >= cls.CHECK_INTERVAL:
+            versions = []
+            for conn in [db] + list(getattr(db, 'shards', None) or ()):
+                conn.query('PRAGMA data_version;')
+                versions.append(conn.result[0])
+            cls.version = tuple(versions)
+            cls.checked = now
+        return (cls.version, cls.changes)
 
 
 def add_content(db, data):
     data = process_content_data(data)
+    if is_sharded(db):
+        return db.add_content(data)
     query = db.Insert('content', cols=data.keys())
     db.execute(query, data)
+    Generation.bump()
     db.execute('SELECT last_insert_rowid() as last_id;')
     return db.result['last_id']
 
 
 def update_content(db, data):
     data = process_content_data(data)
+    if is_sharded(db):
+        db.update_content(data)
+        return
     placeholders = {key: ':{}'.format(key) for key in data.keys()}
     query = db.Update('content', where='id=:id', **placeholders)
     db.execute(query, data)
+    Generation.bump()
+
+
+def allocate_id(db):
+    """
+    Returns an id which has never been used by an entry, for entries copied
+    from another registry whose id is taken. Unless `db` is sharded, the id
+    is only reserved once an entry is written with it, so both must happen
+    in the same transaction.
+    """
+    if is_sharded(db):
+        return db.allocate_id()
+    db.query("SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence "
+             "WHERE name = 'content'), 0), "
+             "COALESCE((SELECT MAX(id) FROM content), 0)) + 1;")
+    return db.result[0]
+
+
+def replace_content(db, rows):
+    """
+    Writes `rows` with values of `LIST_COLS` copied from another registry,
+    replacing entries with the same ids
+    """
+    if is_sharded(db):
+        db.replace_content(rows)
+        return
+    query = 'INSERT OR REPLACE INTO content ({}) VALUES ({});'.format(
+        ', '.join(LIST_COLS), ', '.join('?' * len(LIST_COLS)))
+    db.executemany(query, [tuple(row) for row in rows])
+    Generation.bump()
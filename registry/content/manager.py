@@ -17,9 +17,16 @@ import os
 import time
 import pprint
 import logging
+import itertools
 
-from ..utils.databases import row_to_dict
-from .content import add_content, get_content, update_content
+from ..utils.cache import TTLCache
+from ..utils.databases import row_to_dict, iter_results
+from .content import (add_content, get_content, iter_content,
+                      iter_content_rows, update_content, Generation)
+from .reconcile import iter_differences
+from .merkle import MerkleTree
+from .blobs import BlobStore
+from .volumes import Volumes
 
 
 class ContentException(Exception):
@@ -30,11 +37,27 @@ class ContentManager(object):
     """
     This class provides methods to query content database for their properties
     and methods to add, modify, delete those entries
+
+    Listings limited by count are cached process-wide for ``CACHE_TTL``
+    seconds. Cached listings are keyed by the catalog generation, so they are
+    no longer used as soon as the catalog changes.
+
+    When deduplication is enabled, added files are moved to the blob store
+    and their entries point to the blob holding their data. Entries which are
+    deleted or point to another file release their blob either way.
+
+    Files may be stored on any of the configured storage volumes, and the
+    number and size of the live entries on each volume are kept up to date.
     """
 
     DEFAULT_LIST_COUNT = 100
     MAX_LIST_COUNT = 1000
 
+    CACHE_SIZE = 256
+    CACHE_TTL = 10  # seconds
+
+    cache = TTLCache(size=CACHE_SIZE, ttl=CACHE_TTL)
+
     VALID_FILTERS = ('id', 'path', 'since', 'count', 'category', 'alive',
                      'aired', 'serve_path')
     MODIFY_TRIGGERS = ('path', 'size', 'category', 'expiration',
@@ -43,6 +66,17 @@ class ContentManager(object):
     def __init__(self, config, db):
         self.root_path = os.path.abspath(config['registry.root_path'])
         self.db = db
+        self.deduplicate = config.get('storage.deduplicate', False)
+        self.volumes = Volumes.from_config(config, db)
+        self.blobs = BlobStore(config, db, self.volumes)
+
+    @classmethod
+    def configure(cls, config):
+        """
+        Replaces the listing cache with one sized according to ``config``
+        """
+        cls.cache = TTLCache(size=config['registry.list_cache_size'],
+                             ttl=config['registry.list_cache_ttl'])
 
     def exists(self, **kwargs):
         """
@@ -68,21 +102,85 @@ class ContentManager(object):
 
     def list_files(self, **kwargs):
         """
-        Returns a list of files which satisfy the conditions specified.
-        The list may be truncated to specific length if the number of files
-        are too large
+        Returns an iterator over files which satisfy the conditions
+        specified. Files are fetched from the database in batches as the
+        iterator is consumed. The number of files may be limited to a
+        specific count if the number of files is too large.
+
+        Listings limited by count are served from the listing cache when
+        possible. Cached files are shared, and should not be modified.
+        """
+        filters = self.get_list_filters(**kwargs)
+        return self._cached_listing('files', filters, lambda: itertools.imap(
+            self._process_entry, iter_content(self.db, **filters)))
+
+    def list_rows(self, **kwargs):
+        """
+        Returns the same files as `list_files`, as an iterator over batches
+        of rows of raw column values suitable for `serializer.RowSerializer`
+        """
+        filters = self.get_list_filters(**kwargs)
+        return self._cached_listing('rows', filters, lambda: iter_content_rows(
+            self.db, **filters))
+
+    def reconcile_rows(self, summary, **kwargs):
+        """
+        Returns an iterator over batches of raw rows of files which satisfy
+        the conditions specified, like `list_rows`, but only includes files
+        whose id and modification time are not in `summary`. The number of
+        files is not limited.
+        """
+        filters = self.validate_list_filters(kwargs)
+        filters.pop('count', None)
+        return iter_differences(iter_content_rows(self.db, **filters),
+                                summary)
+
+    def listing_key(self, filters, kind='files'):
+        """
+        Returns a hashable key identifying the listing of ``kind`` produced
+        by the validated ``filters`` in the current catalog generation, or
+        None if such listings should not be cached.
+        """
+        # Listings which are not limited in size are not cached
+        if 'count' not in filters:
+            return None
+        filters = tuple(sorted((key, unicode(value))
+                               for key, value in filters.items()))
+        return (kind, filters, self.generation())
+
+    def _cached_listing(self, kind, filters, fetch):
+        if not self.cache.size:
+            return fetch()
+        key = self.listing_key(filters, kind)
+        if key is None:
+            return fetch()
+        items = self.cache.get(key)
+        if items is None:
+            items = list(fetch())
+            self.cache.set(key, items)
+        return iter(items)
+
+    def get_list_filters(self, **kwargs):
+        """
+        Returns the filters applied when listing files with the conditions
+        specified
         """
         filters = self.default_filters()
         filters.update(kwargs or {})
-        filters = self.validate_list_filters(filters)
-        return map(self._process_entry,
-                   get_content(self.db, **filters))
+        return self.validate_list_filters(filters)
+
+    def generation(self):
+        """
+        Returns a value which changes whenever the catalog changes
+        """
+        return Generation.get(self.db)
 
-    def add_file(self, client, path, params):
+    def add_file(self, client_name, path, params):
         """
-        Adds a new file entry. A `ContentException` is raised if the entry
-        conflicts with an existing entry or if `params` do not contain valid
-        data. On successful addition, the new file entry is returned.
+        Adds a new file entry on behalf of the client named `client_name`. A
+        `ContentException` is raised if the entry conflicts with an existing
+        entry or if `params` do not contain valid data. On successful
+        addition, the new file entry is returned.
         """
         serve_path = params['serve_path']
         if self.exists(serve_path=serve_path):
@@ -90,11 +188,11 @@ class ContentManager(object):
             raise ContentException(msg)
         self._validate_params(params)
         id = self._add_file(path, params)
-        self.record_action(file_id=id, client_name=client['name'],
+        self.record_action(file_id=id, client_name=client_name,
                            action='add')
         return self.get_file(id=id)
 
-    def update_file(self, client, id, params):
+    def update_file(self, client_name, id, params):
         """
         Updates a file entry with the specified `id`. A `ContentException` is
         raised if the entry conflicts with an existing entry or no entry with
@@ -108,11 +206,11 @@ class ContentManager(object):
         self._update_file(id, params)
         action_params = ', '.join(params.keys())
         self.record_action(
-            file_id=id, client_name=client['name'], action='update',
+            file_id=id, client_name=client_name, action='update',
             action_params=action_params)
         return self.get_file(id=id)
 
-    def delete_file(self, client, id):
+    def delete_file(self, client_name, id):
         """
         Deactivates a file entry with the specified `id`. A `ContentException`
         is raised if no such entry exists. On successful deactivation, the
@@ -123,7 +221,7 @@ class ContentManager(object):
             raise ContentException(msg)
         self._delete_file(id)
         self.record_action(
-            file_id=id, client_name=client['name'], action='delete')
+            file_id=id, client_name=client_name, action='delete')
 
     def _process_entry(self, data):
         data['alive'] = bool(data['alive'])
@@ -143,7 +241,7 @@ class ContentManager(object):
                 pass
         # Ensure we return a maximum of `MAX_LIST_COUNT` entries
         if 'count' in filters:
-            filters['count'] = min(filters['count'], self.MAX_LIST_COUNT)
+            filters['count'] = min(int(filters['count']), self.MAX_LIST_COUNT)
         # Ensure serve_path is a valid regex
         if 'serve_path' in filters:
             try:
@@ -161,9 +259,20 @@ class ContentManager(object):
         data['alive'] = True
         data['uploaded'] = data['modified'] = time.time()
         data['size'] = os.path.getsize(path)
+        if self.deduplicate:
+            data['checksum'], data['path'] = self.blobs.store(
+                path, data.get('checksum'))
         logging.info('Adding new file {} with data: {}'.format(
             path, pprint.pformat(data)))
-        return add_content(self.db, data)
+        try:
+            id = add_content(self.db, data)
+        except Exception:
+            if self.deduplicate:
+                self.blobs.release(data['path'])
+            raise
+        MerkleTree(self.db).update([id])
+        self.volumes.record(data['path'], data['size'])
+        return id
 
     def _validate_params(self, params):
         if 'path' in params:
@@ -172,9 +281,9 @@ class ContentManager(object):
     def _validate_path(self, path):
         if not path:
             raise ContentException('Invalid path {}'.format(path))
-        if not path.startswith(self.root_path):
+        if self.volumes.locate(path) is None:
             msg = ' {} does not fall under {} hierarchy.'.format(
-                path, self.root_path)
+                path, ', '.join(volume.root for volume in self.volumes))
             raise ContentException(msg)
         if not os.path.isfile(path):
             msg = 'No file at path {}'.format(path)
@@ -182,9 +291,17 @@ class ContentManager(object):
 
     def _update_file(self, id, data):
         data['id'] = id
+        previous = None
+        if 'path' in data or 'alive' in data:
+            previous = self.get_file(id=id)
         if 'path' in data:
             path = data.get('path')
             data['size'] = os.path.getsize(path)
+            if path != previous['path'] and self.deduplicate:
+                data['checksum'], data['path'] = self.blobs.store(path)
+            elif path != previous['path']:
+                # The checksum of the previous file does not apply
+                data['checksum'] = None
         for key in self.MODIFY_TRIGGERS:
             if key in data:
                 data['modified'] = time.time()
@@ -192,14 +309,30 @@ class ContentManager(object):
         logging.info('Updating file with id {} with data: \n{}'.format(
             id, pprint.pformat(data)))
         update_content(self.db, data)
+        MerkleTree(self.db).update([id])
+        if previous:
+            # Entries which point to another file or are no longer alive
+            # release their blob like deleted ones
+            current = self.get_file(id=id)
+            if current['path'] != previous['path']:
+                self.blobs.release(previous['path'])
+            if not current['alive']:
+                self.blobs.release(current['path'])
+            self.volumes.record(previous['path'], -previous['size'], -1)
+            if current['alive']:
+                self.volumes.record(current['path'], current['size'])
 
     def _delete_file(self, id):
+        entry = self.get_file(id=id)
         data = {}
         data['id'] = id
         data['alive'] = False
         data['modified'] = time.time()
         logging.info('Setting file with id {} to dead'.format(id))
         update_content(self.db, data)
+        MerkleTree(self.db).update([id])
+        self.blobs.release(entry['path'])
+        self.volumes.record(entry['path'], -entry['size'], -1)
 
     def record_action(self, file_id, client_name, action, action_params='',
                       timestamp=None):
@@ -208,6 +341,24 @@ class ContentManager(object):
         records.add_action(
             file_id, client_name, action, action_params, timestamp)
 
+    def get_changes(self, after, count):
+        """
+        Returns the id of the last recorded action, the actions recorded
+        after the action with id `after`, at most `count` of them, and the
+        current rows of raw column values of the files they affected, which
+        other registries use to replicate this one.
+        """
+        records = ActionRecords(self.db)
+        actions = records.get_changes(after, count)
+        last = records.last_change()
+        ids = sorted(set(action[1] for action in actions))
+        rows = []
+        for start in range(0, len(ids), self.MAX_LIST_COUNT // 2):
+            chunk = ids[start:start + self.MAX_LIST_COUNT // 2]
+            for batch in iter_content_rows(self.db, ids=chunk):
+                rows.extend(batch)
+        return last, actions, rows
+
     def validate_filters(self, filters):
         for key in filters.keys():
             if key not in self.VALID_FILTERS:
@@ -232,9 +383,16 @@ class ActionRecords(object):
         self.db = db
 
     def get_actions(self, file_id):
+        return list(self.iter_actions(file_id))
+
+    def iter_actions(self, file_id):
+        """
+        Returns an iterator over actions on the file with id `file_id`, which
+        are fetched from the database in batches as the iterator is consumed
+        """
         query = self.db.Select('*', sets=self.TABLE, where='file_id = ?')
-        self.db.execute(query, (file_id,))
-        return [row_to_dict(row) for row in self.db.results]
+        return itertools.imap(row_to_dict,
+                              iter_results(self.db, query, (file_id,)))
 
     def add_action(self, file_id, client_name, action, action_params,
                    timestamp):
@@ -248,6 +406,28 @@ class ActionRecords(object):
         query = self.db.Insert(self.TABLE, cols=action_data.keys())
         self.db.execute(query, action_data)
 
+    def get_changes(self, after, count):
+        """
+        Returns a list of at most `count` actions recorded after the action
+        with id `after`, ordered by id. Each action is a tuple of its id,
+        file id, client name, action, action parameters and timestamp.
+        """
+        # A negative limit means no limit at all
+        count = max(1, min(count, ContentManager.MAX_LIST_COUNT))
+        query = self.db.Select(
+            ['id', 'file_id', 'client_name', 'action', 'action_params',
+             'CAST(timestamp AS REAL)'],
+            sets=self.TABLE, where='id > ?', order='id', limit=count)
+        self.db.query(query, after)
+        return [tuple(row) for row in self.db.results]
+
+    def last_change(self):
+        """
+        Returns the id of the last recorded action, or 0 if there is none
+        """
+        self.db.query('SELECT MAX(id) FROM {};'.format(self.TABLE))
+        return self.db.result[0] or 0
+
     def clear_actions(self, file_id):
         query = self.db.Delete(self.TABLE, where='file_id = ?')
         self.db.execute(query, (file_id,))
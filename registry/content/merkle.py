@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+merkle.py: Merkle tree over content entries for anti-entropy between replicas
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import struct
+import sqlite3
+import hashlib
+import logging
+import binascii
+
+from .content import (LIST_COLS, RAW_LIST_COLS, Generation, allocate_id,
+                      iter_content_rows, query_results, replace_content)
+from .snapshot import encode_record, iter_rows
+
+
+# Number of children of each node
+FANOUT = 16
+
+# Number of leaves, among which entries are spread by the hash of their serve
+# path
+BUCKETS = FANOUT ** 3
+
+# Maximum number of ids looked up in a single query
+ID_LOOKUP_SIZE = 500
+
+CHILD_INDEX = struct.Struct(str('>B'))
+
+ID_INDEX = LIST_COLS.index('id')
+PATH_INDEX = LIST_COLS.index('path')
+MODIFIED_INDEX = LIST_COLS.index('modified')
+SERVE_PATH_INDEX = LIST_COLS.index('serve_path')
+ALIVE_INDEX = LIST_COLS.index('alive')
+
+# Maximum number of buckets whose entries are fetched in a single query or
+# request, and of nodes whose children are requested at once
+LOOKUP_SIZE = 64
+MAX_NODES = 256
+
+
+def bucket_of(serve_path):
+    """
+    Returns the leaf holding entries with ``serve_path``. Ids are allocated
+    by each registry on its own, so entries are placed by their serve path,
+    which is the same in all registries.
+    """
+    digest = hashlib.sha1(serve_path.encode('utf8')).digest()
+    return struct.unpack(str('>I'), digest[:4])[0] % BUCKETS
+
+
+def version_key(row):
+    """
+    Returns the key by which versions of an entry with values of `LIST_COLS`
+    in ``row`` are ordered, with the most recent version last. Ties are
+    broken by a digest of the content, so that replicas agree on the order.
+    Ids and paths are local to each registry, so they are left out.
+    """
+    return (row[MODIFIED_INDEX],
+            hashlib.sha1(encode_record(localize(row, 0, None))).digest())
+
+
+def latest_versions(rows):
+    """
+    Returns a dict which maps serve paths to the most recent of ``rows``
+    with that serve path
+    """
+    latest = {}
+    for row in rows:
+        current = latest.get(row[SERVE_PATH_INDEX])
+        if current is None or is_newer(row, current):
+            latest[row[SERVE_PATH_INDEX]] = row
+    return latest
+
+
+def hash_leaf(digests):
+    return hashlib.sha1(b''.join(sorted(digests))).digest()
+
+
+def hash_rows(rows):
+    """
+    Returns the hash of a leaf holding ``rows`` with values of `LIST_COLS`.
+    Only the most recent version of each serve path is hashed, as older
+    versions may be missing from registries which never had them.
+    """
+    return hash_leaf(version_key(row)[1]
+                     for row in latest_versions(rows).values())
+
+
+def hash_children(children):
+    """
+    Returns the hash of a node whose non-empty children are given as a dict
+    which maps child indices to hashes
+    """
+    return hashlib.sha1(b''.join(
+        CHILD_INDEX.pack(index % FANOUT) + children[index]
+        for index in sorted(children))).digest()
+
+
+def to_hex(hashes):
+    return dict((index, binascii.hexlify(value).decode('ascii'))
+                for index, value in hashes.items())
+
+
+def localize(row, id, path):
+    """
+    Returns a copy of ``row`` with values of `LIST_COLS` with the id and path
+    replaced by ``id`` and ``path``
+    """
+    row = list(row)
+    row[ID_INDEX] = id
+    row[PATH_INDEX] = path
+    return tuple(row)
+
+
+def is_newer(row, other):
+    """
+    Whether ``row`` supersedes ``other``, another version of the same entry,
+    in the order of `version_key`
+    """
+    return version_key(row) > version_key(other)
+
+
+def reroot(root_path, serve_path):
+    """
+    Returns the path under ``root_path`` where the file of an entry with
+    ``serve_path`` copied from another registry is expected, or None if
+    ``serve_path`` points outside of it
+    """
+    path = os.path.normpath(os.path.join(root_path, serve_path))
+    if not path.startswith(root_path + os.sep):
+        return None
+    return path
+
+
+class MerkleTree(object):
+    """
+    Merkle tree over the entries of the content table in ``db``.
+
+    Entries are spread over `BUCKETS` leaves by the hash of their serve path,
+    and the leaf of each entry is kept in the merkle_entries table, so that
+    leaves can be looked up by id and entries by leaf. Leaf hashes are stored
+    in the merkle table. They are recomputed whenever entries are written
+    through `ContentManager`, so the tree is kept up to date without
+    rescanning the whole table. Nodes above the leaves have
+    `FANOUT` children, and are computed from the leaves when needed. Empty
+    nodes have no hash.
+
+    Nodes are identified by their level, with leaves at level 0, and their
+    index within the level. The node at level ``l`` with index ``i`` covers
+    buckets ``i * FANOUT ** l`` to ``(i + 1) * FANOUT ** l - 1``.
+    """
+
+    # Levels computed for the last seen catalog generation of each database,
+    # shared by all trees in the process
+    cached = {}
+
+    def __init__(self, db):
+        self.db = db
+
+    def update(self, ids):
+        """
+        Recomputes the leaves which hold entries with ``ids``
+        """
+        # Writes are serialized, so that hashes computed from an older state
+        # of the bucket do not overwrite newer ones
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            self.refresh(ids)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def refresh(self, ids):
+        """
+        Same as `update`, but runs within the transaction of the caller
+        """
+        ids = sorted(set(int(id) for id in ids))
+        buckets = set()
+        for start in range(0, len(ids), ID_LOOKUP_SIZE):
+            chunk = ids[start:start + ID_LOOKUP_SIZE]
+            # Entries whose serve path changed leave their previous leaf
+            self.db.query('SELECT bucket FROM merkle_entries WHERE id IN '
+                          '({});'.format(', '.join('?' * len(chunk))), *chunk)
+            buckets.update(row[0] for row in self.db.results)
+            self.db.execute('DELETE FROM merkle_entries WHERE id IN '
+                            '({});'.format(', '.join('?' * len(chunk))),
+                            tuple(chunk))
+            placed = []
+            for rows in iter_content_rows(self.db, ids=chunk):
+                placed.extend((row[ID_INDEX], bucket_of(row[SERVE_PATH_INDEX]))
+                              for row in rows)
+            self.db.executemany('INSERT INTO merkle_entries (id, bucket) '
+                                'VALUES (?, ?);', placed)
+            buckets.update(bucket for _, bucket in placed)
+        for bucket, rows in self.iter_buckets(sorted(buckets)):
+            self.store(bucket, rows)
+
+    def rebuild(self):
+        """
+        Recomputes all leaves from the content table
+        """
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            self.db.execute('DELETE FROM merkle;')
+            self.db.execute('DELETE FROM merkle_entries;')
+            # Only the key of the latest version of each serve path is kept
+            # in memory
+            leaves = {}
+            for batch in iter_rows(self.db):
+                placed = []
+                for row in batch:
+                    bucket = bucket_of(row[SERVE_PATH_INDEX])
+                    placed.append((row[ID_INDEX], bucket))
+                    latest = leaves.setdefault(bucket, {})
+                    key = version_key(row)
+                    serve_path = row[SERVE_PATH_INDEX]
+                    if serve_path not in latest or key > latest[serve_path]:
+                        latest[serve_path] = key
+                self.db.executemany('INSERT INTO merkle_entries (id, bucket) '
+                                    'VALUES (?, ?);', placed)
+            self.db.executemany(
+                'INSERT INTO merkle (bucket, hash) VALUES (?, ?);',
+                [(bucket, sqlite3.Binary(hash_leaf(
+                    key[1] for key in latest.values())))
+                 for bucket, latest in leaves.items()])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        Generation.bump()
+
+    def is_empty(self):
+        self.db.query('SELECT 1 FROM merkle LIMIT 1;')
+        return self.db.result is None
+
+    def store(self, bucket, rows):
+        if rows:
+            self.db.execute('INSERT OR REPLACE INTO merkle (bucket, hash) '
+                            'VALUES (?, ?);',
+                            (bucket, sqlite3.Binary(hash_rows(rows))))
+        else:
+            self.db.execute('DELETE FROM merkle WHERE bucket = ?;', (bucket,))
+
+    def iter_buckets(self, buckets):
+        """
+        Returns an iterator over ``(bucket, rows)`` pairs for each of
+        ``buckets``, where ``rows`` are the entries in the bucket
+        """
+        for start in range(0, len(buckets), LOOKUP_SIZE):
+            chunk = buckets[start:start + LOOKUP_SIZE]
+            found = dict((bucket, []) for bucket in chunk)
+            self.db.query('SELECT id FROM merkle_entries WHERE bucket IN '
+                          '({});'.format(', '.join('?' * len(chunk))), *chunk)
+            ids = sorted(row[0] for row in self.db.results)
+            for id_start in range(0, len(ids), ID_LOOKUP_SIZE):
+                for rows in iter_content_rows(
+                        self.db, ids=ids[id_start:id_start + ID_LOOKUP_SIZE]):
+                    for row in rows:
+                        bucket = bucket_of(row[SERVE_PATH_INDEX])
+                        if bucket in found:
+                            found[bucket].append(tuple(row))
+            for bucket in chunk:
+                yield bucket, found[bucket]
+
+    def levels(self):
+        """
+        Returns a list of dicts mapping node indices to hashes, one for each
+        level from the leaves up to the root
+        """
+        generation = Generation.get(self.db)
+        cached_generation, levels = self.cached.get(self.db.conn.path,
+                                                    (None, None))
+        if cached_generation == generation:
+            return levels
+        self.db.query('SELECT bucket, hash FROM merkle;')
+        level = dict((row[0], bytes(row[1])) for row in self.db.results)
+        levels = [level]
+        while len(level) > 1 or any(level):
+            parents = {}
+            for index in level:
+                parents.setdefault(index // FANOUT, {})[index] = level[index]
+            level = dict((index, hash_children(children))
+                         for index, children in parents.items())
+            levels.append(level)
+        self.cached[self.db.conn.path] = (generation, levels)
+        return levels
+
+    def get_level(self, level):
+        levels = self.levels()
+        if level < len(levels):
+            return levels[level]
+        # Above the root, each level holds a single node whose only child is
+        # the node below it
+        hashes = levels[-1]
+        for _ in range(len(levels) - 1, level):
+            hashes = dict((0, hash_children(hashes)) for _ in hashes)
+        return hashes
+
+    def root(self):
+        """
+        Returns the level and hex encoded hash of the root node, or None as
+        the hash if the tree is empty
+        """
+        levels = self.levels()
+        depth = len(levels) - 1
+        return depth, to_hex(levels[-1]).get(0)
+
+    def children(self, level, indices):
+        """
+        Returns a dict which maps each of ``indices`` to a dict of the hex
+        encoded hashes of the non-empty children of the node with that index
+        at ``level``
+        """
+        if level < 1:
+            raise ValueError('Leaves have no children')
+        hashes = self.get_level(level - 1)
+        result = {}
+        for index in indices:
+            first = index * FANOUT
+            result[index] = to_hex(dict(
+                (child, hashes[child])
+                for child in range(first, first + FANOUT) if child in hashes))
+        return result
+
+    def rows(self, buckets):
+        """
+        Returns an iterator over batches of raw rows of all entries, alive or
+        not, in ``buckets``. All entries of a bucket are in the same batch.
+        """
+        for start in range(0, len(buckets), LOOKUP_SIZE):
+            yield [row for _, rows in self.iter_buckets(
+                       buckets[start:start + LOOKUP_SIZE]) for row in rows]
+
+
+def diff_buckets(tree, peer):
+    """
+    Returns the buckets in which the entries of ``tree`` differ from those of
+    ``peer``, which provides the same `root`, `children` and `rows` methods
+    as `MerkleTree`. Only nodes whose hashes differ are descended into, one
+    level per request.
+    """
+    local_depth, local_hash = tree.root()
+    peer_depth, peer_hash = peer.root()
+    if local_depth == peer_depth and local_hash == peer_hash:
+        return []
+    level = max(local_depth, peer_depth)
+    pending = [0]
+    while level > 0 and pending:
+        local = tree.children(level, pending)
+        remote = peer.children(level, pending)
+        pending = []
+        for index in sorted(local):
+            ours = local[index]
+            theirs = remote.get(index, {})
+            pending.extend(child for child in sorted(set(ours) | set(theirs))
+                           if ours.get(child) != theirs.get(child))
+        level -= 1
+    return pending
+
+
+def sync(tree, peer, root_path):
+    """
+    Updates the entries of ``tree`` with the entries of ``peer`` in buckets
+    where they differ. Entries missing locally are added, and entries which
+    exist on both sides are replaced if the peer's version is newer. Entries
+    missing from the peer are kept, so that replicas which sync with each
+    other converge. Returns the ids of the updated entries.
+
+    Ids are allocated by each registry on its own, so different files may
+    have the same id on both sides. Entries are therefore matched by their
+    serve path, which identifies a file across registries, and keep their
+    local ids and paths. Entries missing locally keep the peer's id unless it
+    is taken, and their path is the serve path under ``root_path``. Files are
+    not copied, so they are expected to be put there by other means.
+    """
+    buckets = diff_buckets(tree, peer)
+    if not buckets:
+        return []
+    root_path = os.path.abspath(root_path)
+    source = getattr(peer, 'name', '')
+    updated = []
+    for rows in peer.rows(buckets):
+        # Older versions of an entry are superseded on both sides
+        rows = latest_versions(rows).values()
+        updated.extend(merge_rows(tree, rows, source, root_path))
+    logging.info('{} entries in {} buckets updated from peer'.format(
+        len(updated), len(buckets)))
+    return updated
+
+
+def merge_rows(tree, rows, source, root_path):
+    """
+    Writes the peer's ``rows`` which are newer than or missing from the
+    entries of ``tree``, and returns the local ids of the written entries
+    """
+    db = tree.db
+    # Matching entries and allocating ids must not race with other writers
+    db.execute('BEGIN IMMEDIATE;')
+    try:
+        updated = []
+        for row in rows:
+            row = reconcile_row(db, row, root_path)
+            if row is None:
+                continue
+            # Written one at a time, so that the following rows are matched
+            # against it
+            apply_rows(db, [row], source)
+            updated.append(row[ID_INDEX])
+        tree.refresh(updated)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return updated
+
+
+def reconcile_row(db, row, root_path):
+    """
+    Returns the row to write locally for the peer's ``row``, with the local
+    id and path, or None if the local entry is up to date or the row is
+    rejected
+    """
+    local = match_entry(db, row)
+    if local is not None:
+        if not is_newer(row, local):
+            return None
+        return localize(row, local[ID_INDEX], local[PATH_INDEX])
+    path = reroot(root_path, row[SERVE_PATH_INDEX])
+    if path is None:
+        logging.warning('Entry {} with serve path {} outside of {} '
+                        'rejected'.format(row[ID_INDEX], row[SERVE_PATH_INDEX],
+                                          root_path))
+        return None
+    id = row[ID_INDEX]
+    if any(iter_content_rows(db, id=id)):
+        id = allocate_id(db)
+    return localize(row, id, path)
+
+
+def match_entry(db, row):
+    """
+    Returns the raw row of the local entry which is another version of the
+    peer's ``row``, or None if there is none. Entries with the same serve
+    path match, and the most recent of them is returned, as it is the one
+    hashed into the tree.
+    """
+    query = db.Select(sets='content', what=RAW_LIST_COLS,
+                      where='serve_path = ?')
+    candidates = list(query_results(db, query, [row[SERVE_PATH_INDEX]]))
+    if not candidates:
+        return None
+    return max(candidates, key=version_key)
+
+
+def apply_rows(db, rows, source):
+    """
+    Writes ``rows`` with values of `LIST_COLS` to the content table, replacing
+    entries with the same ids, and records a sync action from ``source`` for
+    each of them
+    """
+    replace_content(db, rows)
+    now = time.time()
+    db.executemany('INSERT INTO history (file_id, client_name, action, '
+                   'action_params, timestamp) VALUES (?, ?, ?, ?, ?);',
+                   [(row[0], source, 'sync', '', now) for row in rows])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+reconcile.py: summaries of receiver catalogs used for reconciliation
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import math
+import struct
+import hashlib
+
+
+# Indices of the id and modification time in rows of `LIST_COLS` values
+ID_INDEX = 0
+MODIFIED_INDEX = 4
+
+DIGEST_SIZE = 8
+HALVES = struct.Struct(str('>QQ'))
+
+# Limits on summaries sent by receivers
+MAX_HASHES = 32
+MAX_SUMMARY_SIZE = 16 * 1024 * 1024  # bytes
+
+
+def entry_key(id, modified):
+    """
+    Returns the key identifying a version of a content entry, made of its id
+    and modification time in whole milliseconds
+    """
+    return '{}:{}'.format(id, int(round(modified * 1000))).encode('ascii')
+
+
+def row_key(row):
+    return entry_key(row[ID_INDEX], row[MODIFIED_INDEX])
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over entry keys, stored in the bytes ``bits`` and probed
+    at ``hashes`` positions per key.
+
+    Positions are derived from the SHA1 digest of a key: with ``h1`` and
+    ``h2`` being the first and second 8 bytes of the digest read as
+    big-endian integers, the i-th position is ``(h1 + i * h2) % m``, where
+    ``m`` is the number of bits. Bit ``n`` is the bit with value
+    ``1 << (n % 8)`` in byte ``n // 8``.
+    """
+
+    def __init__(self, bits, hashes):
+        if not bits:
+            raise ValueError('Bloom filter is empty')
+        if not 0 < hashes <= MAX_HASHES:
+            raise ValueError('Number of hashes must be between 1 and {}'.format(
+                MAX_HASHES))
+        self.bits = bytearray(bits)
+        self.size = len(self.bits) * 8
+        self.hashes = hashes
+
+    @classmethod
+    def create(cls, capacity, error_rate=0.01):
+        """
+        Returns an empty filter sized for ``capacity`` keys with a false
+        positive rate of ``error_rate``
+        """
+        size = -capacity * math.log(error_rate) / math.log(2) ** 2
+        size = max(int(math.ceil(size / 8)), 1)
+        hashes = int(round(size * 8.0 / max(capacity, 1) * math.log(2)))
+        return cls(bytes(bytearray(size)), min(max(hashes, 1), MAX_HASHES))
+
+    def positions(self, key):
+        h1, h2 = HALVES.unpack_from(hashlib.sha1(key).digest())
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def to_bytes(self):
+        return bytes(self.bits)
+
+
+class DigestSet(object):
+    """
+    Exact set of entry keys, given as the concatenation of the first 8 bytes
+    of the SHA1 digest of each key
+    """
+
+    def __init__(self, data):
+        if len(data) % DIGEST_SIZE:
+            raise ValueError('Digests must be {} bytes long'.format(
+                DIGEST_SIZE))
+        self.digests = set(data[i:i + DIGEST_SIZE]
+                           for i in range(0, len(data), DIGEST_SIZE))
+
+    @staticmethod
+    def digest(key):
+        return hashlib.sha1(key).digest()[:DIGEST_SIZE]
+
+    def add(self, key):
+        self.digests.add(self.digest(key))
+
+    def __contains__(self, key):
+        return self.digest(key) in self.digests
+
+    def to_bytes(self):
+        return b''.join(self.digests)
+
+
+def iter_differences(batches, summary):
+    """
+    Returns an iterator over batches of the rows from ``batches`` which are
+    not in ``summary``. Batches left without rows are skipped.
+    """
+    for rows in batches:
+        rows = [row for row in rows if row_key(row) not in summary]
+        if rows:
+            yield rows
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+replication.py: read-only replicas following a primary registry
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import time
+import logging
+
+from .content import LIST_COLS, Generation, replace_content
+from .merkle import MerkleTree, diff_buckets
+
+
+# Number of snapshot records written at once while bootstrapping
+BOOTSTRAP_BATCH = 1000
+
+
+class Follower(object):
+    """
+    Keeps the catalog in ``db`` a copy of the catalog of the registry which
+    ``client`` talks to, the primary.
+
+    The follower tails the primary's history table, which serves as the
+    change log. Each poll fetches the actions recorded since the last applied
+    one, along with the current rows of the entries they touched, in batches
+    of ``batch_size`` actions, and applies each batch in a transaction. The
+    actions are copied to the local history table with their ids, so the
+    replica can serve snapshots and be followed in turn. A replica which has
+    never followed the primary is first bootstrapped from its snapshot, or
+    from its Merkle tree, so that ``client`` must also provide the methods of
+    `client.RegistryClient` used by `merkle.sync`.
+    """
+
+    def __init__(self, db, client, batch_size=500):
+        self.db = db
+        self.client = client
+        self.batch_size = batch_size
+        self.tree = MerkleTree(db)
+        self.applied = 0
+        self.last = None
+        self.caught_up = None
+
+    @classmethod
+    def from_config(cls, db, client, config):
+        return cls(db, client, batch_size=config['replication.batch_size'])
+
+    @property
+    def position(self):
+        """
+        Id of the last action of the primary applied to the replica, or None
+        if the replica has not followed the primary yet
+        """
+        self.db.query('SELECT position FROM replication WHERE primary_url = ?;',
+                      self.client.name)
+        row = self.db.result
+        return row[0] if row else None
+
+    def lag(self):
+        """
+        Returns the number of actions not applied yet as of the last poll,
+        and the number of seconds since the replica last caught up
+        """
+        if self.last is None:
+            return None, None
+        changes = max(self.last - (self.position or 0), 0)
+        if not changes:
+            return 0, 0
+        return changes, time.time() - (self.caught_up or 0)
+
+    def poll(self):
+        """
+        Applies the actions of the primary recorded since the last poll, and
+        returns their number
+        """
+        position = self.position
+        if position is None:
+            position = self.bootstrap()
+        count = 0
+        while True:
+            data = self.client.changes(position, self.batch_size)
+            self.last = data['last']
+            actions = data['actions']
+            if actions:
+                rows = [tuple(entry[col] for col in LIST_COLS)
+                        for entry in data['results']]
+                self.apply(actions, rows)
+                position = actions[-1][0]
+                count += len(actions)
+            if position >= self.last or len(actions) < self.batch_size:
+                break
+        if position >= self.last:
+            self.caught_up = time.time()
+        self.applied += count
+        if count:
+            logging.debug('Applied {} actions from {}'.format(
+                count, self.client.name))
+        return count
+
+    def apply(self, actions, rows):
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            replace_content(self.db, rows)
+            self.db.executemany(
+                'INSERT OR REPLACE INTO history (id, file_id, '
+                'client_name, action, action_params, timestamp) '
+                'VALUES (?, ?, ?, ?, ?, ?);', [tuple(a) for a in actions])
+            self.tree.refresh(row[0] for row in rows)
+            self.set_position(actions[-1][0])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        Generation.bump()
+
+    def bootstrap(self):
+        """
+        Copies the entries of the primary, and returns the id of the last
+        action reflected in the copy. Entries are read from the primary's
+        snapshot, or from its Merkle tree if it has no snapshot.
+        """
+        reader = self.client.snapshot()
+        if reader is None:
+            # Actions recorded while the entries are copied are applied
+            # again by the next poll, which is harmless as they carry the
+            # current rows
+            position = self.client.changes(0, 1)['last']
+            buckets = diff_buckets(self.tree, self.client)
+            count = self.copy(self.client.rows(buckets), position)
+            logging.info('Bootstrapped {} entries from the catalog of '
+                         '{}'.format(count, self.client.name))
+            return position
+        try:
+            count = self.copy(self.batches(reader.records()),
+                              reader.last_action)
+        finally:
+            reader.close()
+        logging.info('Bootstrapped {} entries from snapshot version {} of '
+                     '{}'.format(count, reader.version, self.client.name))
+        return reader.last_action
+
+    @staticmethod
+    def batches(rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BOOTSTRAP_BATCH:
+                yield batch
+                batch = []
+        yield batch
+
+    def copy(self, batches, position):
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            count = 0
+            for rows in batches:
+                replace_content(self.db, rows)
+                count += len(rows)
+            self.set_position(position)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        self.tree.rebuild()
+        return count
+
+    def set_position(self, position):
+        self.db.execute('INSERT OR REPLACE INTO replication (primary_url, '
+                        'position) VALUES (?, ?);',
+                        (self.client.name, position))
@@ -15,6 +15,18 @@ from __future__ import unicode_literals
 from .api import (add_file,
                   list_files,
                   get_file,
+                  get_snapshot,
+                  reconcile,
+                  merkle_root,
+                  merkle_children,
+                  merkle_rows,
+                  get_changes,
+                  get_discrepancies,
+                  start_upload,
+                  upload_status,
+                  upload_chunk,
+                  complete_upload,
+                  cancel_upload,
                   update_file,
                   delete_file)
 
@@ -23,6 +35,24 @@ def routes(config):
     return (
         ('content:list', list_files, 'GET', '/', {}),
         ('content:add', add_file, 'POST', '/', {}),
+        ('content:snapshot', get_snapshot, 'GET', '/snapshot', {}),
+        ('content:reconcile', reconcile, 'POST', '/reconcile', {}),
+        ('content:changes', get_changes, 'GET', '/changes', {}),
+        ('content:discrepancies', get_discrepancies, 'GET',
+         '/discrepancies', {}),
+        ('content:upload', start_upload, 'POST', '/uploads', {}),
+        ('content:upload_status', upload_status, 'GET',
+         '/uploads/<upload_id>', {}),
+        ('content:upload_chunk', upload_chunk, 'PATCH',
+         '/uploads/<upload_id>', {}),
+        ('content:upload_complete', complete_upload, 'POST',
+         '/uploads/<upload_id>', {}),
+        ('content:upload_cancel', cancel_upload, 'DELETE',
+         '/uploads/<upload_id>', {}),
+        ('content:merkle', merkle_root, 'GET', '/merkle', {}),
+        ('content:merkle_rows', merkle_rows, 'GET', '/merkle/rows', {}),
+        ('content:merkle_children', merkle_children, 'GET',
+         '/merkle/<level:int>', {}),
         ('content:get', get_file, 'GET', '/<id>', {}),
         ('content:update', update_file, 'PUT', '/<id>', {}),
         ('content:delete', delete_file, 'DELETE', '/<id>', {})
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+serializer.py: JSON serialization of content rows
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import json.encoder
+
+
+encode_string = json.encoder.encode_basestring_ascii
+
+
+def encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def encode_null(value):
+    return 'null'
+
+
+# Encoders for the types of values sqlite returns. Output matches what
+# ``json.dumps`` produces for the same values.
+ENCODERS = {
+    int: str,
+    long: str,
+    float: float.__repr__,
+    bool: encode_bool,
+    type(None): encode_null,
+    bytes: encode_string,
+    type(''): encode_string,
+}
+
+
+class RowSerializer(object):
+    """
+    Encodes rows of raw column values as JSON objects with keys from
+    ``columns``. Values of ``booleans`` columns are encoded as JSON booleans.
+
+    Each row is encoded by formatting a template which is computed once from
+    the column names, so rows are never converted to dicts.
+    """
+
+    def __init__(self, columns, booleans=()):
+        self.columns = columns
+        self.booleans = [i for i, col in enumerate(columns) if col in booleans]
+        self.template = '{' + ', '.join(
+            '{}: %s'.format(encode_string(col)) for col in columns) + '}'
+
+    def encode(self, row):
+        encoders = ENCODERS
+        values = [encoders[type(value)](value) for value in row]
+        for i in self.booleans:
+            values[i] = encode_bool(row[i])
+        return self.template % tuple(values)
+
+
+def iter_listing(serializer, batches):
+    """
+    Returns an iterator over chunks of a successful listing API response
+    containing rows from ``batches``, encoding one batch per chunk
+    """
+    count = 0
+    yield '{"success": true, "results": ['
+    for rows in batches:
+        if count:
+            yield ', '
+        count += len(rows)
+        yield ', '.join(map(serializer.encode, rows))
+    yield '], "count": {}}}'.format(count)
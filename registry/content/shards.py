@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+shards.py: content table partitioned across several databases
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import zlib
+import heapq
+import logging
+import itertools
+
+from ..utils.databases import BATCH_SIZE, get_shard_names, iter_results
+from . import content
+from .content import LIST_COLS, RAW_LIST_COLS, is_sharded
+from .filters import IdFilter
+
+
+ID_INDEX = LIST_COLS.index('id')
+CATEGORY_INDEX = LIST_COLS.index('category')
+
+# Order of rows merged from several shards when the query does not specify
+# one
+DEFAULT_ORDER = 'modified, id'
+
+# Maximum number of ids in a single statement
+LOOKUP_SIZE = 500
+
+
+def decorate(rows, index, key):
+    # The shard index breaks ties, so that rows are never compared
+    for row in rows:
+        yield key(row), index, row
+
+
+def merge_batches(iterators, key, limit=None, size=BATCH_SIZE):
+    """
+    Merges ``iterators`` over rows sorted by ``key`` into an iterator over
+    batches of at most ``size`` rows in the same order, the first ``limit``
+    rows only if specified
+    """
+    merged = heapq.merge(*[decorate(rows, index, key)
+                           for index, rows in enumerate(iterators)])
+    rows = (item[2] for item in merged)
+    if limit:
+        rows = itertools.islice(rows, limit)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ShardedDatabase(object):
+    """
+    Wraps the registry database ``db`` to store content entries in the
+    content tables of the ``shards`` databases instead of its own. Each entry
+    belongs to a single shard, chosen by its id or its category depending on
+    ``key``. All other tables stay in ``db``, and all other attributes are
+    looked up on it.
+
+    Ids are allocated from the content_ids table of ``db``, so that they are
+    unique across shards. Queries on the content table are run on each shard
+    which may hold matching entries, and their results are merged in the
+    order of the query, or by modification time if it has none. Writes go to
+    the shard owning the entry.
+
+    The functions of the `content` module use the shards when passed a
+    sharded database, so code working with content entries does not need to
+    be aware of sharding.
+    """
+    KEYS = ('id', 'category')
+
+    def __init__(self, db, shards, key='id'):
+        if key not in self.KEYS:
+            raise ValueError('Invalid shard key: {}'.format(key))
+        self.db = db
+        self.shards = list(shards)
+        self.key = key
+
+    def __getattr__(self, attr):
+        return getattr(self.db, attr)
+
+    def shard_index(self, id, category=None):
+        if self.key == 'id':
+            return int(id) % len(self.shards)
+        category = (category or '').encode('utf8')
+        return (zlib.crc32(category) & 0xffffffff) % len(self.shards)
+
+    def locate(self, id):
+        """
+        Returns the shard holding the entry with ``id``, or None if there is
+        no such entry
+        """
+        if self.key == 'id':
+            return self.shards[self.shard_index(id)]
+        for shard in self.shards:
+            shard.query('SELECT 1 FROM content WHERE id = ?;', id)
+            if shard.result:
+                return shard
+        return None
+
+    def targets(self, filters):
+        """
+        Returns the shards which may hold entries matching ``filters``
+        """
+        if self.key == 'id':
+            for filt in filters:
+                if isinstance(filt, IdFilter):
+                    ids = filt.multi_val or [filt.single_val]
+                    indices = set(self.shard_index(id) for id in ids)
+                    return [self.shards[index] for index in sorted(indices)]
+        return self.shards
+
+    def iter_batches(self, query, params, order=None, filters=(),
+                     size=BATCH_SIZE):
+        """
+        Runs ``query`` on the content table of each shard which may hold
+        entries matching ``filters``, and returns an iterator over batches of
+        the merged results. Results are merged in the order of the columns
+        listed in ``order``, which must be among `LIST_COLS`, and the limit
+        of the query applies to the merged results.
+        """
+        order = order or DEFAULT_ORDER
+        query.order = order
+        indices = [LIST_COLS.index(col.strip()) for col in order.split(',')]
+
+        def key(row):
+            return tuple(row[index] for index in indices)
+
+        # Each shard query runs on a cursor of its own, and results are
+        # read from each of them as the merged rows are consumed
+        iterators = [iter_results(shard, query, params, size)
+                     for shard in self.targets(filters)]
+        return merge_batches(iterators, key, query.limit, size)
+
+    def allocate_id(self):
+        self.db.execute('INSERT INTO content_ids DEFAULT VALUES;')
+        self.db.execute('SELECT last_insert_rowid();')
+        id = self.db.result[0]
+        self.db.execute('DELETE FROM content_ids WHERE id = ?;', (id,))
+        return id
+
+    def reserve_ids(self, last_id):
+        """
+        Makes sure ids up to ``last_id`` are never allocated
+        """
+        if last_id is None:
+            return
+        # Ids are allocated with autoincrement, so a row inserted with
+        # `last_id` makes sqlite skip it and all lower ids even once deleted
+        self.db.execute('INSERT OR IGNORE INTO content_ids (id) VALUES (?);',
+                        (last_id,))
+        self.db.execute('DELETE FROM content_ids WHERE id = ?;', (last_id,))
+
+    def add_content(self, data):
+        data = dict(data, id=self.allocate_id())
+        shard = self.shards[self.shard_index(data['id'],
+                                             data.get('category'))]
+        return content.add_content(shard, data)
+
+    def update_content(self, data):
+        shard = self.locate(data['id'])
+        if shard is None:
+            return
+        if self.key == 'category' and 'category' in data:
+            target = self.shards[self.shard_index(data['id'],
+                                                  data['category'])]
+            if target is not shard:
+                self.move(shard, target, data)
+                return
+        content.update_content(shard, data)
+
+    def move(self, shard, target, data):
+        """
+        Moves the entry with the id in ``data`` from ``shard`` to ``target``,
+        updating it with ``data``
+        """
+        rows = list(itertools.chain.from_iterable(
+            content.iter_content_rows(shard, id=data['id'])))
+        entry = dict(zip(LIST_COLS, rows[0]))
+        entry.update(data)
+        content.replace_content(target, [
+            tuple(entry[col] for col in LIST_COLS)])
+        shard.execute('DELETE FROM content WHERE id = ?;', (data['id'],))
+
+    def replace_content(self, rows):
+        rows = [tuple(row) for row in rows]
+        if not rows:
+            return
+        owned = dict((index, []) for index in range(len(self.shards)))
+        for row in rows:
+            owned[self.shard_index(row[ID_INDEX],
+                                   row[CATEGORY_INDEX])].append(row)
+        for index, shard in enumerate(self.shards):
+            if self.key == 'category':
+                # Entries whose category changed are removed from the shards
+                # which held them
+                ids = set(row[ID_INDEX] for row in owned[index])
+                self.delete(shard, [row[ID_INDEX] for row in rows
+                                    if row[ID_INDEX] not in ids])
+            content.replace_content(shard, owned[index])
+        # Copied entries keep their ids, which must not be allocated again
+        self.reserve_ids(max(row[ID_INDEX] for row in rows))
+
+    @staticmethod
+    def delete(shard, ids):
+        for start in range(0, len(ids), LOOKUP_SIZE):
+            chunk = ids[start:start + LOOKUP_SIZE]
+            shard.execute('DELETE FROM content WHERE id IN ({});'.format(
+                ', '.join('?' * len(chunk))), tuple(chunk))
+
+    def distribute(self):
+        """
+        Moves entries stored in the content table of the registry database,
+        by registries created before sharding was enabled, to the shards
+        """
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            moved = 0
+            while True:
+                query = self.db.Select(sets='content', what=RAW_LIST_COLS,
+                                       order='id', limit=BATCH_SIZE)
+                self.db.query(query)
+                rows = [tuple(row) for row in self.db.results]
+                if not rows:
+                    break
+                self.replace_content(rows)
+                self.db.execute('DELETE FROM content WHERE id <= ?;',
+                                (rows[-1][ID_INDEX],))
+                moved += len(rows)
+            # Ids of entries which no longer exist are not allocated again
+            # either
+            self.db.query("SELECT seq FROM sqlite_sequence "
+                          "WHERE name = 'content';")
+            row = self.db.result
+            if row:
+                self.reserve_ids(row[0])
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        if moved:
+            logging.info('Moved {} entries to {} shards'.format(
+                moved, len(self.shards)))
+        return moved
+
+
+def connect(config, databases):
+    """
+    Returns the registry database of ``databases``, wrapped to store content
+    entries in the shards if the content table is sharded
+    """
+    names = get_shard_names(config)
+    if not names:
+        return databases.registry
+    return ShardedDatabase(databases.registry,
+                           [databases[name] for name in names],
+                           config['database.shard_key'])
+
+
+def prepare(config, databases):
+    db = connect(config, databases)
+    if is_sharded(db):
+        db.distribute()
+
+
+def pre_init(app, config):
+    databases = config['database.connections']
+    db = connect(config, databases)
+    if is_sharded(db):
+        databases['registry'] = db
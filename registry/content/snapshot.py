@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+snapshot.py: compact snapshots of the catalog
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+
+A snapshot is a gzip-compressed file holding all live content entries, so
+that receivers can bootstrap their catalog with a single download. The
+uncompressed layout is, with all integers big-endian:
+
+- header: magic ``RSNP``, format version (uint16), snapshot version (uint32),
+  id of the last history record reflected in the snapshot (uint64) and the
+  time the snapshot was taken (float64)
+- one record per entry, in id order: record length (uint32), id (uint64),
+  a bit mask of null fields (uint16) and the remaining fields of
+  ``LIST_COLS`` which are not null, where strings are length-prefixed
+  (uint16) UTF-8, integers are uint64, timestamps are float64 and booleans
+  are uint8
+- a record length of 0 marking the end of the snapshot
+"""
+
+from __future__ import unicode_literals
+
+import os
+import gzip
+import time
+import struct
+import logging
+
+import gevent
+
+from .content import LIST_COLS, RAW_LIST_COLS, build_query, query_batches
+from .filters import to_filters
+
+
+MAGIC = b'RSNP'
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct(str('>4sHIQd'))
+LENGTH = struct.Struct(str('>I'))
+RECORD_HEAD = struct.Struct(str('>QH'))
+
+STRING = 'string'
+INTEGER = 'integer'
+TIMESTAMP = 'timestamp'
+BOOLEAN = 'boolean'
+
+# Types of fields following the id, in the order of `LIST_COLS`
+FIELDS = (
+    ('path', STRING),
+    ('size', INTEGER),
+    ('uploaded', TIMESTAMP),
+    ('modified', TIMESTAMP),
+    ('category', STRING),
+    ('expiration', TIMESTAMP),
+    ('serve_path', STRING),
+    ('aired', BOOLEAN),
+    ('alive', BOOLEAN),
+    ('checksum', STRING),
+)
+assert tuple(name for name, _ in FIELDS) == LIST_COLS[1:]
+
+ALIVE_INDEX = LIST_COLS.index('alive')
+
+PACKERS = {
+    INTEGER: struct.Struct(str('>Q')),
+    TIMESTAMP: struct.Struct(str('>d')),
+    BOOLEAN: struct.Struct(str('>B')),
+}
+STRING_LENGTH = struct.Struct(str('>H'))
+
+# Number of records compressed at once, between yields to other greenlets
+CHUNK_RECORDS = 1000
+
+# Maximum number of ids looked up in a single query
+LOOKUP_SIZE = 500
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def encode_record(row):
+    """
+    Returns the length-prefixed encoding of a row with values of `LIST_COLS`
+    """
+    mask = 0
+    parts = []
+    for index, (name, kind) in enumerate(FIELDS):
+        value = row[index + 1]
+        if value is None:
+            mask |= 1 << index
+        elif kind == STRING:
+            value = value.encode('utf8')
+            parts.append(STRING_LENGTH.pack(len(value)))
+            parts.append(value)
+        else:
+            parts.append(PACKERS[kind].pack(value))
+    body = RECORD_HEAD.pack(row[0], mask) + b''.join(parts)
+    return LENGTH.pack(len(body)) + body
+
+
+def decode_record(body):
+    """
+    Returns a tuple of `LIST_COLS` values decoded from the record ``body``,
+    which excludes the length prefix
+    """
+    id, mask = RECORD_HEAD.unpack_from(body)
+    offset = RECORD_HEAD.size
+    values = [id]
+    for index, (name, kind) in enumerate(FIELDS):
+        if mask & (1 << index):
+            values.append(None)
+        elif kind == STRING:
+            length, = STRING_LENGTH.unpack_from(body, offset)
+            offset += STRING_LENGTH.size
+            values.append(body[offset:offset + length].decode('utf8'))
+            offset += length
+        else:
+            packer = PACKERS[kind]
+            value, = packer.unpack_from(body, offset)
+            offset += packer.size
+            values.append(bool(value) if kind == BOOLEAN else value)
+    return tuple(values)
+
+
+@to_filters
+def iter_rows(db, filters):
+    """
+    Returns an iterator over batches of raw rows of matching entries, like
+    `content.iter_content_rows`, ordered by id
+    """
+    query, params = build_query(db, filters, what=RAW_LIST_COLS)
+    return query_batches(db, query, params, order='id', filters=filters)
+
+
+def read_exactly(fd, size):
+    data = fd.read(size)
+    if len(data) != size:
+        raise SnapshotError('Snapshot is truncated')
+    return data
+
+
+class SnapshotReader(object):
+    """
+    Reads the snapshot in file object ``fd``. The header fields are available
+    as attributes once the reader is created, and records are read by
+    iterating over :py:meth:`records` or :py:meth:`raw_records`.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        header = read_exactly(fd, HEADER.size)
+        (magic, self.format_version, self.version, self.last_action,
+         self.timestamp) = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise SnapshotError('Not a snapshot')
+        if self.format_version != FORMAT_VERSION:
+            raise SnapshotError('Unsupported snapshot format {}'.format(
+                self.format_version))
+
+    @classmethod
+    def open(cls, path):
+        return cls(gzip.open(path, 'rb'))
+
+    def raw_records(self):
+        """
+        Returns an iterator over ``(id, record)`` pairs, where ``record`` is
+        the length-prefixed encoding of the entry
+        """
+        while True:
+            prefix = read_exactly(self.fd, LENGTH.size)
+            length, = LENGTH.unpack(prefix)
+            if not length:
+                return
+            body = read_exactly(self.fd, length)
+            id, = PACKERS[INTEGER].unpack_from(body)
+            yield id, prefix + body
+
+    def records(self):
+        """
+        Returns an iterator over tuples of `LIST_COLS` values of the entries
+        """
+        for _, record in self.raw_records():
+            yield decode_record(record[LENGTH.size:])
+
+    def close(self):
+        self.fd.close()
+
+
+class SnapshotBuilder(object):
+    """
+    Writes snapshots of the catalog in ``db`` to ``path``.
+
+    A new snapshot is built from the previous one and the history table:
+    only entries touched by actions recorded since the previous snapshot are
+    read from the database, and all other records are copied over as is.
+    Changes which bypass the history table are picked up by a full rebuild,
+    which is done after every ``full_rebuild`` incremental builds, including
+    those skipped because nothing was recorded.
+    """
+
+    def __init__(self, db, path, full_rebuild=12, level=6):
+        self.db = db
+        self.path = path
+        self.full_rebuild = full_rebuild
+        self.level = level
+        self.incremental_builds = 0
+
+    @classmethod
+    def from_config(cls, db, config):
+        return cls(db, config['snapshot.path'],
+                   full_rebuild=config['snapshot.full_rebuild'])
+
+    def build(self):
+        """
+        Writes a new snapshot if the catalog has changed since the previous
+        one, and returns its version, or None if no snapshot was written
+        """
+        timestamp = time.time()
+        last_action = self.get_last_action()
+        previous = self.open_previous()
+        try:
+            if previous and self.incremental_builds < self.full_rebuild:
+                self.incremental_builds += 1
+                if previous.last_action == last_action:
+                    return None
+                records = self.merge(previous.raw_records(),
+                                     self.changed_records(previous))
+            else:
+                records = self.all_records()
+                self.incremental_builds = 0
+            version = previous.version + 1 if previous else 1
+            self.write(records, version, last_action, timestamp)
+        except Exception:
+            # Start over from the database on the next build
+            self.incremental_builds = self.full_rebuild
+            raise
+        finally:
+            if previous:
+                previous.close()
+        logging.info('Catalog snapshot version {} written to {}'.format(
+            version, self.path))
+        return version
+
+    def get_last_action(self):
+        self.db.query('SELECT MAX(id) FROM history;')
+        return self.db.result[0] or 0
+
+    def open_previous(self):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            return SnapshotReader.open(self.path)
+        except (IOError, SnapshotError) as exc:
+            logging.warning('Ignoring previous snapshot {}: {}'.format(
+                self.path, exc))
+            return None
+
+    def all_records(self):
+        for batch in iter_rows(self.db, alive=True):
+            for row in batch:
+                yield row[0], encode_record(row)
+
+    def changed_records(self, previous):
+        """
+        Returns a list of ``(id, record)`` pairs of entries touched since
+        ``previous`` was built, ordered by id, where ``record`` is None for
+        entries which are no longer alive
+        """
+        self.db.query('SELECT DISTINCT file_id FROM history WHERE id > ?;',
+                      previous.last_action)
+        ids = sorted(row[0] for row in self.db.results)
+        changed = dict.fromkeys(ids)
+        for start in range(0, len(ids), LOOKUP_SIZE):
+            chunk = ids[start:start + LOOKUP_SIZE]
+            for batch in iter_rows(self.db, ids=chunk):
+                for row in batch:
+                    if row[ALIVE_INDEX]:
+                        changed[row[0]] = encode_record(row)
+        return [(id, changed[id]) for id in ids]
+
+    @staticmethod
+    def merge(records, changes):
+        """
+        Merges ``changes`` into ``records``, both of which are sequences of
+        ``(id, record)`` pairs ordered by id. Changed records replace records
+        with the same id, and are left out if they are None.
+        """
+        changes = iter(changes)
+        change = next(changes, None)
+        for id, record in records:
+            while change and change[0] < id:
+                if change[1]:
+                    yield change
+                change = next(changes, None)
+            if change and change[0] == id:
+                record = change[1]
+                change = next(changes, None)
+            if record:
+                yield id, record
+        while change:
+            if change[1]:
+                yield change
+            change = next(changes, None)
+
+    def write(self, records, version, last_action, timestamp):
+        # The snapshot is replaced atomically, so that downloads in progress
+        # continue to read the previous one
+        tmp_path = self.path + '.tmp'
+        fd = gzip.open(tmp_path, 'wb', self.level)
+        try:
+            fd.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, last_action,
+                                 timestamp))
+            # Records are written in chunks, as compressing many small
+            # writes is several times slower
+            chunk = []
+            for count, (_, record) in enumerate(records, 1):
+                chunk.append(record)
+                if not count % CHUNK_RECORDS:
+                    fd.write(b''.join(chunk))
+                    chunk = []
+                    gevent.sleep(0)
+            chunk.append(LENGTH.pack(0))
+            fd.write(b''.join(chunk))
+        except Exception:
+            fd.close()
+            os.remove(tmp_path)
+            raise
+        fd.close()
+        os.rename(tmp_path, self.path)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+tasks.py: background tasks related to content
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import socket
+import logging
+import httplib
+
+from ..client import RegistryError
+from ..utils.scheduler import background_task
+from .merkle import MerkleTree, sync
+from .uploads import UploadManager
+from .blobs import BlobStore
+from .verifier import Verifier
+
+
+@background_task(interval='snapshot.interval')
+def build_snapshot(app, config):
+    builder = config.get('snapshot.builder')
+    if builder:
+        builder.build()
+
+
+@background_task(interval='uploads.cleanup_interval')
+def cleanup_uploads(app, config):
+    db = config['database.connections'].registry
+    UploadManager(config, db).cleanup(config['uploads.expiry'])
+
+
+@background_task(interval='storage.gc_interval')
+def collect_blobs(app, config):
+    db = config['database.connections'].registry
+    BlobStore(config, db).collect(limit=config['storage.gc_batch_size'],
+                                  rate=config['storage.gc_rate'])
+
+
+@background_task(interval='verification.interval')
+def verify_files(app, config):
+    # Replicas only copy entries, so their files are usually not on local
+    # storage and would all be reported as missing
+    if not config['verification.enabled'] or config['replication.primary']:
+        return
+    db = config['database.connections'].registry
+    Verifier.from_config(db, config).run()
+
+
+@background_task(interval='sync.interval')
+def sync_peers(app, config):
+    tree = MerkleTree(config['database.connections'].registry)
+    for peer in config['sync.clients']:
+        try:
+            sync(tree, peer, config['registry.root_path'])
+        except (RegistryError, httplib.HTTPException, socket.error) as exc:
+            logging.error('Could not sync with {}: {}'.format(peer.name, exc))
+
+
+@background_task(interval='replication.interval')
+def follow_primary(app, config):
+    follower = config.get('replication.follower')
+    if not follower:
+        return
+    try:
+        follower.poll()
+    except (RegistryError, httplib.HTTPException, socket.error) as exc:
+        logging.error('Could not follow {}: {}'.format(
+            follower.client.name, exc))
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+uploads.py: files uploaded through the API in resumable chunks
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import binascii
+
+from .manager import ContentManager, ContentException
+from .volumes import Volumes
+
+
+# Fields of the entry which may be set when starting an upload, besides the
+# serve path
+ENTRY_FIELDS = ('category', 'expiration')
+
+COLUMNS = ('id', 'client_name', 'serve_path', 'params', 'size', 'volume')
+
+
+class UploadException(ContentException):
+    pass
+
+
+class OffsetMismatch(UploadException):
+    """
+    Raised when a chunk does not start where the uploaded data ends, which is
+    given by ``offset``
+    """
+
+    def __init__(self, offset):
+        super(OffsetMismatch, self).__init__(
+            'Upload is at offset {}'.format(offset))
+        self.offset = offset
+
+
+class UploadManager(object):
+    """
+    Stores files uploaded by clients on the storage volumes, and registers
+    them through `ContentManager` once complete.
+
+    Each upload is placed on a volume when it is started. Uploaded data is
+    appended to a part file in the uploads directory of the volume, which is
+    renamed to its final path under the volume root when the upload is
+    completed. Data is read from requests and written in chunks of
+    ``chunk_size`` bytes, and the checksum of the file is computed as it is
+    written. The state of the checksum is kept by the process which received
+    the previous chunk, so a chunk received by another process, or after a
+    restart, first re-reads the data already uploaded.
+
+    The amount of uploaded data is the size of the part file, so that uploads
+    interrupted at any point can be resumed from there.
+
+    When deduplication is enabled, the part file is moved to the blob store
+    instead, or removed if its data is already stored.
+    """
+
+    # Checksums of uploads in progress, with the offset they were computed
+    # up to, shared by all managers in the process
+    hashers = {}
+    # Uploads receiving data in this process
+    active = set()
+
+    def __init__(self, config, db):
+        self.config = config
+        self.db = db
+        self.root_path = os.path.abspath(config['registry.root_path'])
+        self.volumes = Volumes.from_config(config, db)
+        self.directory = config.get('uploads.directory', '.uploads')
+        self.chunk_size = config.get('uploads.chunk_size', 64 * 1024)
+        self.reserved = [self.directory,
+                         config.get('storage.directory', '.blobs')]
+
+    def create(self, client_name, params):
+        """
+        Starts an upload of a file to be registered with ``params`` on behalf
+        of the client named ``client_name``, and returns its status
+        """
+        serve_path = params.get('serve_path')
+        if not serve_path:
+            raise UploadException('`serve_path` must be specified')
+        self.destination(serve_path)
+        if self.content_manager().exists(serve_path=serve_path):
+            raise UploadException(
+                'File at serve_path {} already exists.'.format(serve_path))
+        size = params.get('size')
+        if size is not None:
+            try:
+                size = int(size)
+            except ValueError:
+                raise UploadException('`size` must be an integer')
+        fields = dict((key, params[key]) for key in ENTRY_FIELDS
+                      if key in params)
+        volume = self.volumes.choose(size)
+        if volume is None:
+            raise UploadException('No storage volume has room for the '
+                                  'upload')
+        upload = {'id': binascii.hexlify(os.urandom(16)).decode('ascii'),
+                  'volume': volume.root}
+        upload_dir = os.path.dirname(self.part_path(upload))
+        if not os.path.isdir(upload_dir):
+            os.makedirs(upload_dir)
+        open(self.part_path(upload), 'wb').close()
+        self.db.execute(
+            'INSERT INTO uploads (id, client_name, serve_path, params, size, '
+            'created, volume) VALUES (?, ?, ?, ?, ?, ?, ?);',
+            (upload['id'], client_name, serve_path, json.dumps(fields), size,
+             time.time(), volume.root))
+        return self.status(upload['id'])
+
+    def get(self, upload_id):
+        """
+        Returns the upload with ``upload_id`` as a dict, or None if there is
+        no such upload
+        """
+        self.db.query('SELECT {} FROM uploads WHERE id = ?;'.format(
+            ', '.join(COLUMNS)), upload_id)
+        row = self.db.result
+        if row is None:
+            return None
+        return self.to_dict(row)
+
+    def to_dict(self, row):
+        upload = dict(zip(COLUMNS, row))
+        # Uploads started before volumes were introduced are on the root path
+        upload['volume'] = upload['volume'] or self.root_path
+        return upload
+
+    def status(self, upload_id):
+        upload = self.get(upload_id)
+        if upload is None:
+            return None
+        return {'id': upload['id'],
+                'serve_path': upload['serve_path'],
+                'size': upload['size'],
+                'offset': self.offset(upload)}
+
+    def offset(self, upload):
+        try:
+            return os.path.getsize(self.part_path(upload))
+        except OSError:
+            raise UploadException('Upload {} has no data'.format(
+                upload['id']))
+
+    def part_path(self, upload):
+        return os.path.join(upload['volume'], self.directory,
+                            upload['id'] + '.part')
+
+    def destination(self, serve_path, root=None):
+        """
+        Returns the path under the volume ``root``, or the root path if not
+        specified, where a file uploaded with ``serve_path`` is stored
+        """
+        root = root or self.root_path
+        path = os.path.normpath(os.path.join(root, serve_path))
+        if not path.startswith(root + os.sep):
+            raise UploadException('Invalid serve_path {}'.format(serve_path))
+        for name in self.reserved:
+            reserved = os.path.join(root, name)
+            if path == reserved or path.startswith(reserved + os.sep):
+                raise UploadException('Invalid serve_path {}'.format(
+                    serve_path))
+        return path
+
+    def append(self, upload_id, offset, stream, length=None):
+        """
+        Appends data read from ``stream`` to the upload, up to ``length``
+        bytes if specified, and returns the new offset. ``offset`` must be
+        the current offset of the upload, as returned by `status`.
+        """
+        upload = self.require(upload_id)
+        if upload_id in self.active:
+            raise UploadException('Upload {} is already receiving '
+                                  'data'.format(upload_id))
+        self.active.add(upload_id)
+        try:
+            with self.volumes.busy(upload['volume']), self.lock_part(
+                    upload) as fobj:
+                # Other workers may append to the upload as well, so the
+                # offset is only checked once the part file is locked
+                current = os.fstat(fobj.fileno()).st_size
+                if offset != current:
+                    raise OffsetMismatch(current)
+                if (upload['size'] is not None and length is not None and
+                        offset + length > upload['size']):
+                    raise UploadException('Upload exceeds its size of {} '
+                                          'bytes'.format(upload['size']))
+                hasher = self.get_hasher(upload, current)
+                try:
+                    while length is None or current - offset < length:
+                        size = self.chunk_size
+                        if length is not None:
+                            size = min(size, length - (current - offset))
+                        chunk = stream.read(size)
+                        if not chunk:
+                            break
+                        if upload['size'] is not None and (
+                                current + len(chunk) > upload['size']):
+                            raise UploadException(
+                                'Upload exceeds its size of {} bytes'.format(
+                                    upload['size']))
+                        fobj.write(chunk)
+                        hasher.update(chunk)
+                        current += len(chunk)
+                finally:
+                    # Data received before an interrupted request is kept, so
+                    # that the upload can be resumed after it
+                    fobj.flush()
+                    self.hashers[upload_id] = (current, hasher)
+        finally:
+            self.active.discard(upload_id)
+        return current
+
+    def lock_part(self, upload):
+        """
+        Opens the part file of ``upload`` for appending and locks it, so that
+        a single process appends to it at a time. The lock is released when
+        the file is closed.
+        """
+        try:
+            fd = os.open(self.part_path(upload), os.O_WRONLY | os.O_APPEND)
+        except OSError:
+            raise UploadException('Upload {} has no data'.format(
+                upload['id']))
+        fobj = os.fdopen(fd, 'ab')
+        try:
+            # Waiting for the lock would block all requests of the worker
+            fcntl.flock(fobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fobj.close()
+            raise UploadException('Upload {} is already receiving '
+                                  'data'.format(upload['id']))
+        return fobj
+
+    def get_hasher(self, upload, offset):
+        cached = self.hashers.get(upload['id'])
+        if cached and cached[0] == offset:
+            return cached[1]
+        logging.debug('Computing checksum of the first {} bytes of upload '
+                      '{}'.format(offset, upload['id']))
+        hasher = hashlib.sha256()
+        with open(self.part_path(upload), 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(self.chunk_size), b''):
+                hasher.update(chunk)
+        self.hashers[upload['id']] = (offset, hasher)
+        return hasher
+
+    def complete(self, upload_id, checksum=None):
+        """
+        Moves the uploaded file to its destination and registers it, and
+        returns the new file entry. If ``checksum`` is specified, it must
+        match the checksum of the uploaded data.
+        """
+        upload = self.require(upload_id)
+        if upload_id in self.active:
+            raise UploadException('Upload {} is still receiving '
+                                  'data'.format(upload_id))
+        offset = self.offset(upload)
+        if upload['size'] is not None and offset != upload['size']:
+            raise UploadException('Upload is incomplete, {} of {} bytes '
+                                  'received'.format(offset, upload['size']))
+        digest = self.get_hasher(upload, offset).hexdigest()
+        if checksum and checksum.lower() != digest:
+            raise UploadException('Checksum mismatch, uploaded data has '
+                                  'checksum {}'.format(digest))
+        part_path = self.part_path(upload)
+        with open(part_path, 'ab') as fobj:
+            os.fsync(fobj.fileno())
+        content_mgr = self.content_manager()
+        if content_mgr.deduplicate:
+            # The part file is moved to its blob when the file is added
+            path = part_path
+        else:
+            path = self.destination(upload['serve_path'], upload['volume'])
+            if os.path.exists(path):
+                raise UploadException('File at {} already exists'.format(
+                    path))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(part_path, path)
+        params = json.loads(upload['params'])
+        params.update(path=path, serve_path=upload['serve_path'],
+                      checksum=digest)
+        try:
+            entry = content_mgr.add_file(upload['client_name'], path, params)
+        except Exception:
+            # The upload can be completed again once the conflict is solved
+            if content_mgr.deduplicate:
+                self.restore(upload, digest, content_mgr.blobs)
+            elif os.path.exists(path):
+                os.rename(path, part_path)
+            raise
+        self.remove(upload)
+        return entry
+
+    def restore(self, upload, checksum, blobs):
+        """
+        Restores the part file of ``upload`` from the blob with ``checksum``,
+        if it was already stored in the blob when adding the file failed
+        """
+        part_path = self.part_path(upload)
+        if os.path.exists(part_path):
+            return
+        root = blobs.locate(checksum)
+        if root is None:
+            return
+        # The blob may hold the data of other entries, and the reference of
+        # the upload was already released, so its data is copied back
+        shutil.copyfile(blobs.blob_path(checksum, root), part_path)
+
+    def cancel(self, upload_id):
+        self.remove(self.require(upload_id))
+
+    def cleanup(self, expiry):
+        """
+        Discards uploads started more than ``expiry`` seconds ago, and
+        returns their number
+        """
+        self.db.query('SELECT {} FROM uploads WHERE created < ?;'.format(
+            ', '.join(COLUMNS)), time.time() - expiry)
+        expired = [self.to_dict(row) for row in self.db.results
+                   if row[0] not in self.active]
+        for upload in expired:
+            self.remove(upload)
+        if expired:
+            logging.info('Discarded {} expired uploads'.format(len(expired)))
+        return len(expired)
+
+    def require(self, upload_id):
+        upload = self.get(upload_id)
+        if upload is None:
+            raise UploadException('No upload with id {}'.format(upload_id))
+        return upload
+
+    def remove(self, upload):
+        self.db.execute('DELETE FROM uploads WHERE id = ?;', (upload['id'],))
+        self.hashers.pop(upload['id'], None)
+        try:
+            os.remove(self.part_path(upload))
+        except OSError:
+            pass
+
+    def content_manager(self):
+        return ContentManager(self.config, self.db)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+utils.py: utility methods for content
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+
+from ..client import RegistryClient
+from ..utils.metrics import metrics, COUNTER, GAUGE
+from ..utils.string import basestring
+from .manager import ContentManager
+from .merkle import MerkleTree
+from .replication import Follower
+from .shards import connect
+from .snapshot import SnapshotBuilder
+from .volumes import Volumes
+
+
+def collect_metrics():
+    cache = ContentManager.cache
+    yield ('registry_list_cache_entries', GAUGE,
+           'Number of listings in the listing cache',
+           [({}, len(cache))])
+    yield ('registry_list_cache_requests_total', COUNTER,
+           'Number of listing cache lookups',
+           [({'result': 'hit'}, cache.hits),
+            ({'result': 'miss'}, cache.misses)])
+
+
+def collect_volume_metrics(volumes):
+    usage = volumes.usage()
+    free = []
+    for volume in volumes:
+        try:
+            free.append(({'volume': volume.root},
+                         volumes.available(volume, usage.get(
+                             volume.root, (0, 0))[1])))
+        except OSError:
+            pass
+    yield ('registry_volume_files', GAUGE,
+           'Number of live entries stored on each storage volume',
+           [({'volume': volume.root}, usage.get(volume.root, (0, 0))[0])
+            for volume in volumes])
+    yield ('registry_volume_bytes', GAUGE,
+           'Total size of live entries stored on each storage volume',
+           [({'volume': volume.root}, usage.get(volume.root, (0, 0))[1])
+            for volume in volumes])
+    yield ('registry_volume_available_bytes', GAUGE,
+           'Number of bytes which may still be placed on each storage volume',
+           free)
+    yield ('registry_volume_transfers', GAUGE,
+           'Number of uploads in progress on each storage volume',
+           [({'volume': volume.root}, volumes.load[volume.root])
+            for volume in volumes])
+
+
+def collect_replication_metrics(follower):
+    changes, seconds = follower.lag()
+    yield ('registry_replication_lag_changes', GAUGE,
+           'Number of actions of the primary not applied yet',
+           [({}, changes)])
+    yield ('registry_replication_lag_seconds', GAUGE,
+           'Number of seconds since the replica was last up to date',
+           [({}, seconds)])
+    yield ('registry_replication_applied_total', COUNTER,
+           'Number of actions of the primary applied to the replica',
+           [({}, follower.applied)])
+
+
+def prepare(config, databases):
+    db = connect(config, databases)
+    # Entries written without going through the content manager, such as
+    # those of databases created before the Merkle tree was introduced, are
+    # only hashed by a rebuild
+    tree = MerkleTree(db)
+    if tree.is_empty():
+        tree.rebuild()
+    # The same goes for usage of storage volumes
+    volumes = Volumes.from_config(config, db)
+    if not volumes.usage():
+        volumes.recount()
+
+
+def pre_init(app, config):
+    databases = config['database.connections']
+    ContentManager.configure(config)
+    metrics.add_collector('content', collect_metrics)
+    builder = None
+    if config['snapshot.enabled']:
+        snapshot_dir = os.path.dirname(config['snapshot.path'])
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        builder = SnapshotBuilder.from_config(databases.registry, config)
+    config['snapshot.builder'] = builder
+    metrics.add_collector('volumes', lambda: collect_volume_metrics(
+        Volumes.from_config(config, databases.registry)))
+    peers = config['sync.peers']
+    if isinstance(peers, basestring):
+        peers = peers.split()
+    follower = None
+    if config['replication.primary']:
+        client = RegistryClient.from_config(config['replication.primary'],
+                                            config, 'replication')
+        follower = Follower.from_config(databases.registry, client, config)
+        # Entries of a replica only come from its primary
+        peers = []
+        # Only the leader polls the primary, so the lag is only known there
+        if config.get('server.worker_id', 0) == 0:
+            metrics.add_collector(
+                'replication',
+                lambda: collect_replication_metrics(follower))
+    config['replication.follower'] = follower
+    config['sync.clients'] = [RegistryClient.from_config(url, config)
+                              for url in peers]
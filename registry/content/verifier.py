@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+verifier.py: background verification of files against their entries
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import hashlib
+import logging
+
+from .content import LIST_COLS, RAW_LIST_COLS, query_batches
+
+
+ID_INDEX = LIST_COLS.index('id')
+PATH_INDEX = LIST_COLS.index('path')
+SIZE_INDEX = LIST_COLS.index('size')
+ALIVE_INDEX = LIST_COLS.index('alive')
+CHECKSUM_INDEX = LIST_COLS.index('checksum')
+
+MISSING = 'missing'
+SIZE = 'size'
+CHECKSUM = 'checksum'
+
+DISCREPANCY_COLS = ('file_id', 'path', 'problem', 'expected', 'actual',
+                    'CAST(detected AS REAL)')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Throttle(object):
+    """
+    Paces operations so that no more than ``ops_rate`` operations and
+    ``bytes_rate`` bytes are processed per second on average. A rate of 0
+    disables the corresponding limit.
+    """
+
+    def __init__(self, ops_rate=0, bytes_rate=0, sleep=time.sleep,
+                 clock=time.time):
+        self.ops_rate = ops_rate
+        self.bytes_rate = bytes_rate
+        self.sleep = sleep
+        self.clock = clock
+        self.started = clock()
+        self.ops = 0
+        self.bytes = 0
+
+    def spend(self, ops=0, size=0):
+        """
+        Accounts for ``ops`` operations and ``size`` bytes, and waits until
+        they fit in the budget
+        """
+        self.ops += ops
+        self.bytes += size
+        due = 0
+        if self.ops_rate:
+            due = max(due, float(self.ops) / self.ops_rate)
+        if self.bytes_rate:
+            due = max(due, float(self.bytes) / self.bytes_rate)
+        delay = self.started + due - self.clock()
+        if delay > 0:
+            self.sleep(delay)
+
+
+class Verifier(object):
+    """
+    Checks that the files of live entries exist and have the recorded size,
+    and the recorded checksum if ``rehash`` is set. Entries are verified in
+    order of their ids, ``batch_size`` at a time, and the id of the last
+    verified entry is stored in the verification table, so that verification
+    resumes where it stopped after a restart. Once the last entry has been
+    verified, a new pass starts from the first one.
+
+    Files which do not match their entries are recorded in the discrepancies
+    table, until they are found to match again or their entries are deleted.
+    Each file checked counts as one operation, and each byte read while
+    rehashing as one byte, towards the limits of ``throttle``.
+    """
+    NAME = 'content'
+
+    def __init__(self, db, throttle=None, batch_size=100, rehash=True):
+        self.db = db
+        self.throttle = throttle or Throttle()
+        self.batch_size = batch_size
+        self.rehash = rehash
+
+    @classmethod
+    def from_config(cls, db, config):
+        throttle = Throttle(ops_rate=config['verification.ops_per_second'],
+                            bytes_rate=config['verification.bytes_per_second'])
+        return cls(db, throttle, batch_size=config['verification.batch_size'],
+                   rehash=config['verification.rehash'])
+
+    def state(self):
+        """
+        Returns the id of the last verified entry, the number of completed
+        passes and the timestamp when the current pass was started
+        """
+        self.db.query('SELECT position, passes, CAST(started AS REAL) '
+                      'FROM verification WHERE name = ?;', self.NAME)
+        row = self.db.result
+        if row is None:
+            return 0, 0, None
+        return tuple(row)
+
+    def save(self, position, passes, started):
+        self.db.execute(
+            'INSERT OR REPLACE INTO verification (name, position, passes, '
+            'started) VALUES (?, ?, ?, ?);',
+            (self.NAME, position, passes, started))
+
+    def run(self):
+        """
+        Verifies the next batch of entries, and returns the number of
+        entries verified
+        """
+        position, passes, started = self.state()
+        query = self.db.Select(sets='content', what=RAW_LIST_COLS,
+                               where='id > ?', limit=self.batch_size)
+        rows = [row for batch in query_batches(self.db, query, [position],
+                                               order='id')
+                for row in batch]
+        if not rows:
+            if position:
+                logging.debug('Verification pass {} completed'.format(
+                    passes + 1))
+                self.save(0, passes + 1, None)
+            return 0
+        for row in rows:
+            self.verify(row)
+        self.save(rows[-1][ID_INDEX], passes, started or time.time())
+        return len(rows)
+
+    def verify(self, row):
+        """
+        Verifies the file of the entry with raw column values ``row``, and
+        records or clears its discrepancy
+        """
+        if not row[ALIVE_INDEX]:
+            self.clear(row[ID_INDEX])
+            return
+        problem = self.check(row)
+        if problem is None:
+            self.clear(row[ID_INDEX])
+            return
+        kind, expected, actual = problem
+        self.db.query('SELECT problem, actual FROM discrepancies '
+                      'WHERE file_id = ?;', row[ID_INDEX])
+        recorded = self.db.result
+        if recorded and tuple(recorded) == (kind, actual):
+            # Already known since a previous pass
+            return
+        logging.warning('File {} of entry {} does not match it: {} '
+                        '(expected {}, found {})'.format(
+                            row[PATH_INDEX], row[ID_INDEX], kind, expected,
+                            actual))
+        self.db.execute(
+            'INSERT OR REPLACE INTO discrepancies (file_id, path, problem, '
+            'expected, actual, detected) VALUES (?, ?, ?, ?, ?, ?);',
+            (row[ID_INDEX], row[PATH_INDEX], kind, expected, actual,
+             time.time()))
+
+    def check(self, row):
+        """
+        Returns the kind of discrepancy between the file of the entry with
+        raw column values ``row`` and the entry, along with the expected and
+        actual values, or None if the file matches the entry
+        """
+        path = row[PATH_INDEX]
+        self.throttle.spend(ops=1)
+        try:
+            size = os.path.getsize(path)
+        except (OSError, TypeError):
+            return MISSING, path, None
+        if size != row[SIZE_INDEX]:
+            return SIZE, row[SIZE_INDEX], size
+        if not self.rehash or not row[CHECKSUM_INDEX]:
+            return None
+        try:
+            checksum = self.checksum(path)
+        except (OSError, IOError):
+            return MISSING, path, None
+        if checksum != row[CHECKSUM_INDEX]:
+            return CHECKSUM, row[CHECKSUM_INDEX], checksum
+        return None
+
+    def checksum(self, path):
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as fobj:
+            for chunk in iter(lambda: fobj.read(CHUNK_SIZE), b''):
+                self.throttle.spend(size=len(chunk))
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def clear(self, file_id):
+        self.db.execute('DELETE FROM discrepancies WHERE file_id = ?;',
+                        (file_id,))
+
+    def discrepancies(self, after=0, count=100):
+        """
+        Returns at most ``count`` recorded discrepancies of entries with ids
+        greater than ``after``, ordered by id
+        """
+        query = self.db.Select(DISCREPANCY_COLS, sets='discrepancies',
+                               where='file_id > ?', order='file_id',
+                               limit=count)
+        self.db.query(query, after)
+        return [dict(zip(('file_id', 'path', 'problem', 'expected', 'actual',
+                          'detected'), row)) for row in self.db.results]
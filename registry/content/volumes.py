@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+volumes.py: storage volumes holding content files
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import logging
+import contextlib
+import collections
+
+from ..utils.string import basestring
+from .content import LIST_COLS, iter_content_rows
+
+
+PATH_INDEX = LIST_COLS.index('path')
+SIZE_INDEX = LIST_COLS.index('size')
+
+
+class Volume(object):
+    """
+    A directory holding content files, usually the mount point of a disk.
+    New files are placed on volumes in proportion to their ``weight``, and
+    no more than ``capacity`` bytes of files are placed on the volume unless
+    it is 0.
+    """
+
+    def __init__(self, root, weight=1, capacity=0):
+        self.root = os.path.abspath(root)
+        self.weight = weight
+        self.capacity = capacity
+
+    def contains(self, path):
+        return bool(path) and os.path.abspath(path).startswith(
+            self.root + os.sep)
+
+    def free_space(self):
+        stat = os.statvfs(self.root)
+        return stat.f_bavail * stat.f_frsize
+
+
+class Volumes(object):
+    """
+    The volumes content files are stored on, along with the number and size
+    of the live entries stored on each, which are kept in the volumes table.
+    Entries written without going through the content manager, such as those
+    copied from other registries, are only counted by `recount`.
+
+    The number of transfers in progress on each volume is counted in
+    ``load``, which is shared by all instances in the process.
+    """
+
+    # Transfers in progress on each volume, by root
+    load = collections.Counter()
+
+    def __init__(self, volumes, db):
+        self.volumes = list(volumes)
+        self.db = db
+
+    @classmethod
+    def from_config(cls, config, db):
+        """
+        Returns the volumes listed in the configuration, one per line in the
+        ``<root> <weight> <capacity>`` format. The root path is always a
+        volume, with a weight of 1 and no capacity unless it is listed.
+        """
+        lines = config.get('storage.volumes', [])
+        if isinstance(lines, basestring):
+            lines = lines.splitlines()
+        volumes = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                root, weight, capacity = line.split()
+                volumes.append(Volume(root, float(weight), int(capacity)))
+            except ValueError:
+                logging.error('Invalid storage volume: {}'.format(line))
+        root_path = os.path.abspath(config['registry.root_path'])
+        if not any(volume.root == root_path for volume in volumes):
+            volumes.insert(0, Volume(root_path))
+        return cls(volumes, db)
+
+    def __iter__(self):
+        return iter(self.volumes)
+
+    def locate(self, path):
+        """
+        Returns the volume holding ``path``, or None if it is on none of the
+        volumes
+        """
+        for volume in self.volumes:
+            if volume.contains(path):
+                return volume
+        return None
+
+    def get(self, root):
+        root = os.path.abspath(root)
+        for volume in self.volumes:
+            if volume.root == root:
+                return volume
+        return None
+
+    def usage(self):
+        """
+        Returns a dict mapping the root of each volume to the number and
+        total size of the live entries stored on it
+        """
+        self.db.query('SELECT root, files, bytes FROM volumes;')
+        return dict((row[0], (row[1], row[2])) for row in self.db.results)
+
+    def record(self, path, size, files=1):
+        """
+        Adds ``files`` entries of ``size`` bytes in total at ``path`` to the
+        usage of its volume. Negative values remove entries.
+        """
+        volume = self.locate(path)
+        if volume is None or not (files or size):
+            return
+        self.db.execute('INSERT OR IGNORE INTO volumes (root) VALUES (?);',
+                        (volume.root,))
+        self.db.execute('UPDATE volumes SET files = files + ?, '
+                        'bytes = bytes + ? WHERE root = ?;',
+                        (files, size or 0, volume.root))
+
+    def recount(self):
+        """
+        Counts the live entries stored on each volume from scratch
+        """
+        counts = dict((volume.root, [0, 0]) for volume in self.volumes)
+        for rows in iter_content_rows(self.db, alive=True):
+            for row in rows:
+                volume = self.locate(row[PATH_INDEX])
+                if volume is not None:
+                    counts[volume.root][0] += 1
+                    counts[volume.root][1] += row[SIZE_INDEX] or 0
+        self.db.execute('BEGIN IMMEDIATE;')
+        try:
+            self.db.execute('DELETE FROM volumes;')
+            for root, (files, size) in counts.items():
+                self.db.execute('INSERT INTO volumes (root, files, bytes) '
+                                'VALUES (?, ?, ?);', (root, files, size))
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+
+    def available(self, volume, used):
+        """
+        Returns the number of bytes which may still be placed on ``volume``,
+        given the ``used`` bytes of entries stored on it
+        """
+        free = volume.free_space()
+        if volume.capacity:
+            free = min(free, volume.capacity - used)
+        return max(free, 0)
+
+    def choose(self, size=None):
+        """
+        Returns the volume a new file of ``size`` bytes should be placed on,
+        or None if there is no room for it. Volumes are chosen in proportion
+        to their weight and available space, and volumes with transfers in
+        progress are avoided.
+        """
+        usage = self.usage()
+        best = None
+        best_score = 0
+        for volume in self.volumes:
+            try:
+                free = self.available(volume,
+                                      usage.get(volume.root, (0, 0))[1])
+            except OSError as exc:
+                logging.error('Could not check volume {}: {}'.format(
+                    volume.root, exc))
+                continue
+            if not free or free < (size or 0):
+                continue
+            score = free * volume.weight / (1 + self.load[volume.root])
+            if score > best_score:
+                best, best_score = volume, score
+        return best
+
+    @contextlib.contextmanager
+    def busy(self, root):
+        """
+        Counts a transfer in progress on the volume at ``root`` while the
+        context is active
+        """
+        self.load[root] += 1
+        try:
+            yield
+        finally:
+            self.load[root] -= 1
+            if not self.load[root]:
+                del self.load[root]
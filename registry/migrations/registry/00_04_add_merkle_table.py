@@ -0,0 +1,11 @@
+SQL = """
+CREATE TABLE merkle
+(
+    bucket integer primary key,               -- content ids divided by bucket size
+    hash blob not null                        -- hash of content entries in the bucket
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,11 @@
+SQL = """
+CREATE TABLE replication
+(
+    primary_url varchar primary key,          -- base url of the followed registry
+    position integer not null                 -- id of the last applied action of the followed registry
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,10 @@
+SQL = """
+CREATE TABLE content_ids
+(
+    id integer primary key autoincrement      -- last id allocated to a file stored in a content shard
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,21 @@
+SQL = """
+ALTER TABLE content ADD COLUMN checksum varchar;  -- hex encoded sha256 digest of the file contents
+
+CREATE TABLE uploads
+(
+    id varchar primary key,                   -- random identifier of the upload
+    client_name varchar not null,             -- client which started the upload
+    serve_path varchar not null,              -- path where file should be written to on the receiver
+    params varchar not null,                  -- other fields of the entry, encoded as json
+    size integer,                             -- total size announced by the client, if any
+    created timestamp not null                -- timestamp when the upload was started
+);
+
+-- Entries are hashed with their checksum from now on, so the Merkle tree is
+-- rebuilt on startup
+DELETE FROM merkle;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
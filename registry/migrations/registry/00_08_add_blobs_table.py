@@ -0,0 +1,15 @@
+SQL = """
+CREATE TABLE blobs
+(
+    checksum varchar primary key,             -- hex encoded sha256 digest of the blob
+    size integer not null,                    -- size of the blob in bytes
+    refs integer not null default 0,          -- number of live entries stored in the blob
+    released timestamp                        -- timestamp when the last reference was dropped
+);
+
+CREATE INDEX blobs_released ON blobs (released);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
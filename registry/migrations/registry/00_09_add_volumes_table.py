@@ -0,0 +1,15 @@
+SQL = """
+CREATE TABLE volumes
+(
+    root varchar primary key,                 -- absolute path of the volume
+    files integer not null default 0,         -- number of live entries stored on the volume
+    bytes integer not null default 0          -- total size of live entries stored on the volume
+);
+
+ALTER TABLE uploads ADD COLUMN volume varchar;  -- root of the volume the upload is stored on
+ALTER TABLE blobs ADD COLUMN volume varchar;    -- root of the volume the blob is stored on
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,23 @@
+SQL = """
+CREATE TABLE verification
+(
+    name varchar primary key,                 -- name of the verified table
+    position integer not null,                -- id of the last verified entry
+    passes integer not null default 0,        -- number of completed passes over the table
+    started timestamp                         -- timestamp when the current pass was started
+);
+
+CREATE TABLE discrepancies
+(
+    file_id integer primary key,              -- id of the entry whose file does not match it
+    path varchar,                             -- path of the file
+    problem varchar not null,                 -- missing, size or checksum
+    expected varchar,                         -- value recorded in the entry
+    actual varchar,                           -- value found on disk
+    detected timestamp not null               -- timestamp when the discrepancy was found
+);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,13 @@
+SQL = """
+CREATE TABLE revoked
+(
+    id varchar primary key,                   -- handshake id or session token which may no longer be used
+    expires timestamp not null                -- timestamp after which the id is invalid anyway
+);
+
+CREATE INDEX revoked_expires ON revoked (expires);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
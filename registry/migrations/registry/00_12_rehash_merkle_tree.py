@@ -0,0 +1,8 @@
+SQL = """
+-- Paths are no longer hashed, so the Merkle tree is rebuilt on startup
+DELETE FROM merkle;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,29 @@
+SQL = """
+-- Actions are identified by an explicit id, as rowids may change when the
+-- database is vacuumed. Existing actions keep their rowids as ids.
+CREATE TABLE history_ids
+(
+    id integer primary key autoincrement,     -- position of the action in the history
+    file_id integer not null,
+    client_name varchar not null,
+    action varchar not null,
+    action_params varchar,
+    timestamp timestamp not null,
+
+    foreign key(file_id) references content(id)
+    foreign key(client_name) references clients(name)
+);
+
+INSERT INTO history_ids (id, file_id, client_name, action, action_params,
+                         timestamp)
+SELECT rowid, file_id, client_name, action, action_params, timestamp
+FROM history;
+
+DROP TABLE history;
+
+ALTER TABLE history_ids RENAME TO history;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
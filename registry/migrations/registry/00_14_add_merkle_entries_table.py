@@ -0,0 +1,17 @@
+SQL = """
+-- Entries are spread among leaves by the hash of their serve path instead of
+-- by id, so the Merkle tree is rebuilt on startup
+CREATE TABLE merkle_entries
+(
+    id integer primary key,                   -- content id
+    bucket integer not null                   -- leaf holding the entry
+);
+
+CREATE INDEX merkle_entries_bucket ON merkle_entries (bucket);
+
+DELETE FROM merkle;
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
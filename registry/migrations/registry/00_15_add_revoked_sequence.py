@@ -0,0 +1,24 @@
+SQL = """
+-- Revocations are numbered in the order they were recorded, so that processes
+-- can read the ones they have not seen yet. Unlike rowids, the numbers are
+-- never reused once the rows are purged.
+CREATE TABLE revoked_seq
+(
+    seq integer primary key autoincrement,    -- position of the revocation
+    id varchar unique not null,               -- handshake id or session token which may no longer be used
+    expires timestamp not null                -- timestamp after which the id is invalid anyway
+);
+
+INSERT INTO revoked_seq (id, expires)
+SELECT id, expires FROM revoked ORDER BY rowid;
+
+DROP TABLE revoked;
+
+ALTER TABLE revoked_seq RENAME TO revoked;
+
+CREATE INDEX revoked_expires ON revoked (expires);
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
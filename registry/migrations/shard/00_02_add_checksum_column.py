@@ -0,0 +1,7 @@
+SQL = """
+ALTER TABLE content ADD COLUMN checksum varchar;  -- hex encoded sha256 digest of the file contents
+"""
+
+
+def up(db, conf):
+    db.executescript(SQL)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+supervisor.py: runs the application in several worker processes
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import signal
+import logging
+import binascii
+
+import gevent
+
+from .application import Application
+from .utils.databases import init_databases, close_databases
+from .utils.logs import configure_logging
+from .utils.system import on_interrupt
+
+
+class Supervisor(object):
+    """
+    Forks ``workers`` worker processes, each of which runs its own
+    :py:class:`~registry.application.Application` listening on the same port
+    using ``SO_REUSEPORT``.
+
+    Database migrations and the hooks which prepare the databases after them
+    are run once by the supervisor before any worker is started. Workers that exit while the supervisor is running are restarted
+    with the same worker id, and the worker with id 0 is the leader which
+    runs the background hooks. Interrupting the supervisor stops all workers.
+    """
+    RESTART_DELAY = 1  # seconds
+    STOP_TIMEOUT = 10  # seconds
+
+    def __init__(self, root_dir, workers, overrides=None):
+        self.root_dir = root_dir
+        self.workers = workers
+        self.overrides = dict(overrides or {})
+        self.config = Application.load_config(root_dir, self.overrides)
+        self.pids = {}
+        self.signal_handlers = []
+        self.stopping = False
+        # Workers must sign sessions with the same secret to accept sessions
+        # created by each other
+        self.secret = (self.config.get('auth.secret') or
+                       binascii.hexlify(os.urandom(32)).decode('ascii'))
+
+    def start(self):
+        configure_logging(self.config)
+        logging.info('Running database migrations and preparing databases')
+        close_databases(init_databases(self.config))
+        self.signal_handlers = on_interrupt(self.stop)
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        self.monitor()
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker(worker_id)
+        self.pids[pid] = worker_id
+        logging.info('Started worker {} with pid {}'.format(worker_id, pid))
+
+    def run_worker(self, worker_id):
+        # The supervisor's signal handlers are inherited by the worker, which
+        # registers its own handlers instead
+        for handler in self.signal_handlers:
+            handler.cancel()
+        overrides = dict(self.overrides)
+        overrides.update({
+            'server.worker_id': worker_id,
+            'server.workers': self.workers,
+            'server.reuse_port': True,
+            'database.migrate': False,
+            'auth.secret': self.secret,
+        })
+        code = 0
+        try:
+            Application(self.root_dir, overrides).start()
+        except SystemExit as exc:
+            code = exc.code or 0
+        except Exception:
+            logging.exception('Worker {} crashed'.format(worker_id))
+            code = 1
+        os._exit(code)
+
+    def monitor(self):
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError:
+                gevent.sleep(self.RESTART_DELAY)
+                continue
+            worker_id = self.pids.pop(pid, None)
+            if worker_id is None or self.stopping:
+                continue
+            logging.error('Worker {} (pid {}) exited with status {}, '
+                          'restarting'.format(worker_id, pid, status))
+            gevent.sleep(self.RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(worker_id)
+
+    def stop(self):
+        logging.info('Stopping workers')
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.time() + self.STOP_TIMEOUT
+        while self.pids and time.time() < deadline:
+            gevent.sleep(0.1)
+        if self.pids:
+            logging.error('Killing workers which did not stop in time')
+            self.signal_workers(signal.SIGKILL)
+
+    def signal_workers(self, signum):
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                self.pids.pop(pid, None)
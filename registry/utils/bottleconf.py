@@ -10,6 +10,9 @@ class DateTimeCapableEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
             return self.totimestamp(obj)
+        # Compact records which stand in for dicts
+        if hasattr(obj, 'to_dict'):
+            return obj.to_dict()
 
         return super(DateTimeCapableEncoder, self).default(obj)
 
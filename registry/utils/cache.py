@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+cache.py: in-memory caches
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import time
+import collections
+
+
+class TTLCache(object):
+    """
+    Least-recently-used cache holding at most ``size`` entries, each of which
+    also expires ``ttl`` seconds after it was stored.
+
+    Hits and misses are counted in :py:attr:`hits` and :py:attr:`misses`.
+    """
+
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored under ``key``, or ``default`` if there is no
+        such value or the value has expired.
+        """
+        try:
+            expires, value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < time.time():
+            self.misses += 1
+            return default
+        # Reinserting the key marks it as the most recently used one
+        self.data[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Stores ``value`` under ``key``, evicting the least recently used
+        entries if the cache is full.
+        """
+        self.data.pop(key, None)
+        self.data[key] = (time.time() + self.ttl, value)
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
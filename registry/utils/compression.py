@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+compression.py: response compression
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import zlib
+
+from bottle import request, response, HTTPResponse
+
+from .cache import TTLCache
+from .bottleconf import json_dumps
+
+
+# Header names and values must be native strings
+GZIP = str('gzip')
+DEFLATE = str('deflate')
+CONTENT_ENCODING = str('Content-Encoding')
+
+# Window bits which make zlib produce the gzip and zlib formats respectively
+WBITS = {
+    GZIP: 16 + zlib.MAX_WBITS,
+    DEFLATE: zlib.MAX_WBITS,
+}
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+def negotiate(accept_encoding):
+    """
+    Returns the supported encoding the client prefers according to the
+    ``accept_encoding`` header value, or ``None`` if the client does not
+    accept any of them. Gzip is preferred over deflate when both are
+    equally acceptable.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        qualities[coding] = quality
+    best = None
+    best_quality = 0
+    for coding in (GZIP, DEFLATE):
+        quality = qualities.get(coding, qualities.get('*', 0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def to_bytes(chunk):
+    if isinstance(chunk, bytes):
+        return chunk
+    return chunk.encode('utf-8')
+
+
+def compress(data, encoding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(to_bytes(data)) + compressor.flush()
+
+
+def compress_iter(chunks, encoding, level=6):
+    """
+    Compresses ``chunks`` as they are produced, so that large responses are
+    never held in memory whole
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(to_bytes(chunk))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def is_compressible(content_type):
+    return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+
+class CompressionPlugin(object):
+    """
+    Bottle plugin which compresses JSON and text responses using gzip or
+    deflate, depending on what the client accepts. Dicts are serialized to
+    JSON here, as the JSON plugin only gets to them after this plugin.
+    Bodies shorter than ``min_size`` bytes are sent uncompressed, while
+    iterable bodies are compressed as they are streamed.
+
+    Route callbacks which set the ``Content-Encoding`` header themselves, for
+    example to serve cached compressed bodies, are left alone.
+    """
+    name = 'compression'
+    api = 2
+
+    def __init__(self, level=6, min_size=512):
+        self.level = level
+        self.min_size = min_size
+
+    def apply(self, callback, route):
+        def wrapper(*args, **kwargs):
+            body = callback(*args, **kwargs)
+            if isinstance(body, HTTPResponse):
+                return body
+            response.add_header(str('Vary'), str('Accept-Encoding'))
+            if response.get_header(CONTENT_ENCODING):
+                return body
+            encoding = negotiate(request.get_header('Accept-Encoding'))
+            if not encoding:
+                return body
+            if isinstance(body, dict):
+                response.content_type = 'application/json'
+                body = json_dumps(body)
+            if not is_compressible(response.content_type):
+                return body
+            if isinstance(body, (bytes, type(''))):
+                if len(body) < self.min_size:
+                    return body
+                body = compress(body, encoding, self.level)
+            elif body is not None:
+                body = compress_iter(body, encoding, self.level)
+            else:
+                return body
+            response.set_header(CONTENT_ENCODING, encoding)
+            return body
+        return wrapper
+
+
+class CompressedCache(object):
+    """
+    Least-recently-used cache of compressed response bodies. Entries are
+    keyed by the key of the response and the encoding.
+    """
+
+    def __init__(self, size=64, ttl=300, level=6):
+        self.cache = TTLCache(size=size, ttl=ttl)
+        self.level = level
+
+    def get_body(self, key, encoding, produce):
+        """
+        Returns the body stored under ``key`` compressed with ``encoding``.
+        If there is no such body, it is obtained by calling ``produce`` and
+        stored.
+        """
+        cache_key = (key, encoding)
+        body = self.cache.get(cache_key)
+        if body is None:
+            data = b''.join(to_bytes(chunk) for chunk in produce())
+            body = compress(data, encoding, self.level)
+            self.cache.set(cache_key, body)
+        return body
+
+
+def serve_cached(cache, key, produce):
+    """
+    Returns the response body produced by ``produce``, served from
+    ``cache`` when the client accepts compressed responses. Responses with
+    ``key`` of ``None`` are not cached.
+    """
+    if cache is None or key is None:
+        return produce()
+    encoding = negotiate(request.get_header('Accept-Encoding'))
+    if not encoding:
+        return produce()
+    body = cache.get_body(key, encoding, produce)
+    response.set_header(CONTENT_ENCODING, encoding)
+    return body
+
+
+def plugin(config):
+    return CompressionPlugin(level=config['compression.level'],
+                             min_size=config['compression.min_size'])
+
+
+def pre_init(app, config):
+    cache = None
+    if config['compression.cache_size']:
+        cache = CompressedCache(size=config['compression.cache_size'],
+                                ttl=config['compression.cache_ttl'],
+                                level=config['compression.level'])
+    config['compression.cache'] = cache
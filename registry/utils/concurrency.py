@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+concurrency.py: limiting the number of concurrently handled requests
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import time
+
+from gevent.lock import BoundedSemaphore
+
+
+REJECT_STATUS = '503 Service Unavailable'
+REJECT_BODY = b'Service Unavailable'
+
+
+class ReleasingIterable(object):
+    """
+    Wraps a WSGI response iterable to call ``release`` once the server is
+    done with the response.
+    """
+
+    def __init__(self, iterable, release):
+        self.iterable = iterable
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.release()
+
+
+class ConcurrencyLimiter(object):
+    """
+    WSGI middleware which lets at most ``concurrency`` requests be handled at
+    once. Up to ``queue_size`` further requests wait for a free slot, for at
+    most ``queue_timeout`` seconds. Requests which arrive when the queue is
+    full, or which time out while waiting, are rejected with 503 status
+    straight away instead of slowing down the requests being handled.
+
+    Queue depth and waiting time are tracked on the instance and can be
+    obtained using :py:meth:`stats`.
+    """
+
+    def __init__(self, app, concurrency, queue_size, queue_timeout,
+                 retry_after=1):
+        self.app = app
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = str(retry_after)
+        self.slots = BoundedSemaphore(concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __call__(self, environ, start_response):
+        if not self.acquire():
+            return self.reject(start_response)
+        self.active += 1
+        try:
+            result = self.app(environ, start_response)
+        except Exception:
+            self.release()
+            raise
+        if isinstance(result, (list, tuple)):
+            # The response is already rendered, so the slot can be freed
+            # without waiting for it to be sent
+            self.release()
+            return result
+        return ReleasingIterable(result, self.release)
+
+    def acquire(self):
+        if self.slots.acquire(blocking=False):
+            return True
+        if self.waiting >= self.queue_size:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        start = time.time()
+        try:
+            acquired = self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        wait = time.time() - start
+        self.wait_count += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        if not acquired:
+            self.timed_out += 1
+        return acquired
+
+    def release(self):
+        self.active -= 1
+        self.slots.release()
+
+    def reject(self, start_response):
+        start_response(REJECT_STATUS, [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(REJECT_BODY))),
+            ('Retry-After', self.retry_after),
+        ])
+        return [REJECT_BODY]
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'wait_count': self.wait_count,
+            'wait_total': self.wait_total,
+            'wait_max': self.wait_max,
+        }
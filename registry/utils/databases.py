@@ -1,15 +1,24 @@
 import re
 import os
+import time
 import logging
 import functools
+import importlib
+import itertools
 
 from bottle import request
 
+from .metrics import DB_EXECUTE_DURATION
+from .querylog import QueryLog
+
 
 POSTGRES_BACKEND = 'postgres'
 SQLITE_BACKEND = 'sqlite'
 SERVERLESS_DATABASE_BACKENDS = (SQLITE_BACKEND,)
 
+# Number of rows fetched at once by iterators over query results
+BATCH_SIZE = 500
+
 
 def import_squery(conf):
     backend = conf['database.backend']
@@ -45,8 +54,122 @@ def patch_connection(backend, conn):
         conn.create_function('REGEXP', 2, regexp_operator)
 
 
+class InstrumentedDatabase(object):
+    """
+    Wraps a database connection and records the time spent running queries,
+    including fetching their results. If ``query_log`` is specified, executed
+    statements are also recorded in it. All other attributes are looked up on
+    the wrapped connection.
+
+    Results are fetched after the statement returns, so a statement is only
+    recorded once its results are read through :py:attr:`result` or
+    :py:attr:`results`, or when the next statement is executed.
+    """
+
+    def __init__(self, db, name, query_log=None):
+        self.db = db
+        self.name = name
+        self.query_log = query_log
+        self.timings = DB_EXECUTE_DURATION.labels(name)
+        # Statement whose results may still be fetched, with its parameters
+        # and the time spent on it so far
+        self.pending = None
+
+    def __getattr__(self, attr):
+        return getattr(self.db, attr)
+
+    def record(self, qry, params, duration):
+        self.timings.observe(duration)
+        if self.query_log:
+            self.query_log.record(self.db, self.name, qry, params, duration)
+
+    def flush(self, fetched=0):
+        """
+        Records the pending statement, adding ``fetched`` seconds spent
+        fetching its results
+        """
+        if self.pending is None:
+            return
+        qry, params, duration = self.pending
+        self.pending = None
+        self.record(qry, params, duration + fetched)
+
+    def timed(self, method, qry, params, *args, **kwargs):
+        self.flush()
+        if hasattr(qry, 'serialize'):
+            qry = qry.serialize()
+        start = time.time()
+        try:
+            return method(qry, *args, **kwargs)
+        finally:
+            self.pending = (qry, params, time.time() - start)
+
+    def fetch(self, attr):
+        start = time.time()
+        try:
+            return getattr(self.db, attr)
+        finally:
+            self.flush(time.time() - start)
+
+    @property
+    def result(self):
+        return self.fetch('result')
+
+    @property
+    def results(self):
+        return self.fetch('results')
+
+    def query(self, qry, *params, **kwparams):
+        return self.timed(self.db.query, qry, params or kwparams, *params,
+                          **kwparams)
+
+    def execute(self, qry, *args, **kwargs):
+        params = args[0] if args else ()
+        return self.timed(self.db.execute, qry, params, *args, **kwargs)
+
+    def executemany(self, qry, *args, **kwargs):
+        # Plans are not captured for statements executed with many sets of
+        # parameters
+        try:
+            return self.timed(self.db.executemany, qry, None, *args,
+                              **kwargs)
+        finally:
+            # There are no results to fetch
+            self.flush()
+
+    def timed_batches(self, cursor, qry, params, size=BATCH_SIZE):
+        """
+        Executes ``qry`` on ``cursor`` like :py:func:`iter_batches`. The
+        statement is recorded once the results are exhausted or the iterator
+        is closed, with the time spent executing it and fetching its results.
+        """
+        start = time.time()
+        try:
+            cursor.execute(qry, params)
+        except Exception:
+            self.record(qry, params, time.time() - start)
+            raise
+        return self.record_batches(fetch_batches(cursor, size), qry, params,
+                                   time.time() - start)
+
+    def record_batches(self, batches, qry, params, duration):
+        try:
+            while True:
+                start = time.time()
+                try:
+                    rows = next(batches)
+                except StopIteration:
+                    return
+                finally:
+                    duration += time.time() - start
+                yield rows
+        finally:
+            batches.close()
+            self.record(qry, params, duration)
+
+
 def get_databases(database_cls, container_cls, backend, db_confs, host, port,
-                  user, password, debug=False):
+                  user, password, debug=False, query_log=None):
     databases = {}
     for name, db_config in db_confs.items():
         conn = database_cls.connect(host=host,
@@ -57,7 +180,22 @@ def get_databases(database_cls, container_cls, backend, db_confs, host, port,
                                     debug=debug)
         patch_connection(backend, conn)
         databases[name] = conn
-    return container_cls(databases, debug=debug)
+    databases = container_cls(databases, debug=debug)
+    for name in db_confs:
+        databases[name] = InstrumentedDatabase(databases[name], name,
+                                               query_log)
+    return databases
+
+
+def get_shard_names(conf):
+    """
+    Returns the names of the databases holding the content table, if it is
+    sharded
+    """
+    shards = conf.get('database.shards', 1)
+    if shards < 2:
+        return []
+    return ['content_{}'.format(index) for index in range(shards)]
 
 
 def get_database_configs(conf):
@@ -65,11 +203,16 @@ def get_database_configs(conf):
     databases = dict()
     for name in conf['database.names']:
         database = get_database_path(conf, name) if serverless else name
-        databases[name] = dict(package_name='registry', database=database)
+        databases[name] = dict(package_name='registry', database=database,
+                               migrations=name)
+    for name in get_shard_names(conf):
+        database = get_database_path(conf, name) if serverless else name
+        databases[name] = dict(package_name='registry', database=database,
+                               migrations='shard')
     return databases
 
 
-def init_databases(config):
+def init_databases(config, query_log=None):
     (database_cls, container_cls) = import_squery(config)
     database_configs = get_database_configs(config)
     if is_serverless(config):
@@ -86,16 +229,74 @@ def init_databases(config):
                               config['database.port'],
                               config['database.user'],
                               config['database.password'],
-                              debug=debug)
-    # Run migrations on all databases
-    for db_name, db_config in database_configs.items():
-        migration_pkg = '{0}.migrations.{1}'.format(db_config['package_name'],
-                                                    db_name)
-        database_cls.migrate(databases[db_name], migration_pkg, config)
+                              debug=debug,
+                              query_log=query_log)
+    # Run migrations on all databases, unless they were already run by the
+    # process supervising this one
+    if config.get('database.migrate', True):
+        for db_name, db_config in database_configs.items():
+            migration_pkg = '{0}.migrations.{1}'.format(
+                db_config['package_name'], db_config['migrations'])
+            database_cls.migrate(databases[db_name], migration_pkg, config)
+            # Migrating a new database recreates it and reconnects, which
+            # drops the functions added to the previous connection
+            patch_connection(config['database.backend'],
+                             databases[db_name].connection)
+        prepare_databases(config, databases)
 
     return databases
 
 
+def prepare_databases(config, databases):
+    """
+    Runs the hooks listed in the ``stack.prepare`` setting, which bring the
+    data in ``databases`` up to date after migrations. Like migrations, they
+    run once before the workers are started, and not in each of them.
+    """
+    for name in config.get('stack.prepare', []):
+        module, hook = name.rsplit('.', 1)
+        getattr(importlib.import_module(module), hook)(config, databases)
+
+
+def close_databases(databases):
+    for conn in databases.values():
+        conn.close()
+
+
+def iter_batches(db, query, params=(), size=BATCH_SIZE):
+    """
+    Executes ``query`` and returns an iterator over lists of at most ``size``
+    result rows. The query runs on a cursor of its own, so that other
+    queries can be executed on ``db`` while the results are consumed.
+    """
+    if hasattr(query, 'serialize'):
+        query = query.serialize()
+    cursor = db.connection.cursor()
+    if isinstance(db, InstrumentedDatabase):
+        return db.timed_batches(cursor, query, params, size)
+    cursor.execute(query, params)
+    return fetch_batches(cursor, size)
+
+
+def fetch_batches(cursor, size=BATCH_SIZE):
+    try:
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield rows
+    finally:
+        cursor.close()
+
+
+def iter_results(db, query, params=(), size=BATCH_SIZE):
+    """
+    Like :py:func:`iter_batches`, but iterates over individual rows
+    """
+    return itertools.chain.from_iterable(
+        iter_batches(db, query, params, size))
+
+
 def row_to_dict(row):
     return {col: row[col] for col in row.keys()}
 
@@ -110,8 +311,10 @@ def regexp_operator(expr, item):
 
 def pre_init(app, config):
     logging.info('Connecting to databases')
-    databases = init_databases(config)
+    query_log = QueryLog.from_config(config)
+    databases = init_databases(config, query_log)
     config['database.connections'] = databases
+    config['database.query_log'] = query_log
 
 
 def plugin(config):
@@ -129,6 +332,4 @@ def plugin(config):
 
 def pre_stop(app):
     logging.info('Disconnecting from databases')
-    conns = app.config['database.connections']
-    for conn in conns.values():
-        conn.close()
+    close_databases(app.config['database.connections'])
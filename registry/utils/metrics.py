@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py: performance metrics in Prometheus text format
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import time
+import bisect
+import logging
+
+from bottle import response, HTTPResponse
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Upper bounds of latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    """
+    Monotonically increasing value. Greenlets are never preempted in the
+    middle of an increment, so no locking is needed.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram(object):
+    """
+    Histogram with fixed bucket bounds. Only the count for the bucket the
+    value falls in is incremented, and the counts are made cumulative when
+    the histogram is exported.
+    """
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The extra bucket is for values above the highest bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+class Family(object):
+    """
+    Group of metrics of the same name and type which differ by label values
+    """
+
+    def __init__(self, name, kind, help, labels=(), factory=Counter):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.label_names = labels
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        """
+        Returns the metric for the given label values, creating it if needed.
+        Callers on hot paths should hold on to the returned metric.
+        """
+        try:
+            return self.children[values]
+        except KeyError:
+            metric = self.children[values] = self.factory()
+            return metric
+
+
+class Metrics(object):
+    """
+    Holds the metric families and collectors of this process. Collectors are
+    callables which return an iterable of ``(name, kind, help, samples)``
+    tuples, where samples are ``(labels, value)`` pairs, and are used for
+    values which are read from other objects when metrics are exported.
+    Collectors are registered by name, so registering a collector again
+    replaces the previous one.
+    """
+
+    def __init__(self):
+        self.families = {}
+        self.collectors = {}
+        self.const_labels = {}
+
+    def counter(self, name, help, labels=()):
+        return self._family(name, COUNTER, help, labels, Counter)
+
+    def histogram(self, name, help, labels=(), bounds=LATENCY_BUCKETS):
+        return self._family(name, HISTOGRAM, help, labels,
+                            lambda: Histogram(bounds))
+
+    def add_collector(self, name, collector):
+        self.collectors[name] = collector
+
+    def _family(self, name, kind, help, labels, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, kind, help, labels,
+                                                  factory)
+        return family
+
+    def export(self):
+        """
+        Returns all metrics in Prometheus text exposition format
+        """
+        lines = []
+        for name in sorted(self.families):
+            family = self.families[name]
+            lines.extend(header(name, family.kind, family.help))
+            for values, metric in sorted(family.children.items()):
+                labels = dict(zip(family.label_names, values))
+                labels.update(self.const_labels)
+                if family.kind == HISTOGRAM:
+                    lines.extend(histogram_lines(name, labels, metric))
+                else:
+                    lines.append(sample(name, labels, metric.value))
+        for key in sorted(self.collectors):
+            collector = self.collectors[key]
+            try:
+                collected = list(collector())
+            except Exception:
+                logging.exception('Error while collecting metrics')
+                continue
+            for name, kind, help, samples in collected:
+                lines.extend(header(name, kind, help))
+                for labels, value in samples:
+                    labels = dict(labels)
+                    labels.update(self.const_labels)
+                    lines.append(sample(name, labels, value))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def header(name, kind, help):
+    return ['# HELP {} {}'.format(name, help),
+            '# TYPE {} {}'.format(name, kind)]
+
+
+def escape(value):
+    return ('{}'.format(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        value = int(value)
+    return repr(value) if isinstance(value, float) else '{}'.format(value)
+
+
+def sample(name, labels, value):
+    if labels:
+        pairs = ','.join('{}="{}"'.format(key, escape(labels[key]))
+                         for key in sorted(labels))
+        name = '{}{{{}}}'.format(name, pairs)
+    return '{} {}'.format(name, format_value(value))
+
+
+def histogram_lines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    bounds = list(histogram.bounds) + ['+Inf']
+    for bound, count in zip(bounds, histogram.counts):
+        cumulative += count
+        bucket_labels = dict(labels, le=bound)
+        lines.append(sample(name + '_bucket', bucket_labels, cumulative))
+    lines.append(sample(name + '_sum', labels, histogram.sum))
+    lines.append(sample(name + '_count', labels, cumulative))
+    return lines
+
+
+metrics = Metrics()
+
+REQUESTS = metrics.counter(
+    'registry_requests_total', 'Number of handled requests',
+    labels=('route', 'status'))
+REQUEST_DURATION = metrics.histogram(
+    'registry_request_duration_seconds', 'Time spent handling requests',
+    labels=('route',))
+DB_EXECUTE_DURATION = metrics.histogram(
+    'registry_db_execute_seconds',
+    'Time spent executing database queries and fetching their results',
+    labels=('database',))
+
+
+class MetricsPlugin(object):
+    """
+    Bottle plugin which records the number of requests per route and status
+    code, and a latency histogram per route
+    """
+    name = 'metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        route_name = route.name or route.rule
+        latency = REQUEST_DURATION.labels(route_name)
+        counters = {}
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            status = 500
+            try:
+                rv = callback(*args, **kwargs)
+                if isinstance(rv, HTTPResponse):
+                    status = rv.status_code
+                else:
+                    status = response.status_code
+                return rv
+            except HTTPResponse as exc:
+                status = exc.status_code
+                raise
+            finally:
+                latency.observe(time.time() - start)
+                counter = counters.get(status)
+                if counter is None:
+                    counter = counters[status] = REQUESTS.labels(
+                        route_name, status)
+                counter.inc()
+        return wrapper
+
+
+def collect_server(config):
+    limiter = config.get('server.limiter')
+    if limiter:
+        stats = limiter.stats()
+        yield ('registry_server_active_requests', GAUGE,
+               'Number of requests being handled', [({}, stats['active'])])
+        yield ('registry_server_waiting_requests', GAUGE,
+               'Number of requests waiting for a free slot',
+               [({}, stats['waiting'])])
+        yield ('registry_server_rejected_requests_total', COUNTER,
+               'Number of requests rejected because the queue was full or '
+               'the wait timed out',
+               [({'reason': 'queue_full'}, stats['rejected']),
+                ({'reason': 'timeout'}, stats['timed_out'])])
+        yield ('registry_server_queue_wait_seconds_total', COUNTER,
+               'Time requests spent waiting for a free slot',
+               [({}, stats['wait_total'])])
+        yield ('registry_server_queue_waits_total', COUNTER,
+               'Number of requests which waited for a free slot',
+               [({}, stats['wait_count'])])
+    scheduler = config.get('background.scheduler')
+    if scheduler:
+        tasks = sorted(scheduler.stats().items())
+        yield ('registry_task_runs_total', COUNTER,
+               'Number of background task runs',
+               [({'task': name}, s['runs']) for name, s in tasks])
+        yield ('registry_task_failures_total', COUNTER,
+               'Number of failed background task runs',
+               [({'task': name}, s['failures']) for name, s in tasks])
+        yield ('registry_task_overruns_total', COUNTER,
+               'Number of background task runs which took longer than the '
+               'task interval',
+               [({'task': name}, s['overruns']) for name, s in tasks])
+        yield ('registry_task_duration_seconds_total', COUNTER,
+               'Time spent running background tasks',
+               [({'task': name}, s['total_duration']) for name, s in tasks])
+        yield ('registry_task_last_duration_seconds', GAUGE,
+               'Duration of the last run of background tasks',
+               [({'task': name}, s['last_duration']) for name, s in tasks])
+
+
+def plugin(config):
+    metrics.const_labels['worker'] = config.get('server.worker_id', 0)
+    metrics.add_collector('server', lambda: collect_server(config))
+    return MetricsPlugin()
+
+
+def export():
+    response.content_type = CONTENT_TYPE
+    return metrics.export()
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+querylog.py: query statistics and slow query log
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+
+from .metrics import metrics
+
+
+SLOW_QUERIES = metrics.counter(
+    'registry_db_slow_queries_total',
+    'Number of queries which took longer than the slow query threshold',
+    labels=('database',))
+
+# Key under which statements are counted once the table is full
+OTHER = '<other>'
+
+
+class QueryStats(object):
+    """
+    Aggregated execution statistics of a single statement
+    """
+    __slots__ = ('count', 'total', 'max', 'slow', 'plan')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.slow = 0
+        self.plan = None
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+
+def param_shape(value):
+    """
+    Describes a query parameter without revealing its value
+    """
+    name = type(value).__name__
+    if isinstance(value, (bytes, type(''))):
+        return '{}({})'.format(name, len(value))
+    return name
+
+
+def params_shape(params):
+    if isinstance(params, dict):
+        return dict((key, param_shape(value))
+                    for key, value in params.items())
+    return [param_shape(value) for value in params]
+
+
+def is_full_scan(plan):
+    # SQLite reports table scans as 'SCAN TABLE <name>', while index scans
+    # mention the index being used
+    return any(row.startswith('SCAN') and 'INDEX' not in row
+               for row in plan)
+
+
+class QueryLog(object):
+    """
+    Keeps execution statistics for up to ``size`` distinct statements, and
+    logs statements which take longer than ``threshold`` seconds along with
+    the shape of their parameters and their query plan. Statements executed
+    after the table is full are counted under :py:data:`OTHER`.
+    """
+
+    def __init__(self, threshold=0.1, size=500, explain=True):
+        self.threshold = threshold
+        self.size = size
+        self.explain = explain
+        self.statements = {}
+
+    @classmethod
+    def from_config(cls, config):
+        threshold = config.get('database.slow_query_threshold', 100)
+        return cls(threshold=threshold / 1000.0 if threshold else None,
+                   size=config.get('database.query_stats_size', 500),
+                   explain=config['database.backend'] == 'sqlite')
+
+    def record(self, db, name, sql, params, duration):
+        """
+        Records execution of ``sql`` with ``params`` on connection ``db``
+        named ``name``
+        """
+        key = (name, sql)
+        stats = self.statements.get(key)
+        if stats is None:
+            if len(self.statements) >= self.size:
+                key = (name, OTHER)
+            stats = self.statements.setdefault(key, QueryStats())
+        stats.add(duration)
+        if self.threshold is None or duration < self.threshold:
+            return
+        stats.slow += 1
+        SLOW_QUERIES.labels(name).inc()
+        if self.explain and params is not None:
+            stats.plan = self.get_plan(db, sql, params)
+        logging.warning(
+            'Slow query on {} ({:.1f}ms): {} params={} plan={}'.format(
+                name, duration * 1000, sql,
+                params_shape(params) if params is not None else None,
+                stats.plan))
+
+    def get_plan(self, db, sql, params):
+        # A separate cursor is used so that results of the slow query which
+        # were not fetched yet are kept intact
+        try:
+            cursor = db.connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[3] for row in cursor.fetchall()]
+            cursor.close()
+            return plan
+        except Exception:
+            logging.exception('Could not get query plan')
+            return None
+
+    def top(self, count=20):
+        """
+        Returns the ``count`` statements which took the most time in total
+        """
+        ranked = sorted(self.statements.items(),
+                        key=lambda item: item[1].total, reverse=True)
+        return [{'database': name,
+                 'sql': sql,
+                 'count': stats.count,
+                 'total': stats.total,
+                 'mean': stats.total / stats.count,
+                 'max': stats.max,
+                 'slow': stats.slow,
+                 'plan': stats.plan,
+                 'full_scan': is_full_scan(stats.plan or [])}
+                for (name, sql), stats in ranked[:count]]
+
+    def clear(self):
+        self.statements.clear()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+ratelimit.py: per-client rate limiting
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import math
+import time
+import logging
+import functools
+
+from bottle import request, HTTPError, HTTP_CODES
+
+from .metrics import metrics, COUNTER
+
+
+CHEAP = 'cheap'
+EXPENSIVE = 'expensive'
+KINDS = (CHEAP, EXPENSIVE)
+
+
+class TokenBucket(object):
+    """
+    Token bucket which is refilled with ``rate`` tokens per second up to
+    ``burst`` tokens. Only the token count and the time of the last refill
+    are stored, the rate and burst are supplied by the caller.
+    """
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+    def take(self, rate, burst, now):
+        """
+        Takes a token from the bucket. Returns 0 on success, or the number of
+        seconds after which a token will become available.
+        """
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(burst, self.tokens + elapsed * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1.0 - self.tokens) / rate
+
+
+class RateLimiter(object):
+    """
+    Keeps a token bucket per client for each kind of request. Limits are
+    specified as a dict mapping request kinds to ``(rate, burst)`` pairs.
+    ``overrides`` maps client names to such dicts. A non-positive rate
+    disables limiting for the given kind.
+    """
+
+    def __init__(self, limits, overrides=None):
+        self.limits = limits
+        self.overrides = overrides or {}
+        self.buckets = dict((kind, {}) for kind in KINDS)
+        self.rejected = 0
+
+    def acquire(self, client_name, kind=CHEAP, now=None):
+        """
+        Accounts for a request of ``kind`` made by client ``client_name``.
+        Returns 0 if the request is allowed, or the number of seconds after
+        which the client may retry.
+        """
+        limits = self.overrides.get(client_name, self.limits)
+        rate, burst = limits[kind]
+        if rate <= 0:
+            return 0
+        if now is None:
+            now = time.time()
+        buckets = self.buckets[kind]
+        bucket = buckets.get(client_name)
+        if bucket is None:
+            bucket = buckets[client_name] = TokenBucket(burst, now)
+        delay = bucket.take(rate, burst, now)
+        if delay:
+            self.rejected += 1
+        return delay
+
+    @classmethod
+    def from_config(cls, config):
+        # Each worker process keeps its own buckets, and connections are
+        # spread evenly between workers, so each gets a share of the limits
+        share = 1.0 / (config.get('server.workers', 1) or 1)
+
+        def limits(rate, burst, exp_rate, exp_burst):
+            return {
+                CHEAP: (float(rate) * share, max(float(burst) * share, 1)),
+                EXPENSIVE: (float(exp_rate) * share,
+                            max(float(exp_burst) * share, 1)),
+            }
+
+        default = limits(config['ratelimit.rate'],
+                         config['ratelimit.burst'],
+                         config['ratelimit.expensive_rate'],
+                         config['ratelimit.expensive_burst'])
+        overrides = {}
+        for line in to_list(config.get('ratelimit.clients', [])):
+            try:
+                name, rate, burst, exp_rate, exp_burst = line.split()
+                overrides[name] = limits(rate, burst, exp_rate, exp_burst)
+            except ValueError:
+                logging.error('Invalid rate limit override: {}'.format(line))
+        return cls(default, overrides)
+
+
+def to_list(val):
+    if isinstance(val, (list, tuple)):
+        return [v for v in val if v]
+    return [val] if val else []
+
+
+def rate_limited(kind=CHEAP):
+    """
+    Decorates a route handler to subject it to per-client rate limiting. The
+    handler must be protected by ``check_auth`` as the limits are applied to
+    the authenticated client. ``kind`` is either one of the request kinds or
+    a callable which returns the kind of the current request.
+
+    Requests over the limit are rejected with 429 status and a
+    ``Retry-After`` header.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            limiter = request.app.config['ratelimit.limiter']
+            if limiter:
+                req_kind = kind() if callable(kind) else kind
+                client_name = request.session.client_name
+                delay = limiter.acquire(client_name, req_kind)
+                if delay:
+                    retry_after = str(int(math.ceil(delay)))
+                    # The WSGI server only accepts native header names
+                    raise HTTPError(429, HTTP_CODES[429],
+                                    headers={str('Retry-After'): retry_after})
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def collect_metrics(limiter):
+    yield ('registry_ratelimit_rejected_total', COUNTER,
+           'Number of requests rejected by the rate limiter',
+           [({}, limiter.rejected)])
+
+
+def pre_init(app, config):
+    limiter = None
+    if config['ratelimit.enabled']:
+        limiter = RateLimiter.from_config(config)
+        metrics.add_collector('ratelimit', lambda: collect_metrics(limiter))
+    config['ratelimit.limiter'] = limiter
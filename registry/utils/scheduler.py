@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+scheduler.py: scheduling of background tasks
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import time
+import random
+import logging
+
+import gevent
+
+from .string import basestring
+
+
+DEFAULT_INTERVAL = 5  # seconds
+
+
+def background_task(interval=DEFAULT_INTERVAL, jitter=0, timeout=None,
+                    concurrent=False):
+    """
+    Declares how a background hook is scheduled. The hook runs every
+    ``interval`` seconds, delayed by a random amount of up to ``jitter``
+    seconds. Runs which take longer than ``timeout`` seconds are aborted. If
+    ``concurrent`` is set, a new run is started when due even if the previous
+    run has not finished yet.
+
+    ``interval``, ``jitter`` and ``timeout`` may also be given as names of
+    configuration keys which hold the value.
+    """
+    def decorator(func):
+        func.schedule = {
+            'interval': interval,
+            'jitter': jitter,
+            'timeout': timeout,
+            'concurrent': concurrent,
+        }
+        return func
+    return decorator
+
+
+class Task(object):
+    """
+    A background hook along with its schedule and run statistics
+    """
+
+    def __init__(self, func, interval=DEFAULT_INTERVAL, jitter=0,
+                 timeout=None, concurrent=False, name=None):
+        self.func = func
+        self.name = name or '{}.{}'.format(func.__module__, func.__name__)
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.concurrent = concurrent
+        self.running = 0
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.overruns = 0
+        self.last_run = None
+        self.last_duration = None
+        self.max_duration = 0
+        self.total_duration = 0
+
+    @classmethod
+    def from_hook(cls, hook, config):
+        """
+        Creates a task for ``hook`` using the schedule declared with
+        :py:func:`background_task`, resolving configuration keys using
+        ``config``.
+        """
+        schedule = dict(getattr(hook, 'schedule', {}))
+        for key in ('interval', 'jitter', 'timeout'):
+            if isinstance(schedule.get(key), basestring):
+                schedule[key] = config[schedule[key]]
+        return cls(hook, **schedule)
+
+    def next_delay(self):
+        if not self.jitter:
+            return self.interval
+        return self.interval + random.uniform(0, self.jitter)
+
+    def run(self, *args, **kwargs):
+        """
+        Runs the task once, recording its duration and outcome
+        """
+        if self.running:
+            # Only possible for concurrent tasks
+            self.overruns += 1
+        self.running += 1
+        start = self.last_run = time.time()
+        timeout = gevent.Timeout(self.timeout)
+        timeout.start()
+        try:
+            self.func(*args, **kwargs)
+        except gevent.Timeout as exc:
+            if exc is not timeout:
+                raise
+            self.timeouts += 1
+            logging.error('Background task {} timed out after {}s'.format(
+                self.name, self.timeout))
+        except Exception:
+            self.failures += 1
+            logging.exception('Error while running background task {}'.format(
+                self.name))
+        finally:
+            timeout.cancel()
+            self.running -= 1
+            duration = time.time() - start
+            self.runs += 1
+            self.last_duration = duration
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+            if not self.concurrent and duration > self.interval:
+                self.overruns += 1
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'running': self.running,
+            'runs': self.runs,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'overruns': self.overruns,
+            'last_run': self.last_run,
+            'last_duration': self.last_duration,
+            'max_duration': self.max_duration,
+            'total_duration': self.total_duration,
+        }
+
+
+class Scheduler(object):
+    """
+    Runs each task in its own greenlet, so that a slow task does not delay
+    the others. All tasks are invoked with ``args``.
+    """
+
+    def __init__(self, args=()):
+        self.args = args
+        self.tasks = []
+        self.greenlets = []
+
+    def add(self, task):
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        for task in self.tasks:
+            self.greenlets.append(gevent.spawn(self._loop, task))
+
+    def stop(self):
+        gevent.killall(self.greenlets)
+        self.greenlets = []
+
+    def _loop(self, task):
+        next_run = time.time() + task.next_delay()
+        while True:
+            gevent.sleep(max(next_run - time.time(), 0))
+            if task.concurrent:
+                gevent.spawn(task.run, *self.args)
+            else:
+                task.run(*self.args)
+            # Runs are scheduled at fixed intervals, but runs which were
+            # missed while the task was running are skipped
+            next_run = max(next_run + task.next_delay(), time.time())
+
+    def stats(self):
+        return dict((task.name, task.stats()) for task in self.tasks)
@@ -22,3 +22,15 @@ if PY3:
 if PY2:
     basestring = basestring
     unicode = unicode
+
+
+def to_bytes(value, encoding='utf-8'):
+    """
+    Returns ``value`` as a byte string. Unicode strings are encoded using
+    ``encoding`` and other objects are converted to strings first.
+    """
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return value.encode(encoding)
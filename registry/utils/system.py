@@ -9,21 +9,46 @@ file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
 """
 
 import sys
+import socket
 import gevent
 import signal
 
 
+# Not exposed by the socket module on Python 2, the value is Linux-specific
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
 def on_interrupt(handler):
     """ Registers a signal handler function
     The handler function should not expect any arguments, and should return an
     integer that is passed to ``sys.exit()``. Exceptions raised in the handler
     will be propagaed without being trapped.
+
+    Returns a list of the registered signal handler objects, which can be used
+    to cancel the registration.
     """
 
     def wrapper(*args, **kwargs):
         ret = handler()
         sys.exit(ret)
 
-    gevent.signal(signal.SIGINT, wrapper)
-    gevent.signal(signal.SIGTERM, wrapper)
-    gevent.signal(signal.SIGSEGV, wrapper)
+    return [
+        gevent.signal(signal.SIGINT, wrapper),
+        gevent.signal(signal.SIGTERM, wrapper),
+        gevent.signal(signal.SIGSEGV, wrapper),
+    ]
+
+
+def make_listener(host, port, reuse_port=False, backlog=1024):
+    """ Returns a listening socket bound to ``host`` and ``port``
+    If ``reuse_port`` is set, the socket is created with ``SO_REUSEPORT``
+    option, so that several processes can listen on the same port.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
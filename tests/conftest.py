@@ -17,6 +17,8 @@ except ImportError:
 
 from squery_lite.pytest_fixtures import *
 
+from registry.utils.databases import patch_connection, SQLITE_BACKEND
+
 
 TESTDIR = os.path.abspath(os.path.dirname(__file__))
 DATADIR = os.path.join(TESTDIR, 'data')
@@ -99,6 +101,13 @@ def populated_databases(databases):
     return databases
 
 
+@pytest.fixture
+def db(populated_databases):
+    # Filters on serve paths need the REGEXP function
+    patch_connection(SQLITE_BACKEND, populated_databases.registry.connection)
+    return populated_databases.registry
+
+
 @pytest.yield_fixture
 def server(populated_databases):
     testargv = ['/usr/bin/env', 'python', '--conf',
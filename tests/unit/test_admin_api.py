@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+test_admin_api.py: Unit tests for registry.admin.api module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import pytest
+from bottle import HTTPError
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.admin import api as mod
+
+
+@mock.patch('registry.auth.utils.request')
+def test_queries_require_session(request):
+    sessions = mock.Mock()
+    sessions.verify_session.return_value = (False, 'No session found')
+    query_log = mock.Mock()
+    request.query = {}
+    request.params = {}
+    request.app.config = {'auth.sessions': sessions,
+                          'database.query_log': query_log}
+    with pytest.raises(HTTPError) as exc:
+        mod.get_queries()
+    assert exc.value.status_code == 401
+    assert not query_log.top.called
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+test_auth_clients.py: Unit tests for registry.auth.clients module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.auth import clients as mod
+
+
+@pytest.fixture
+def client_mgr():
+    mod.ClientManager.cache.clear()
+    db = mock.MagicMock()
+    db.result = {'name': 'test', 'active': 1}
+    return mod.ClientManager(db)
+
+
+def test_get_client_cached(client_mgr):
+    client = client_mgr.get_client('test')
+    assert client == {'name': 'test', 'active': True}
+    assert client_mgr.get_client('test') is client
+    assert client_mgr.db.execute.call_count == 1
+
+
+def test_get_client_caches_missing_client(client_mgr):
+    client_mgr.db.result = None
+    assert client_mgr.get_client('missing') is None
+    assert client_mgr.get_client('missing') is None
+    assert client_mgr.db.execute.call_count == 1
+
+
+@pytest.mark.parametrize('method,args', [
+    ('set_client_key', ('test', 'AES_CBC', b'This is a key123')),
+    ('remove_client_key', ('test', 'AES_CBC')),
+    ('deactivate_client', ('test',)),
+    ('activate_client', ('test',)),
+])
+def test_modifications_invalidate_cache(client_mgr, method, args):
+    client_mgr.get_client('test')
+    getattr(client_mgr, method)(*args)
+    client_mgr.db.execute.reset_mock()
+    client_mgr.get_client('test')
+    assert client_mgr.db.execute.call_count == 1
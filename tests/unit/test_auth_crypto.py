@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+test_auth_crypto.py: Unit tests for registry.auth.crypto module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import os
+import binascii
+
+from Crypto.Cipher import AES
+
+from registry.auth import crypto as mod
+
+
+def test_aes_encrypt_matches_cbc():
+    key = b'This is a key123'
+    iv = mod.aes_make_iv()
+    for _ in range(3):
+        message = binascii.hexlify(os.urandom(32))
+        expected = AES.new(key, AES.MODE_CBC, iv).encrypt(message)
+        assert mod.aes_encrypt(message, key, iv) == expected
+
+
+def test_aes_get_cipher_reused():
+    key = b'Another key 1234'
+    assert mod.aes_get_cipher(key) is mod.aes_get_cipher(key)
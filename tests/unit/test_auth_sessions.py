@@ -23,24 +23,27 @@ from registry.auth import sessions as mod
 
 
 @pytest.fixture
-def session_mgr():
-    db = mock.MagicMock
-    return mod.SessionManager(db)
+def session_mgr(monkeypatch, databases):
+    cls = mod.SessionManager
+    monkeypatch.setattr(cls, 'handshakes', mod.HandshakeStore())
+    monkeypatch.setattr(cls, 'sessions', {})
+    monkeypatch.setattr(cls, 'session_expiry', mod.ExpiryIndex())
+    monkeypatch.setattr(cls, 'revoked', {})
+    monkeypatch.setattr(cls, 'share_revoked', False)
+    monkeypatch.setattr(cls, 'revoked_seq', 0)
+    monkeypatch.setattr(cls, 'revoked_checked', 0)
+    monkeypatch.setattr(cls, 'revoked_purged', 0)
+    databases.registry.execute('DELETE FROM revoked;')
+    return mod.SessionManager(databases.registry)
 
 
 BASE_TIMESTAMP = (datetime(2016, 4, 19) - datetime(1970, 1, 1)).total_seconds()
 
 
 def test_timed_object_is_valid_no_duration():
-        to = mod.TimedObject({
-            'random_key1': 0,
-            'duration': 10,
-        })
+        to = mod.TimedObject(duration=10)
         assert to.is_valid()
-        to = mod.TimedObject({
-            'initiated': 0,
-            'random_key2': 0
-        })
+        to = mod.TimedObject(initiated=0)
         assert to.is_valid()
 
 
@@ -54,10 +57,7 @@ def test_timed_object_is_valid(initiated, duration, current, valid):
     mock_time = mock.Mock()
     mock_time.return_value = current
     with mock.patch('time.time', mock_time):
-        to = mod.TimedObject({
-            'initiated': initiated,
-            'duration': duration
-        })
+        to = mod.TimedObject(initiated=initiated, duration=duration)
         assert to.is_valid() == valid
 
 
@@ -78,6 +78,195 @@ def test_session_mgr_create_session_required_params(session_mgr):
     assert expected_params.issubset(received_params)
 
 
+def test_session_record_has_no_dict():
+    session = mod.Session(token='abc', client_name='test_client',
+                          duration=10, initiated=BASE_TIMESTAMP)
+    assert not hasattr(session, '__dict__')
+    assert session['client_name'] == 'test_client'
+    assert session.expires == BASE_TIMESTAMP + 10
+
+
+def test_expiry_index_pop_expired():
+    index = mod.ExpiryIndex()
+    index.add('late', 30)
+    index.add('early', 10)
+    index.add('middle', 20)
+    assert list(index.pop_expired(25)) == ['early', 'middle']
+    assert len(index) == 1
+    assert list(index.pop_expired(25)) == []
+
+
+def test_session_mgr_cleanup(session_mgr):
+    client = {'name': 'test_client'}
+    mock_time = mock.Mock(return_value=BASE_TIMESTAMP)
+    with mock.patch('time.time', mock_time):
+        expiring = session_mgr._create_session(client, 10)
+        lasting = session_mgr._create_session(client, 100)
+        handshake = session_mgr.create_handshake(client)
+    mock_time.return_value = BASE_TIMESTAMP + 50
+    with mock.patch('time.time', mock_time):
+        assert session_mgr.cleanup() == 2
+    assert expiring.token not in session_mgr.sessions
+    assert lasting.token in session_mgr.sessions
+    assert (client['name'], handshake.id) not in session_mgr.handshakes
+
+
+def make_handshake(client_name, hid, initiated=BASE_TIMESTAMP):
+    return mod.Handshake(id=hid, client_name=client_name, duration=30,
+                         initiated=initiated)
+
+
+def test_handshake_store_client_capacity():
+    store = mod.HandshakeStore(capacity=10, client_capacity=2)
+    store.add(('a', '1'), make_handshake('a', '1'))
+    store.add(('a', '2'), make_handshake('a', '2'))
+    store.add(('b', '1'), make_handshake('b', '1'))
+    store.add(('a', '3'), make_handshake('a', '3'))
+    assert ('a', '1') not in store
+    assert ('a', '3') in store
+    assert ('b', '1') in store
+    assert store.pending['a'] == ['2', '3']
+    assert store.evicted == 1
+    assert store.pop_evicted() == [('a', '1')]
+
+
+def test_handshake_store_evicts_oldest():
+    store = mod.HandshakeStore(capacity=2, client_capacity=2)
+    store.add(('a', '1'), make_handshake('a', '1'))
+    store.add(('b', '1'), make_handshake('b', '1'))
+    store.add(('c', '1'), make_handshake('c', '1'))
+    assert ('a', '1') not in store
+    assert len(store) == 2
+    assert store.evicted == 1
+    assert 'a' not in store.pending
+
+
+def test_handshake_store_purge_expired():
+    store = mod.HandshakeStore()
+    store.add(('a', '1'), make_handshake('a', '1', BASE_TIMESTAMP))
+    store.add(('a', '2'), make_handshake('a', '2', BASE_TIMESTAMP + 20))
+    assert store.purge_expired(BASE_TIMESTAMP + 40) == 1
+    assert ('a', '2') in store
+
+
+def test_session_mgr_store_handshake_evicts_client_oldest(session_mgr):
+    client = {'name': 'greedy_client'}
+    oldest = session_mgr.create_handshake(client)
+    for _ in range(session_mgr.handshakes.client_capacity):
+        latest = session_mgr.create_handshake(client)
+    assert session_mgr.handshakes.evicted == 1
+    assert session_mgr.load_handshake(client, oldest.id) is None
+    assert session_mgr.load_handshake(client, latest.id) is not None
+
+
+def test_session_mgr_restore_session(session_mgr):
+    client = {'name': 'test_client'}
+    session = session_mgr._create_session(client, 3600)
+    # Simulate another worker which has not seen the session
+    session_mgr.sessions.clear()
+    verified, restored = session_mgr.verify_session(session.token)
+    assert verified
+    assert restored.client_name == 'test_client'
+    assert restored.initiated == session.initiated
+    assert session.token in session_mgr.sessions
+
+
+@pytest.mark.parametrize('token', [
+    None,
+    'abc',
+    'a.b.c.d.e',
+])
+def test_session_mgr_restore_session_invalid(session_mgr, token):
+    assert session_mgr.restore_session(token) is None
+
+
+def test_session_mgr_restore_session_bad_signature(session_mgr,
+                                                   monkeypatch):
+    client = {'name': 'test_client'}
+    session = session_mgr._create_session(client, 3600)
+    session_mgr.sessions.clear()
+    monkeypatch.setattr(mod.SessionManager, 'secret', b'another secret')
+    assert session_mgr.restore_session(session.token) is None
+
+
+def test_session_mgr_restore_handshake(session_mgr):
+    client = {'name': 'test_client'}
+    handshake = session_mgr.create_handshake(client)
+    # Simulate another worker which has not seen the handshake
+    session_mgr.handshakes.remove((client['name'], handshake.id))
+    restored = session_mgr.load_handshake(client, handshake.id)
+    assert restored.text == handshake.text
+    assert restored.initiated == handshake.initiated
+    assert session_mgr.load_handshake({'name': 'other'}, handshake.id) is None
+
+
+def test_session_mgr_completed_handshake_not_restored(session_mgr):
+    client = {'name': 'test_client'}
+    handshake = session_mgr.create_handshake(client)
+    session_mgr.invalidate_handshake(client['name'], handshake.id)
+    assert session_mgr.load_handshake(client, handshake.id) is None
+    # Nor by a worker which still holds it
+    other = session_mgr.create_handshake(client)
+    session_mgr.revoke(other.id, BASE_TIMESTAMP * 2)
+    assert session_mgr.load_handshake(client, other.id) is None
+    assert (client['name'], other.id) not in session_mgr.handshakes
+
+
+def test_session_mgr_evicted_handshake_not_restored(session_mgr,
+                                                    monkeypatch):
+    monkeypatch.setattr(mod.SessionManager, 'handshakes',
+                        mod.HandshakeStore(capacity=1))
+    client = {'name': 'test_client'}
+    evicted = session_mgr.create_handshake(client)
+    session_mgr.create_handshake(client)
+    assert session_mgr.load_handshake(client, evicted.id) is None
+
+
+def test_session_mgr_invalidated_session(session_mgr):
+    client = {'name': 'test_client'}
+    session = session_mgr._create_session(client, 3600)
+    other = session_mgr._create_session(client, 3600)
+    session_mgr.invalidate_session(session.token)
+    assert session_mgr.verify_session(session.token)[0] is False
+    # Sessions invalidated by another worker are dropped as well
+    session_mgr.revoke(other.token, other.expires)
+    assert session_mgr.verify_session(other.token)[0] is False
+    assert other.token not in session_mgr.sessions
+
+
+def test_session_mgr_cleanup_revoked(session_mgr):
+    session_mgr.revoke('old', BASE_TIMESTAMP)
+    session_mgr.revoke('new', BASE_TIMESTAMP * 2)
+    session_mgr.cleanup()
+    assert not session_mgr.is_revoked('old')
+    assert session_mgr.is_revoked('new')
+
+
+def test_session_mgr_single_process_skips_revoked_table(session_mgr):
+    session_mgr.revoke('token', BASE_TIMESTAMP * 2)
+    assert session_mgr.is_revoked('token')
+    session_mgr.db.query('SELECT id FROM revoked;')
+    assert session_mgr.db.result is None
+
+
+def test_session_mgr_shared_revoked(session_mgr, monkeypatch):
+    monkeypatch.setattr(mod.SessionManager, 'share_revoked', True)
+    session_mgr.revoke('own', BASE_TIMESTAMP * 2)
+    assert session_mgr.is_revoked('own')
+    session_mgr.db.query('SELECT id FROM revoked;')
+    assert session_mgr.db.result[0] == 'own'
+    # Simulate another worker revoking a token
+    session_mgr.db.execute('INSERT INTO revoked (id, expires) VALUES (?, ?);',
+                           ('other', BASE_TIMESTAMP * 2))
+    mock_time = mock.Mock()
+    mock_time.return_value = mod.SessionManager.revoked_checked + 0.5
+    with mock.patch('time.time', mock_time):
+        assert not session_mgr.is_revoked('other')
+    mock_time.return_value = mod.SessionManager.revoked_checked + 1
+    with mock.patch('time.time', mock_time):
+        assert session_mgr.is_revoked('other')
+
+
 def test_session_mgr_strip_handshake(session_mgr):
     valid = {
         'id': 'id123',
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+test_blobs.py: Unit tests for ``registry.content.blobs`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import hashlib
+
+import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.content import api
+from registry.content.manager import ContentManager
+
+
+@pytest.fixture
+def config(tmpdir):
+    return {'registry.root_path': str(tmpdir),
+            'storage.deduplicate': True,
+            'storage.gc_grace': -1}
+
+
+def add(mgr, tmpdir, name, data):
+    path = tmpdir.join(name)
+    path.write_binary(data)
+    return mgr.add_file('test', str(path), {'path': str(path),
+                                            'serve_path': 'dedup/' + name})
+
+
+def test_duplicates_share_blob(config, db, tmpdir):
+    data = os.urandom(100)
+    checksum = hashlib.sha256(data).hexdigest()
+    mgr = ContentManager(config, db)
+    first = add(mgr, tmpdir, 'first.bin', data)
+    second = add(mgr, tmpdir, 'second.bin', data)
+    assert first['path'] == second['path'] == mgr.blobs.blob_path(checksum)
+    assert first['checksum'] == checksum
+    assert first['size'] == 100
+    assert open(first['path'], 'rb').read() == data
+    assert not tmpdir.join('first.bin').exists()
+    assert not tmpdir.join('second.bin').exists()
+    assert mgr.blobs.refs(checksum) == 2
+
+
+def test_unreferenced_blobs_are_collected(config, db, tmpdir):
+    mgr = ContentManager(config, db)
+    first = add(mgr, tmpdir, 'a.bin', os.urandom(100))
+    second = add(mgr, tmpdir, 'b.bin', os.urandom(100))
+    mgr.delete_file('test', first['id'])
+    # Entries pointing to another file release their blob as well
+    other = tmpdir.join('c.bin')
+    other.write_binary(os.urandom(100))
+    mgr.update_file('test', second['id'], {'path': str(other)})
+    assert mgr.blobs.refs(first['checksum']) == 0
+    assert mgr.blobs.refs(second['checksum']) == 0
+    assert mgr.blobs.collect() >= 200
+    assert not os.path.exists(first['path'])
+    assert not os.path.exists(second['path'])
+    assert os.path.exists(mgr.get_file(id=second['id'])['path'])
+
+
+def test_dead_entries_release_blobs(config, db, tmpdir):
+    mgr = ContentManager(config, db)
+    entry = add(mgr, tmpdir, 'dead.bin', os.urandom(100))
+    root = mgr.volumes.locate(entry['path']).root
+    files, size = mgr.volumes.usage()[root]
+    mgr.update_file('test', entry['id'], {'alive': '0'})
+    assert mgr.blobs.refs(entry['checksum']) == 0
+    assert mgr.volumes.usage()[root] == (files - 1, size - 100)
+    # The same goes for entries pointing to another file at the same time
+    entry = add(mgr, tmpdir, 'moved.bin', os.urandom(100))
+    other = tmpdir.join('other.bin')
+    other.write_binary(os.urandom(100))
+    mgr.update_file('test', entry['id'], {'path': str(other), 'alive': '0'})
+    updated = mgr.get_file(id=entry['id'])
+    assert mgr.blobs.refs(entry['checksum']) == 0
+    assert mgr.blobs.refs(updated['checksum']) == 0
+    assert mgr.volumes.usage()[root] == (files - 1, size - 100)
+
+
+def test_referenced_again_before_collection(config, db, tmpdir):
+    mgr = ContentManager(config, db)
+    data = os.urandom(100)
+    first = add(mgr, tmpdir, 'd.bin', data)
+    mgr.delete_file('test', first['id'])
+    second = add(mgr, tmpdir, 'e.bin', data)
+    mgr.blobs.collect()
+    assert mgr.blobs.refs(first['checksum']) == 1
+    assert open(second['path'], 'rb').read() == data
+
+
+def test_plain_storage(config, db, tmpdir):
+    config['storage.deduplicate'] = False
+    mgr = ContentManager(config, db)
+    entry = add(mgr, tmpdir, 'plain.bin', os.urandom(100))
+    assert entry['path'] == str(tmpdir.join('plain.bin'))
+    assert not mgr.blobs.is_blob(entry['path'])
+
+
+def test_download_named_after_serve_path(config, db, tmpdir):
+    mgr = ContentManager(config, db)
+    entry = add(mgr, tmpdir, 'named.bin', os.urandom(100))
+    assert mgr.blobs.is_blob(entry['path'])
+    config['replication.primary'] = None
+    with mock.patch.object(api, 'request', app=mock.Mock(config=config),
+                           db=mock.Mock(registry=db)):
+        resp = api.get_file(entry['id'])
+    assert resp.status_code == 200
+    assert resp.headers['Content-Disposition'] == (
+        'attachment; filename="named.bin"')
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+test_compression.py: Unit tests for registry.utils.compression module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import gzip
+import json
+import zlib
+from io import BytesIO
+
+import pytest
+from bottle import request, response
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.utils import compression as mod
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=BytesIO(data)).read()
+
+
+@pytest.fixture
+def accept():
+    def bind(accept_encoding):
+        request.bind({'HTTP_ACCEPT_ENCODING': accept_encoding})
+        response.bind()
+    return bind
+
+
+@pytest.mark.parametrize('header,expected', [
+    (None, None),
+    ('', None),
+    ('identity', None),
+    ('gzip', mod.GZIP),
+    ('deflate, gzip', mod.GZIP),
+    ('deflate', mod.DEFLATE),
+    ('gzip;q=0.5, deflate', mod.DEFLATE),
+    ('gzip;q=0, deflate;q=0', None),
+    ('*', mod.GZIP),
+])
+def test_negotiate(header, expected):
+    assert mod.negotiate(header) == expected
+
+
+def test_plugin_compresses_dict(accept):
+    accept('gzip')
+    data = {'results': ['x' * 100] * 10}
+    wrapper = mod.CompressionPlugin(min_size=10).apply(lambda: data, None)
+    body = wrapper()
+    assert response.get_header('Content-Encoding') == 'gzip'
+    assert response.content_type == 'application/json'
+    assert json.loads(gunzip(body)) == data
+
+
+def test_plugin_skips_small_and_unaccepted(accept):
+    accept('gzip')
+    wrapper = mod.CompressionPlugin(min_size=1000).apply(lambda: {}, None)
+    assert wrapper() == '{}'
+    assert response.get_header('Content-Encoding') is None
+    accept('')
+    wrapper = mod.CompressionPlugin(min_size=0).apply(lambda: {}, None)
+    assert wrapper() == {}
+
+
+def test_plugin_streams_iterables(accept):
+    accept('deflate')
+    response.content_type = 'application/json'
+    chunks = [u'[', u'1, ' * 1000, u'1]']
+    wrapper = mod.CompressionPlugin().apply(lambda: iter(chunks), None)
+    body = b''.join(wrapper())
+    assert response.get_header('Content-Encoding') == 'deflate'
+    assert zlib.decompress(body) == ''.join(chunks).encode('utf-8')
+
+
+def test_serve_cached_compresses_once(accept):
+    accept('gzip')
+    cache = mod.CompressedCache()
+    produce = mock.Mock(return_value=[u'{"a": ', u'1}'])
+    for _ in range(2):
+        body = mod.serve_cached(cache, 'key', produce)
+        assert gunzip(body) == b'{"a": 1}'
+    assert produce.call_count == 1
+    assert response.get_header('Content-Encoding') == 'gzip'
+    accept('')
+    assert mod.serve_cached(cache, 'key', produce) == [u'{"a": ', u'1}']
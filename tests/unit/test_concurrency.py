@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+test_concurrency.py: Unit tests for registry.utils.concurrency module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import gevent
+from gevent.event import Event
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.utils import concurrency as mod
+
+
+def make_limiter(queue_size, queue_timeout=1):
+    done = Event()
+
+    def app(environ, start_response):
+        done.wait()
+        start_response('200 OK', [])
+        return [b'ok']
+
+    limiter = mod.ConcurrencyLimiter(app, concurrency=1,
+                                     queue_size=queue_size,
+                                     queue_timeout=queue_timeout)
+    return limiter, done
+
+
+def test_reject_when_queue_full():
+    limiter, done = make_limiter(queue_size=0)
+    first = gevent.spawn(limiter, {}, mock.Mock())
+    gevent.sleep(0)
+    start_response = mock.Mock()
+    assert limiter({}, start_response) == [mod.REJECT_BODY]
+    assert start_response.call_args[0][0] == mod.REJECT_STATUS
+    assert limiter.rejected == 1
+    done.set()
+    assert first.get() == [b'ok']
+    assert limiter.active == 0
+
+
+def test_queued_request_is_handled():
+    limiter, done = make_limiter(queue_size=1)
+    first = gevent.spawn(limiter, {}, mock.Mock())
+    second = gevent.spawn(limiter, {}, mock.Mock())
+    gevent.sleep(0)
+    assert limiter.waiting == 1
+    done.set()
+    assert first.get() == [b'ok']
+    assert second.get() == [b'ok']
+    assert limiter.wait_count == 1
+
+
+def test_reject_after_queue_timeout():
+    limiter, done = make_limiter(queue_size=1, queue_timeout=0.01)
+    gevent.spawn(limiter, {}, mock.Mock())
+    gevent.sleep(0)
+    assert limiter({}, mock.Mock()) == [mod.REJECT_BODY]
+    assert limiter.timed_out == 1
+    done.set()
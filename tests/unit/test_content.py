@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+test_content.py: Unit tests for ``registry.content.content`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import sys
+import json
+
+import pytest
+
+from registry.content import content as mod
+from registry.utils.bottleconf import json_dumps
+
+
+VALUES = (1, 'tmp/file.txt', 100, None, None, 'core', None, 'file.txt', 0,
+          1, None)
+
+
+@pytest.fixture
+def record():
+    return mod.ContentRecord(VALUES)
+
+
+def test_record_item_access(record):
+    assert record['path'] == 'tmp/file.txt'
+    assert record.get('missing', 'x') == 'x'
+    assert 'serve_path' in record
+    assert 'missing' not in record
+    with pytest.raises(KeyError):
+        record['missing']
+    record['alive'] = True
+    assert record.alive is True
+
+
+def test_record_equals_dict(record):
+    expected = dict(zip(mod.LIST_COLS, VALUES))
+    assert record == expected
+    assert record.to_dict() == expected
+    # Objects without items are never equal
+    assert record != None
+    assert record != 1
+    assert not record == 'tmp/file.txt'
+
+
+def test_record_json(record):
+    assert json.loads(json_dumps([record])) == [dict(record.items())]
+
+
+def test_record_is_smaller_than_dict(record):
+    size = sys.getsizeof(record)
+    assert size * 4 < sys.getsizeof(record.to_dict())
+
+
+def test_iter_content_is_lazy(populated_databases):
+    db = populated_databases.registry
+    files = mod.iter_content(db, count=100)
+    first = next(files)
+    # Other queries on the same connection do not disturb the iteration
+    ids = [f.id for f in mod.get_content(db, count=100)]
+    assert len(ids) == 4
+    assert [first.id] + [f.id for f in files] == ids
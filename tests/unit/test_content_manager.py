@@ -13,6 +13,10 @@ from __future__ import unicode_literals
 
 
 import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from registry.content import manager as mod
 
@@ -22,6 +26,13 @@ def content_mgr():
     return mod.ContentManager({'registry.root_path': 'tmp/'}, db=object())
 
 
+@pytest.fixture()
+def cached_mgr(populated_databases):
+    mod.ContentManager.cache.clear()
+    db = populated_databases.registry
+    return mod.ContentManager({'registry.root_path': 'tmp/'}, db=db)
+
+
 @pytest.mark.parametrize('filters', (
     {'serve_path': 'tmp', 'count': 100},
     {'since': '145000000', 'count': 100},
@@ -41,3 +52,44 @@ def test_validate_list_filters_serve_path(content_mgr):
     with pytest.raises(ValueError) as exc:
         content_mgr.validate_list_filters(filters)
     assert 'invalid' in str(exc.value).lower()
+
+
+def test_validate_list_filters_count(content_mgr):
+    assert content_mgr.validate_list_filters({'count': '10'}) == {'count': 10}
+    assert content_mgr.validate_list_filters({'count': '5000'}) == {
+        'count': content_mgr.MAX_LIST_COUNT}
+
+
+def test_listing_key_normalized(content_mgr):
+    with mock.patch.object(content_mgr, 'generation', return_value=(1, 0)):
+        key = content_mgr.listing_key({'count': 10, 'category': 'core'})
+        assert key == content_mgr.listing_key(
+            {'category': 'core', 'count': 10})
+        assert key != content_mgr.listing_key({'count': 10})
+        assert content_mgr.listing_key({'category': 'core'}) is None
+
+
+@mock.patch.object(mod, 'iter_content')
+def test_list_files_cached(iter_content, cached_mgr):
+    iter_content.return_value = iter([{'id': 1, 'alive': 1}])
+    first = list(cached_mgr.list_files(count=10))
+    assert list(cached_mgr.list_files(count='10')) == first
+    assert iter_content.call_count == 1
+
+
+@mock.patch.object(mod, 'iter_content')
+def test_list_files_cache_invalidated_by_writes(iter_content, cached_mgr):
+    iter_content.side_effect = lambda db, **kw: iter([{'id': 1, 'alive': 1}])
+    list(cached_mgr.list_files(count=10))
+    mod.Generation.bump()
+    list(cached_mgr.list_files(count=10))
+    assert iter_content.call_count == 2
+
+
+@mock.patch.object(mod, 'iter_content')
+def test_list_files_unbounded_not_cached(iter_content, cached_mgr):
+    iter_content.side_effect = lambda db, **kw: iter([])
+    list(cached_mgr.list_files(since=0))
+    list(cached_mgr.list_files(since=0))
+    assert iter_content.call_count == 2
+    assert len(cached_mgr.cache) == 0
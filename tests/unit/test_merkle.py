@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+test_merkle.py: Unit tests for ``registry.content.merkle`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+from squery_lite import testing
+
+from registry.content import merkle as mod
+from registry.content import utils
+from registry.content.manager import ContentManager
+
+
+SQL = os.path.join(os.path.dirname(__file__), '..', 'data', 'registry.sql')
+
+ROOT = os.path.abspath('tests/data')
+
+
+@pytest.fixture
+def replicas(request, database_config):
+    # Two registries starting with the same catalog
+    containers = [testing.TestContainer(**database_config) for _ in range(2)]
+    for container in containers:
+        container.setupall()
+        with open(SQL) as fobj:
+            container.registry.executescript(fobj.read())
+        # Timestamps of the fixtures are set when they are loaded, and may
+        # fall in different seconds for each registry
+        container.registry.execute('UPDATE content SET uploaded = 1.0, '
+                                   'modified = 1.0, expiration = NULL;')
+        request.addfinalizer(container.teardownall)
+    trees = [mod.MerkleTree(container.registry) for container in containers]
+    for tree in trees:
+        tree.rebuild()
+    return trees
+
+
+class Databases(dict):
+    __getattr__ = dict.__getitem__
+
+
+def manager(tree):
+    return ContentManager({'registry.root_path': 'tests/data'}, tree.db)
+
+
+def entries(tree):
+    tree.db.query('SELECT id, category, alive FROM content ORDER BY id;')
+    return [tuple(row) for row in tree.db.results]
+
+
+def served(tree):
+    tree.db.query('SELECT serve_path, id, path, category FROM content '
+                  'ORDER BY serve_path;')
+    return dict((row[0], (row[1], row[2], row[3])) for row in tree.db.results)
+
+
+def buckets(tree, ids):
+    tree.db.query('SELECT serve_path FROM content WHERE id IN ({});'.format(
+        ', '.join('?' * len(ids))), *ids)
+    return sorted(set(mod.bucket_of(row[0]) for row in tree.db.results))
+
+
+def add_entries(tree, first, count):
+    mod.apply_rows(tree.db, [
+        (id, 'tmp/{}'.format(id), 1, 1.0, 1.0, 'core', None,
+         'file{}'.format(id), 0, 1, None)
+        for id in range(first, first + count)],
+        'test')
+    tree.rebuild()
+
+
+def test_identical_replicas(replicas):
+    local, peer = replicas
+    assert local.root() == peer.root()
+    assert mod.diff_buckets(local, peer) == []
+    assert mod.sync(local, peer, ROOT) == []
+
+
+def test_writes_update_tree(replicas):
+    local, peer = replicas
+    before = local.root()
+    manager(local).update_file('test', 1, {'category': 'changed'})
+    assert local.root() != before
+    updated = local.root()
+    local.rebuild()
+    assert local.root() == updated
+
+
+def test_sync_pulls_newer_entries(replicas):
+    local, peer = replicas
+    manager(peer).update_file('test', 1, {'category': 'changed'})
+    manager(peer).delete_file('test', 2)
+    assert mod.diff_buckets(local, peer) == buckets(peer, [1, 2])
+    assert sorted(mod.sync(local, peer, ROOT)) == [1, 2]
+    assert entries(local) == entries(peer)
+    assert local.root() == peer.root()
+    # Older versions are not pulled back
+    assert mod.sync(peer, local, ROOT) == []
+
+
+def test_sync_descends_to_divergent_buckets(replicas):
+    local, peer = replicas
+    # Entries are spread over the leaves by serve path, under a root at
+    # level 3
+    add_entries(local, 1000, 10)
+    add_entries(local, 100000, 10)
+    add_entries(peer, 1000, 10)
+    add_entries(peer, 100000, 10)
+    manager(peer).update_file('test', 100005, {'category': 'changed'})
+    assert local.root()[0] == 3
+    assert mod.diff_buckets(local, peer) == [
+        mod.bucket_of('file100005')]
+    assert mod.sync(local, peer, ROOT) == [100005]
+    assert entries(local) == entries(peer)
+
+
+def test_sync_with_shallower_peer(replicas):
+    local, peer = replicas
+    local.db.execute('DELETE FROM content;')
+    local.rebuild()
+    add_entries(peer, 100000, 10)
+    assert peer.root()[0] > local.root()[0]
+    assert sorted(mod.sync(local, peer, ROOT)) == [
+        row[0] for row in entries(peer)]
+    assert local.root() == peer.root()
+    assert mod.sync(peer, local, ROOT) == []
+
+
+def test_sync_matches_entries_by_serve_path(replicas):
+    local, peer = replicas
+    # Both registries allocated id 5000 to a different file
+    mod.apply_rows(local.db, [(5000, '/local/a.txt', 1, 1.0, 1.0, 'core',
+                               None, 'a.txt', 0, 1, None)], 'test')
+    mod.apply_rows(peer.db, [(5000, '/peer/b.txt', 1, 1.0, 1.0, 'core',
+                              None, 'b.txt', 0, 1, None)], 'test')
+    local.rebuild()
+    peer.rebuild()
+    updated = mod.sync(local, peer, ROOT)
+    assert len(updated) == 1
+    new_id = updated[0]
+    assert new_id != 5000
+    found = served(local)
+    # The local file is left alone, and the peer's file gets a new id and a
+    # path under the local root
+    assert found['a.txt'] == (5000, '/local/a.txt', 'core')
+    assert found['b.txt'] == (new_id, os.path.join(ROOT, 'b.txt'), 'core')
+    assert len(mod.sync(peer, local, ROOT)) == 1
+    assert served(peer)['b.txt'] == (5000, '/peer/b.txt', 'core')
+    assert local.root() == peer.root()
+    # Changes to the entry on the peer reach the entry with the local id
+    manager(peer).update_file('test', 5000, {'category': 'changed'})
+    assert mod.sync(local, peer, ROOT) == [new_id]
+    assert served(local)['b.txt'] == (new_id, os.path.join(ROOT, 'b.txt'),
+                                      'changed')
+    assert mod.sync(local, peer, ROOT) == []
+    assert mod.sync(peer, local, ROOT) == []
+
+
+def test_sync_rejects_paths_outside_root(replicas):
+    local, peer = replicas
+    add_entries(peer, 6000, 1)
+    mod.apply_rows(peer.db, [(6001, '/etc/passwd', 1, 1.0, 1.0, 'core',
+                              None, '../../etc/passwd', 0, 1, None)], 'test')
+    peer.rebuild()
+    assert mod.sync(local, peer, ROOT) == [6000]
+    assert served(local)['file6000'][1] == os.path.join(ROOT, 'file6000')
+    assert '../../etc/passwd' not in served(local)
+
+
+def test_prepare_rebuilds_empty_tree(replicas):
+    local, peer = replicas
+    root = local.root()
+    local.db.execute('DELETE FROM merkle;')
+    assert local.is_empty()
+    databases = Databases(registry=local.db)
+    utils.prepare({'database.shards': 1, 'registry.root_path': ROOT},
+                  databases)
+    assert local.root() == root
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+test_metrics.py: Unit tests for registry.utils.metrics module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import sqlite3
+
+import pytest
+from bottle import HTTPError
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.utils import metrics as mod
+from registry.utils.databases import InstrumentedDatabase, iter_batches
+
+
+def test_histogram_buckets():
+    hist = mod.Histogram(bounds=(1, 5))
+    for value in (0.5, 1, 3, 10):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1]
+    assert hist.count == 4
+    assert hist.sum == 14.5
+
+
+def test_export_histogram_is_cumulative():
+    metrics = mod.Metrics()
+    family = metrics.histogram('test_seconds', 'Test', labels=('route',),
+                               bounds=(1, 5))
+    family.labels('a').observe(0.5)
+    family.labels('a').observe(3)
+    lines = metrics.export().splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{le="1",route="a"} 1' in lines
+    assert 'test_seconds_bucket{le="5",route="a"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf",route="a"} 2' in lines
+    assert 'test_seconds_count{route="a"} 2' in lines
+
+
+def test_export_collectors_and_const_labels():
+    metrics = mod.Metrics()
+    metrics.const_labels['worker'] = 1
+    metrics.counter('test_total', 'Test').labels().inc(3)
+    metrics.add_collector('test', lambda: [
+        ('test_size', mod.GAUGE, 'Size', [({'kind': 'a"b'}, 2)])])
+    lines = metrics.export().splitlines()
+    assert 'test_total{worker="1"} 3' in lines
+    assert 'test_size{kind="a\\"b",worker="1"} 2' in lines
+
+
+def test_failing_collector_is_skipped():
+    metrics = mod.Metrics()
+
+    def collector():
+        raise RuntimeError('failed')
+    metrics.add_collector('test', collector)
+    assert metrics.export() == ''
+
+
+def test_plugin_records_status():
+    route = mock.Mock()
+    route.name = 'test:route'
+    plugin = mod.MetricsPlugin()
+
+    def fail():
+        raise HTTPError(404)
+    wrapper = plugin.apply(fail, route)
+    with pytest.raises(HTTPError):
+        wrapper()
+    assert mod.REQUESTS.labels('test:route', 404).value == 1
+    assert mod.REQUEST_DURATION.labels('test:route').count == 1
+
+
+def test_instrumented_database_records_timing():
+    db = mock.Mock()
+    wrapped = InstrumentedDatabase(db, 'test')
+    wrapped.timings = mod.Histogram()
+    wrapped.execute('SELECT 1;')
+    db.execute.assert_called_once_with('SELECT 1;')
+    # Timing is recorded once the results are fetched
+    assert wrapped.timings.count == 0
+    assert wrapped.result is db.result
+    assert wrapped.timings.count == 1
+    wrapped.execute('SELECT 2;')
+    wrapped.execute('SELECT 3;')
+    assert wrapped.timings.count == 2
+    assert wrapped.connection is db.connection
+
+
+def test_instrumented_database_times_batches():
+    db = mock.Mock()
+    db.connection = sqlite3.connect(':memory:')
+    wrapped = InstrumentedDatabase(db, 'test')
+    wrapped.timings = mod.Histogram()
+    batches = iter_batches(wrapped, 'SELECT 1 UNION SELECT 2;', size=1)
+    assert next(batches) == [(1,)]
+    assert wrapped.timings.count == 0
+    assert list(batches) == [[(2,)]]
+    assert wrapped.timings.count == 1
+    batches = iter_batches(wrapped, 'SELECT 1 UNION SELECT 2;', size=1)
+    next(batches)
+    batches.close()
+    assert wrapped.timings.count == 2
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+test_querylog.py: Unit tests for registry.utils.querylog module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import sqlite3
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.utils import querylog as mod
+
+
+SQL = 'SELECT * FROM content WHERE path = ?;'
+
+
+@pytest.fixture
+def db():
+    db = mock.Mock()
+    db.connection = sqlite3.connect(':memory:')
+    db.connection.execute('CREATE TABLE content (id, path);')
+    return db
+
+
+def test_record_aggregates_statements(db):
+    log = mod.QueryLog(threshold=None)
+    log.record(db, 'registry', SQL, ('a',), 0.5)
+    log.record(db, 'registry', SQL, ('b',), 1.5)
+    log.record(db, 'registry', 'SELECT 1;', (), 0.1)
+    top = log.top(1)
+    assert len(top) == 1
+    assert top[0]['sql'] == SQL
+    assert top[0]['count'] == 2
+    assert top[0]['total'] == 2
+    assert top[0]['mean'] == 1
+    assert top[0]['max'] == 1.5
+    assert top[0]['slow'] == 0
+
+
+@mock.patch.object(mod, 'logging')
+def test_slow_query_captures_plan(logging, db):
+    log = mod.QueryLog(threshold=0.1)
+    log.record(db, 'registry', SQL, ('secret',), 0.2)
+    stats = log.top()[0]
+    assert stats['slow'] == 1
+    assert stats['full_scan'] is True
+    message = logging.warning.call_args[0][0]
+    assert 'SCAN' in message
+    assert 'secret' not in message
+
+
+def test_full_table_counts_other(db):
+    log = mod.QueryLog(threshold=None, size=1)
+    log.record(db, 'registry', SQL, (), 0.1)
+    log.record(db, 'registry', 'SELECT 1;', (), 0.1)
+    log.record(db, 'registry', 'SELECT 2;', (), 0.1)
+    sqls = [stats['sql'] for stats in log.top()]
+    assert sorted(sqls) == sorted([mod.OTHER, SQL])
+
+
+def test_params_shape():
+    assert mod.params_shape((u'abc', 1)) == ['unicode(3)', 'int']
+    assert mod.params_shape({'a': None}) == {'a': 'NoneType'}
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+test_ratelimit.py: Unit tests for registry.utils.ratelimit module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import pytest
+from bottle import HTTPError
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.utils import ratelimit as mod
+
+
+@pytest.fixture
+def limiter():
+    limits = {mod.CHEAP: (10, 2), mod.EXPENSIVE: (1, 1)}
+    overrides = {'vip': {mod.CHEAP: (0, 0), mod.EXPENSIVE: (0, 0)}}
+    return mod.RateLimiter(limits, overrides)
+
+
+def test_token_bucket_refill():
+    bucket = mod.TokenBucket(1, 0)
+    assert bucket.take(2, 1, 0) == 0
+    assert bucket.take(2, 1, 0) == 0.5
+    assert bucket.take(2, 1, 0.5) == 0
+
+
+def test_limiter_burst(limiter):
+    assert limiter.acquire('test', mod.CHEAP, now=0) == 0
+    assert limiter.acquire('test', mod.CHEAP, now=0) == 0
+    assert limiter.acquire('test', mod.CHEAP, now=0) > 0
+    assert limiter.rejected == 1
+
+
+def test_limiter_kinds_are_separate(limiter):
+    assert limiter.acquire('test', mod.EXPENSIVE, now=0) == 0
+    assert limiter.acquire('test', mod.EXPENSIVE, now=0) == 1
+    assert limiter.acquire('test', mod.CHEAP, now=0) == 0
+
+
+def test_limiter_clients_are_separate(limiter):
+    assert limiter.acquire('test', mod.EXPENSIVE, now=0) == 0
+    assert limiter.acquire('other', mod.EXPENSIVE, now=0) == 0
+
+
+def test_limiter_override_disables(limiter):
+    for _ in range(10):
+        assert limiter.acquire('vip', mod.EXPENSIVE, now=0) == 0
+
+
+def test_from_config():
+    config = {
+        'ratelimit.rate': 20,
+        'ratelimit.burst': 40,
+        'ratelimit.expensive_rate': 1,
+        'ratelimit.expensive_burst': 10,
+        'ratelimit.clients': ['test 1 2 3 4', 'broken 1'],
+    }
+    limiter = mod.RateLimiter.from_config(config)
+    assert limiter.limits[mod.EXPENSIVE] == (1, 10)
+    assert limiter.overrides == {
+        'test': {mod.CHEAP: (1, 2), mod.EXPENSIVE: (3, 4)}
+    }
+
+
+def test_from_config_divides_limits_between_workers():
+    config = {
+        'server.workers': 4,
+        'ratelimit.rate': 20,
+        'ratelimit.burst': 40,
+        'ratelimit.expensive_rate': 1,
+        'ratelimit.expensive_burst': 2,
+    }
+    limiter = mod.RateLimiter.from_config(config)
+    assert limiter.limits[mod.CHEAP] == (5, 10)
+    assert limiter.limits[mod.EXPENSIVE] == (0.25, 1)
+
+
+@mock.patch.object(mod, 'request')
+def test_rate_limited_rejects_with_retry_after(request, limiter):
+    request.app.config = {'ratelimit.limiter': limiter}
+    request.session.client_name = 'test'
+    handler = mod.rate_limited(mod.EXPENSIVE)(lambda: 'ok')
+    assert handler() == 'ok'
+    with pytest.raises(HTTPError) as exc:
+        handler()
+    assert exc.value.status_code == 429
+    headers = exc.value.headerlist
+    assert (str('Retry-After'), str('1')) in headers
+    # The WSGI server rejects header names which are not native strings
+    assert all(type(name) is str for name, _ in headers)
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+test_reconcile.py: Unit tests for ``registry.content.reconcile`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import pytest
+
+from registry.content import reconcile as mod
+from registry.content.content import iter_content_rows
+from registry.content.manager import ContentManager
+
+
+def make_row(id, modified):
+    return (id, 'path', 0, 0.0, modified, None, None, 'path', 0, 1)
+
+
+def test_entry_key():
+    assert mod.entry_key(12, 1450000000.1234) == b'12:1450000000123'
+    assert mod.row_key(make_row(12, 1450000000.1234)) == b'12:1450000000123'
+
+
+def test_bloom_filter():
+    bloom = mod.BloomFilter.create(1000, error_rate=0.01)
+    keys = [mod.entry_key(i, 1.0) for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    others = [mod.entry_key(i, 2.0) for i in range(10000)]
+    false_positives = sum(key in bloom for key in others)
+    assert false_positives < 300
+    copy = mod.BloomFilter(bloom.to_bytes(), bloom.hashes)
+    assert all(key in copy for key in keys)
+
+
+@pytest.mark.parametrize('bits,hashes', (
+    (b'', 3),
+    (b'\x00', 0),
+    (b'\x00', mod.MAX_HASHES + 1),
+))
+def test_bloom_filter_invalid(bits, hashes):
+    with pytest.raises(ValueError):
+        mod.BloomFilter(bits, hashes)
+
+
+def test_digest_set():
+    keys = [mod.entry_key(i, 1.0) for i in range(10)]
+    digests = b''.join(mod.DigestSet.digest(key) for key in keys)
+    summary = mod.DigestSet(digests)
+    assert all(key in summary for key in keys)
+    assert mod.entry_key(1, 2.0) not in summary
+    with pytest.raises(ValueError):
+        mod.DigestSet(digests[:-1])
+
+
+def test_iter_differences():
+    summary = mod.DigestSet(b'')
+    summary.add(mod.entry_key(1, 1.0))
+    summary.add(mod.entry_key(3, 1.0))
+    batches = [[make_row(1, 1.0), make_row(2, 1.0)], [make_row(3, 1.0)],
+               [make_row(3, 2.0)]]
+    result = list(mod.iter_differences(batches, summary))
+    assert result == [[make_row(2, 1.0)], [make_row(3, 2.0)]]
+
+
+def test_reconcile_rows(populated_databases):
+    db = populated_databases.registry
+    mgr = ContentManager({'registry.root_path': 'tests/data'}, db)
+    rows = [row for batch in iter_content_rows(db) for row in batch]
+    summary = mod.DigestSet(b'')
+    for row in rows[1:]:
+        summary.add(mod.row_key(row))
+    # Only the entry missing from the summary is returned
+    result = [row for batch in mgr.reconcile_rows(summary, count=1)
+              for row in batch]
+    assert [row[0] for row in result] == [rows[0][0]]
+    # Modified entries are returned along with their new state
+    mgr.delete_file('test', rows[1][0])
+    result = [row for batch in mgr.reconcile_rows(summary) for row in batch]
+    assert [(row[0], row[9]) for row in result] == [
+        (rows[0][0], 1), (rows[1][0], 0)]
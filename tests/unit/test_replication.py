@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+test_replication.py: Unit tests for ``registry.content.replication`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+from bottle import HTTPError, HTTPResponse
+from squery_lite import testing
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.content import api
+from registry.content import replication as mod
+from registry.content.content import ContentRecord
+from registry.content.manager import ContentManager
+from registry.content.merkle import MerkleTree
+from registry.content.snapshot import SnapshotBuilder, SnapshotReader
+
+
+SQL = os.path.join(os.path.dirname(__file__), '..', 'data', 'registry.sql')
+
+
+class FakeClient(object):
+    """
+    Serves the changes, snapshot and Merkle tree of the primary's database
+    as the registry client would receive them
+    """
+    name = 'http://primary/'
+
+    def __init__(self, mgr, snapshot_path):
+        self.mgr = mgr
+        self.snapshot_path = snapshot_path
+        self.tree = MerkleTree(mgr.db)
+        self.root = self.tree.root
+        self.children = self.tree.children
+        self.rows = self.tree.rows
+
+    def changes(self, after, count):
+        last, actions, rows = self.mgr.get_changes(after, count)
+        return {'success': True, 'last': last, 'actions': actions,
+                'results': [ContentRecord(row).to_dict() for row in rows]}
+
+    def snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return None
+        return SnapshotReader.open(self.snapshot_path)
+
+
+@pytest.fixture
+def registries(request, database_config, tmpdir):
+    containers = [testing.TestContainer(**database_config) for _ in range(2)]
+    for container in containers:
+        container.setupall()
+        request.addfinalizer(container.teardownall)
+    primary, replica = [container.registry for container in containers]
+    with open(SQL) as fobj:
+        primary.executescript(fobj.read())
+    MerkleTree(primary).rebuild()
+    return primary, replica, str(tmpdir.join('catalog.snap'))
+
+
+@pytest.fixture
+def primary_mgr(registries):
+    return manager(registries[0])
+
+
+@pytest.fixture
+def follower(registries, primary_mgr):
+    primary, replica, snapshot_path = registries
+    return mod.Follower(replica, FakeClient(primary_mgr, snapshot_path))
+
+
+def manager(db):
+    return ContentManager({'registry.root_path': 'tests/data'}, db)
+
+
+def entries(db, alive_only=False):
+    db.query('SELECT id, category, alive FROM content {} ORDER BY id;'.format(
+        'WHERE alive = 1' if alive_only else ''))
+    return [tuple(row) for row in db.results]
+
+
+def test_bootstrap_from_snapshot(registries, follower):
+    primary, replica, snapshot_path = registries
+    SnapshotBuilder(primary, snapshot_path).build()
+    assert follower.position is None
+    assert follower.poll() == 0
+    assert entries(replica) == entries(primary, alive_only=True)
+    assert follower.position == manager(primary).get_changes(0, 1)[0]
+    assert follower.lag() == (0, 0)
+
+
+def test_bootstrap_without_snapshot(registries, primary_mgr, follower):
+    primary, replica, snapshot_path = registries
+    primary_mgr.delete_file('test', entries(primary)[0][0])
+    assert follower.poll() == 0
+    assert entries(replica) == entries(primary)
+    assert follower.position == primary_mgr.get_changes(0, 1)[0]
+
+
+def test_poll_applies_actions(registries, primary_mgr, follower):
+    primary, replica, snapshot_path = registries
+    SnapshotBuilder(primary, snapshot_path).build()
+    follower.poll()
+    first, second = entries(primary)[:2]
+    primary_mgr.update_file('test', first[0], {'category': 'changed'})
+    primary_mgr.delete_file('test', second[0])
+    follower.batch_size = 1
+    assert follower.poll() == 2
+    assert follower.applied == 2
+    assert entries(replica) == entries(primary)
+    assert MerkleTree(replica).root() == MerkleTree(primary).root()
+    # The actions are kept in the replica's history with their ids
+    assert (manager(replica).get_changes(0, 10)[1] ==
+            primary_mgr.get_changes(0, 10)[1])
+    assert follower.poll() == 0
+
+
+def test_changes_count_is_clamped(registries, primary_mgr):
+    primary, replica, snapshot_path = registries
+    for entry in entries(primary)[:3]:
+        primary_mgr.update_file('test', entry[0], {'category': 'changed'})
+    assert len(primary_mgr.get_changes(0, -1)[1]) == 1
+    assert len(primary_mgr.get_changes(0, 0)[1]) == 1
+    assert len(primary_mgr.get_changes(0, 2)[1]) == 2
+
+
+def test_history_ids_survive_vacuum(registries, primary_mgr):
+    primary, replica, snapshot_path = registries
+    first, second = entries(primary)[:2]
+    primary_mgr.update_file('test', first[0], {'category': 'changed'})
+    primary_mgr.update_file('test', second[0], {'category': 'changed'})
+    before = primary_mgr.get_changes(0, 10)[1]
+    primary.execute('DELETE FROM history WHERE id = ?;', (before[0][0],))
+    primary.execute('VACUUM;')
+    assert primary_mgr.get_changes(0, 10)[1] == before[1:]
+    assert primary_mgr.get_changes(0, 10)[0] == before[-1][0]
+
+
+def test_replica_redirects_downloads(registries, follower):
+    primary, replica, snapshot_path = registries
+    follower.poll()
+    id = entries(replica)[0][0]
+    config = {'registry.root_path': 'tests/data',
+              'replication.primary': 'http://primary/'}
+    db = mock.Mock(registry=replica)
+    with mock.patch.object(api, 'request', app=mock.Mock(config=config),
+                           db=db):
+        with pytest.raises(HTTPResponse) as exc:
+            api.get_file(id)
+        assert exc.value.status_code == 302
+        assert exc.value.headers['Location'] == 'http://primary/{}'.format(id)
+        # Unknown entries are not redirected
+        with pytest.raises(HTTPError) as exc:
+            api.get_file(100000)
+        assert exc.value.status_code == 404
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+test_scheduler.py: Unit tests for registry.utils.scheduler module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+import gevent
+
+from registry.utils import scheduler as mod
+
+
+def test_background_task_declares_schedule():
+    @mod.background_task(interval='test.interval', jitter=2)
+    def hook(app, config):
+        pass
+
+    task = mod.Task.from_hook(hook, {'test.interval': 30})
+    assert task.interval == 30
+    assert task.jitter == 2
+    assert task.concurrent is False
+    assert task.name.endswith('.hook')
+
+
+def test_task_from_undecorated_hook():
+    def hook(app, config):
+        pass
+
+    task = mod.Task.from_hook(hook, {})
+    assert task.interval == mod.DEFAULT_INTERVAL
+
+
+def test_task_run_records_failure():
+    def hook():
+        raise RuntimeError('failed')
+
+    task = mod.Task(hook, interval=1)
+    task.run()
+    assert task.runs == 1
+    assert task.failures == 1
+    assert task.running == 0
+
+
+def test_task_run_timeout_and_overrun():
+    task = mod.Task(lambda: gevent.sleep(1), interval=0.01, timeout=0.05)
+    task.run()
+    assert task.timeouts == 1
+    assert task.overruns == 1
+    assert task.last_duration < 1
+
+
+def test_scheduler_slow_task_does_not_delay_others():
+    calls = []
+    slow = mod.Task(lambda: gevent.sleep(10), interval=0.01, name='slow')
+    fast = mod.Task(lambda: calls.append(1), interval=0.01, name='fast')
+    scheduler = mod.Scheduler()
+    scheduler.add(slow)
+    scheduler.add(fast)
+    scheduler.start()
+    gevent.sleep(0.1)
+    scheduler.stop()
+    assert slow.running == 0
+    assert len(calls) > 3
+    assert set(scheduler.stats()) == set(['slow', 'fast'])
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+test_serializer.py: Unit tests for registry.content.serializer module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+
+from registry.content import serializer as mod
+from registry.content.content import LIST_COLS
+from registry.content.manager import ContentManager
+from registry.utils.bottleconf import json_dumps
+from registry.utils.databases import patch_connection, SQLITE_BACKEND
+
+
+@pytest.mark.parametrize('value', [
+    1, 2 ** 40, 1.5, 1456789012.123456, None, True, False, 'a"b\\c',
+    'čćž\n', b'bytes',
+])
+def test_encode_matches_json_dumps(value):
+    serializer = mod.RowSerializer(('value',))
+    assert serializer.encode((value,)) == json.dumps({'value': value})
+
+
+def test_encode_booleans():
+    serializer = mod.RowSerializer(('id', 'alive'), booleans=('alive',))
+    assert json.loads(serializer.encode((1, 0))) == {'id': 1, 'alive': False}
+
+
+@pytest.mark.parametrize('filters', [
+    {},
+    {'count': 2},
+    {'serve_path': '^dir1/'},
+    {'alive': 'yes'},
+])
+def test_listing_matches_dict_listing(populated_databases, filters):
+    patch_connection(SQLITE_BACKEND, populated_databases.registry.connection)
+    mgr = ContentManager({'registry.root_path': 'tests/tmp/'},
+                         db=populated_databases.registry)
+    files = list(mgr.list_files(**filters))
+    expected = {'success': True, 'results': files, 'count': len(files)}
+    serializer = mod.RowSerializer(LIST_COLS, booleans=('alive',))
+    listing = ''.join(mod.iter_listing(serializer, mgr.list_rows(**filters)))
+    assert json.loads(listing) == json.loads(json_dumps(expected))
+
+
+def test_iter_listing_batches():
+    serializer = mod.RowSerializer(('id',))
+    listing = ''.join(mod.iter_listing(serializer, [[(1,), (2,)], [(3,)]]))
+    assert json.loads(listing) == {
+        'success': True, 'results': [{'id': 1}, {'id': 2}, {'id': 3}],
+        'count': 3}
+    assert json.loads(''.join(mod.iter_listing(serializer, []))) == {
+        'success': True, 'results': [], 'count': 0}
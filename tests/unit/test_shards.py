@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+test_shards.py: Unit tests for ``registry.content.shards`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+from squery_lite import testing
+
+from registry.content import shards as mod
+from registry.content.filters import FilterBase
+from registry.content.manager import ContentManager
+from registry.content.merkle import MerkleTree
+from registry.utils.databases import patch_connection, SQLITE_BACKEND
+
+
+SQL = os.path.join(os.path.dirname(__file__), '..', 'data', 'registry.sql')
+
+SHARDS = 3
+
+
+def make_database(request, database_config, key):
+    config = dict(database_config, databases=list(
+        database_config['databases']) + [
+        {'name': 'content_{}'.format(index),
+         'migrations': 'registry.migrations.shard'}
+        for index in range(SHARDS)])
+    container = testing.TestContainer(**config)
+    container.setupall()
+    request.addfinalizer(container.teardownall)
+    with open(SQL) as fobj:
+        container.registry.executescript(fobj.read())
+    shards = [getattr(container, 'content_{}'.format(index))
+              for index in range(SHARDS)]
+    for shard in shards:
+        patch_connection(SQLITE_BACKEND, shard.connection)
+    db = mod.ShardedDatabase(container.registry, shards, key)
+    db.distribute()
+    return db
+
+
+@pytest.fixture
+def db(request, database_config):
+    return make_database(request, database_config, 'id')
+
+
+@pytest.fixture
+def category_db(request, database_config):
+    return make_database(request, database_config, 'category')
+
+
+class Databases(dict):
+    __getattr__ = dict.__getitem__
+
+
+def manager(db):
+    return ContentManager({'registry.root_path': 'tests/data'}, db)
+
+
+def add_entries(db, first, count, modified=1.0, category='core'):
+    db.replace_content([
+        (id, 'tmp/{}'.format(id), 1, 1.0, modified + id % 7, category, None,
+         'file{}'.format(id), 0, 1, None)
+        for id in range(first, first + count)])
+
+
+def shard_ids(shard):
+    shard.query('SELECT id FROM content ORDER BY id;')
+    return [row[0] for row in shard.results]
+
+
+def test_merge_batches():
+    merged = mod.merge_batches([iter([1, 4, 7]), iter([2, 3]), iter([5])],
+                               key=lambda row: row, limit=6, size=4)
+    assert list(merged) == [[1, 2, 3, 4], [5, 7]]
+
+
+def test_distribute(db):
+    db.db.query('SELECT COUNT(*) FROM content;')
+    assert db.db.result[0] == 0
+    for index, shard in enumerate(db.shards):
+        assert all(id % SHARDS == index for id in shard_ids(shard))
+    assert sorted(sum(map(shard_ids, db.shards), [])) == [1, 2, 3, 4]
+
+
+def test_prepare_distributes_entries(db):
+    databases = Databases(registry=db.db)
+    for index, shard in enumerate(db.shards):
+        databases['content_{}'.format(index)] = shard
+    # Entries left in the registry database, as by a registry which ran
+    # before sharding was enabled
+    db.db.execute("INSERT INTO content (id, path, uploaded, modified, "
+                  "serve_path, alive) VALUES (10, 'tmp/10', 1.0, 1.0, "
+                  "'file10', 1);")
+    mod.prepare({'database.shards': 1}, databases)
+    db.db.query('SELECT COUNT(*) FROM content;')
+    assert db.db.result[0] == 1
+    mod.prepare({'database.shards': SHARDS, 'database.shard_key': 'id'},
+                databases)
+    db.db.query('SELECT COUNT(*) FROM content;')
+    assert db.db.result[0] == 0
+    assert 10 in shard_ids(db.shards[10 % SHARDS])
+
+
+def test_writes_are_routed(db, tmpdir):
+    path = tmpdir.join('file1.txt')
+    path.write('content')
+    mgr = ContentManager({'registry.root_path': str(tmpdir)}, db)
+    entry = mgr.add_file('test', str(path), {'path': str(path),
+                                             'serve_path': 'new/file1.txt',
+                                             'category': 'core'})
+    # Ids are not reused
+    assert entry['id'] == 5
+    assert shard_ids(db.shards[5 % SHARDS]) == [2, 5]
+    mgr.update_file('test', 5, {'category': 'changed'})
+    assert mgr.get_file(id=5)['category'] == 'changed'
+    mgr.delete_file('test', 5)
+    assert not mgr.exists(id=5)
+
+
+def test_listings_are_merged(db):
+    add_entries(db, 100, 50)
+    mgr = manager(db)
+    files = list(mgr.list_files(count=20))
+    assert len(files) == 20
+    keys = [(f['modified'], f['id']) for f in files]
+    assert keys == sorted(keys)
+    all_files = list(mgr.list_files(count=1000))
+    assert [f['id'] for f in files] == [f['id'] for f in all_files[:20]]
+    assert len(all_files) == 54
+
+
+def test_queries_by_id_use_owning_shard(db):
+    filters = FilterBase.get_filters(ids='4,7')
+    assert db.targets(filters) == [db.shards[1]]
+    assert manager(db).get_file(id=4)['id'] == 4
+
+
+def test_category_key_moves_entries(category_db):
+    db = category_db
+    add_entries(db, 100, 10, category='a')
+    owner = db.shards[db.shard_index(100, 'a')]
+    target = next(shard for index, shard in enumerate(db.shards)
+                  if index != db.shard_index(100, 'a'))
+    category = next('c{}'.format(n) for n in range(100)
+                    if db.shards[db.shard_index(100, 'c{}'.format(n))] is
+                    target)
+    manager(db).update_file('test', 100, {'category': category})
+    assert 100 not in shard_ids(owner)
+    assert 100 in shard_ids(target)
+    assert manager(db).get_file(id=100)['category'] == category
+    # Copied entries replace the version held by another shard
+    add_entries(db, 100, 1, category='a')
+    assert 100 in shard_ids(owner)
+    assert 100 not in shard_ids(target)
+
+
+def test_merkle_tree_spans_shards(db, populated_databases):
+    add_entries(db, 100, 300)
+    # Same entries in an unsharded database
+    plain = populated_databases.registry
+    plain.execute('DELETE FROM content;')
+    for rows in mod.content.iter_content_rows(db):
+        mod.content.replace_content(plain, rows)
+    sharded_tree, plain_tree = MerkleTree(db), MerkleTree(plain)
+    sharded_tree.rebuild()
+    plain_tree.rebuild()
+    assert sharded_tree.root() == plain_tree.root()
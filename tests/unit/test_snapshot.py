@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+test_snapshot.py: Unit tests for ``registry.content.snapshot`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import pytest
+
+from registry.content import snapshot as mod
+from registry.content.manager import ContentManager
+
+
+ROW = (3, 'tmp/ünicode.txt', 100, 1450000000.5, 1450000001.0, None, None,
+       'ünicode.txt', 0, 1, 'ab12')
+
+
+@pytest.fixture
+def builder(db, tmpdir):
+    return mod.SnapshotBuilder(db, str(tmpdir.join('catalog.snap')))
+
+
+def read(path):
+    reader = mod.SnapshotReader.open(path)
+    try:
+        return reader, list(reader.records())
+    finally:
+        reader.close()
+
+
+def test_record_roundtrip():
+    record = mod.encode_record(ROW)
+    assert mod.decode_record(record[mod.LENGTH.size:]) == (
+        3, 'tmp/ünicode.txt', 100, 1450000000.5, 1450000001.0, None, None,
+        'ünicode.txt', False, True, 'ab12')
+
+
+def test_merge():
+    records = [(1, 'a'), (3, 'c'), (5, 'e')]
+    changes = [(0, 'z'), (3, None), (4, 'd'), (5, 'E'), (7, 'g')]
+    merged = mod.SnapshotBuilder.merge(records, changes)
+    assert list(merged) == [(0, 'z'), (1, 'a'), (4, 'd'), (5, 'E'),
+                            (7, 'g')]
+
+
+def test_build_full(builder, db):
+    assert builder.build() == 1
+    reader, records = read(builder.path)
+    assert reader.version == 1
+    assert reader.last_action == builder.get_last_action()
+    db.query('SELECT id FROM content WHERE alive = 1 ORDER BY id;')
+    assert [r[0] for r in records] == [row[0] for row in db.results]
+    assert records[0][1] == 'tests/data/content/dir1/file1.txt'
+    # Nothing is written if the catalog has not changed
+    assert builder.build() is None
+
+
+def test_build_incremental(builder, db):
+    builder.build()
+    reader, before = read(builder.path)
+    last_action = reader.last_action
+    mgr = ContentManager({'registry.root_path': 'tests/data'}, db)
+    mgr.update_file('test', before[0][0], {'category': 'changed'})
+    mgr.delete_file('test', before[1][0])
+    assert builder.build() == 2
+    reader, after = read(builder.path)
+    assert reader.last_action == last_action + 2
+    assert after[0][5] == 'changed'
+    assert [r[0] for r in after] == [before[0][0]] + [
+        r[0] for r in before[2:]]
+
+
+def test_build_rebuilds_periodically(builder, db):
+    builder.full_rebuild = 0
+    builder.build()
+    # Changes are not recorded in history, but are picked up in full builds
+    db.execute('UPDATE content SET alive = 0;')
+    assert builder.build() == 2
+    assert read(builder.path)[1] == []
+
+
+def test_reader_rejects_other_files(tmpdir):
+    path = tmpdir.join('other.gz')
+    fd = mod.gzip.open(str(path), 'wb')
+    fd.write(b'x' * 64)
+    fd.close()
+    with pytest.raises(mod.SnapshotError):
+        mod.SnapshotReader.open(str(path))
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+test_uploads.py: Unit tests for ``registry.content.uploads`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import os
+import fcntl
+import hashlib
+
+import pytest
+from bottle import HTTPError
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from registry.content import api
+from registry.content import uploads as mod
+from registry.utils.databases import patch_connection, SQLITE_BACKEND
+
+
+DATA = b'0123456789' * 1000
+
+
+@pytest.fixture
+def upload_mgr(populated_databases, tmpdir):
+    mod.UploadManager.hashers.clear()
+    patch_connection(SQLITE_BACKEND, populated_databases.registry.connection)
+    config = {'registry.root_path': str(tmpdir), 'uploads.chunk_size': 1000}
+    return mod.UploadManager(config, populated_databases.registry)
+
+
+def start(upload_mgr, **params):
+    params.setdefault('serve_path', 'media/file.bin')
+    return upload_mgr.create('test', params)['id']
+
+
+def test_upload_in_chunks(upload_mgr, tmpdir):
+    upload_id = start(upload_mgr, size=len(DATA), category='media')
+    part_path = upload_mgr.part_path(upload_mgr.get(upload_id))
+    assert upload_mgr.append(upload_id, 0, io.BytesIO(DATA[:4500])) == 4500
+    assert upload_mgr.append(upload_id, 4500, io.BytesIO(DATA[4500:])) == len(
+        DATA)
+    checksum = hashlib.sha256(DATA).hexdigest()
+    entry = upload_mgr.complete(upload_id, checksum)
+    path = str(tmpdir.join('media', 'file.bin'))
+    assert entry['path'] == path
+    assert entry['size'] == len(DATA)
+    assert entry['category'] == 'media'
+    assert entry['checksum'] == checksum
+    assert open(path, 'rb').read() == DATA
+    assert upload_mgr.get(upload_id) is None
+    assert not os.path.exists(part_path)
+
+
+def test_resume_after_interruption(upload_mgr):
+    upload_id = start(upload_mgr)
+    # Only part of the announced length is received
+    assert upload_mgr.append(upload_id, 0, io.BytesIO(DATA[:3000]),
+                             length=5000) == 3000
+    with pytest.raises(mod.OffsetMismatch) as exc:
+        upload_mgr.append(upload_id, 5000, io.BytesIO(DATA[5000:]))
+    assert exc.value.offset == 3000
+    # Another process resumes the upload
+    mod.UploadManager.hashers.clear()
+    upload_mgr.append(upload_id, 3000, io.BytesIO(DATA[3000:]))
+    entry = upload_mgr.complete(upload_id)
+    assert entry['checksum'] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_append_locks_part_file(upload_mgr):
+    upload_id = start(upload_mgr)
+    part_path = upload_mgr.part_path(upload_mgr.get(upload_id))
+    # Another worker is appending to the upload
+    with open(part_path, 'ab') as fobj:
+        fcntl.flock(fobj, fcntl.LOCK_EX)
+        with pytest.raises(mod.UploadException):
+            upload_mgr.append(upload_id, 0, io.BytesIO(DATA))
+        fobj.write(DATA[:1000])
+    # The offset is checked against the data it appended
+    with pytest.raises(mod.OffsetMismatch) as exc:
+        upload_mgr.append(upload_id, 0, io.BytesIO(DATA))
+    assert exc.value.offset == 1000
+    assert upload_mgr.append(upload_id, 1000, io.BytesIO(DATA[1000:])) == len(
+        DATA)
+    entry = upload_mgr.complete(upload_id)
+    assert entry['checksum'] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_complete_checks_upload(upload_mgr):
+    upload_id = start(upload_mgr, size=len(DATA))
+    upload_mgr.append(upload_id, 0, io.BytesIO(DATA[:100]))
+    with pytest.raises(mod.UploadException):
+        upload_mgr.complete(upload_id)
+    with pytest.raises(mod.UploadException):
+        upload_mgr.append(upload_id, 100, io.BytesIO(DATA), len(DATA))
+    upload_mgr.append(upload_id, 100, io.BytesIO(DATA[100:]))
+    with pytest.raises(mod.UploadException):
+        upload_mgr.complete(upload_id, hashlib.sha256(b'x').hexdigest())
+    assert upload_mgr.status(upload_id)['offset'] == len(DATA)
+
+
+def test_invalid_serve_path(upload_mgr):
+    for serve_path in ('../outside', '.uploads/x.part', ''):
+        with pytest.raises(mod.UploadException):
+            start(upload_mgr, serve_path=serve_path)
+
+
+def test_cancel_and_cleanup(upload_mgr):
+    first = start(upload_mgr)
+    second = start(upload_mgr, serve_path='other.bin')
+    upload_mgr.cancel(first)
+    assert upload_mgr.get(first) is None
+    assert upload_mgr.cleanup(3600) == 0
+    # Uploads left by other tests are discarded as well
+    assert upload_mgr.cleanup(-1) >= 1
+    assert upload_mgr.get(second) is None
+
+
+def test_upload_deduplicated(upload_mgr):
+    upload_mgr.config['storage.deduplicate'] = True
+    upload_id = start(upload_mgr, serve_path='media/dedup.bin')
+    upload_mgr.append(upload_id, 0, io.BytesIO(DATA))
+    entry = upload_mgr.complete(upload_id)
+    blobs = upload_mgr.content_manager().blobs
+    assert entry['path'] == blobs.blob_path(entry['checksum'])
+    assert open(entry['path'], 'rb').read() == DATA
+    assert not os.path.exists(upload_mgr.destination('media/dedup.bin'))
+    with pytest.raises(mod.UploadException):
+        start(upload_mgr, serve_path='.blobs/x')
+
+
+def test_failed_completion_keeps_data(upload_mgr):
+    upload_mgr.config['storage.deduplicate'] = True
+    data = os.urandom(1000)
+    upload_id = start(upload_mgr, serve_path='media/retried.bin')
+    upload_mgr.append(upload_id, 0, io.BytesIO(data))
+    with mock.patch('registry.content.manager.add_content',
+                    side_effect=RuntimeError('disk full')):
+        with pytest.raises(RuntimeError):
+            upload_mgr.complete(upload_id)
+    # The blob is released, and the data is back in the part file
+    checksum = hashlib.sha256(data).hexdigest()
+    assert upload_mgr.content_manager().blobs.refs(checksum) == 0
+    assert upload_mgr.status(upload_id)['offset'] == len(data)
+    entry = upload_mgr.complete(upload_id, checksum)
+    assert open(entry['path'], 'rb').read() == data
+
+
+def test_uploads_belong_to_their_client(upload_mgr):
+    upload_id = start(upload_mgr, serve_path='media/owned.bin')
+    with mock.patch.object(api, 'request') as request:
+        request.session.client_name = 'other'
+        with pytest.raises(HTTPError) as exc:
+            api.get_upload(upload_mgr, upload_id)
+        assert exc.value.status_code == 403
+        request.session.client_name = 'test'
+        assert api.get_upload(upload_mgr, upload_id)['id'] == upload_id
+        with pytest.raises(HTTPError) as exc:
+            api.get_upload(upload_mgr, 'unknown')
+        assert exc.value.status_code == 404
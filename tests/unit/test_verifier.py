@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+test_verifier.py: Unit tests for ``registry.content.verifier`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+
+import pytest
+
+from registry.content import tasks
+from registry.content import verifier as mod
+from registry.content.content import LIST_COLS, replace_content
+
+
+DATA = b'content'
+
+
+@pytest.fixture(autouse=True)
+def clear_verification(db):
+    db.execute('DELETE FROM verification;')
+    db.execute('DELETE FROM discrepancies;')
+
+
+def add_entry(db, id, path, size=len(DATA), checksum=None, alive=True):
+    entry = dict((col, None) for col in LIST_COLS)
+    entry.update(id=id, path=path, size=size, uploaded=1.0, modified=1.0,
+                 serve_path='verify/{}'.format(id), alive=alive, aired=False,
+                 checksum=checksum)
+    replace_content(db, [tuple(entry[col] for col in LIST_COLS)])
+
+
+def problems(verifier):
+    return dict((item['file_id'], item['problem'])
+                for item in verifier.discrepancies(count=1000))
+
+
+def test_throttle():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(delay):
+        sleeps.append(delay)
+        now[0] += delay
+
+    throttle = mod.Throttle(ops_rate=10, bytes_rate=100, sleep=sleep,
+                            clock=lambda: now[0])
+    throttle.spend(ops=1)
+    assert sleeps == [pytest.approx(0.1)]
+    throttle.spend(size=50)
+    assert sleeps[-1] == pytest.approx(0.4)
+    # Time which passed without spending counts towards the budget
+    now[0] += 10
+    throttle.spend(ops=5, size=100)
+    assert len(sleeps) == 2
+
+
+def test_verify_files(db, tmpdir):
+    path = tmpdir.join('file.txt')
+    path.write_binary(DATA)
+    checksum = hashlib.sha256(DATA).hexdigest()
+    add_entry(db, 10001, str(path), checksum=checksum)
+    add_entry(db, 10002, str(tmpdir.join('missing.txt')))
+    add_entry(db, 10003, str(path), size=100)
+    add_entry(db, 10004, str(path), checksum='0' * 64)
+    add_entry(db, 10005, str(tmpdir.join('missing.txt')), alive=False)
+    verifier = mod.Verifier(db, batch_size=1000)
+    while verifier.run():
+        pass
+    found = problems(verifier)
+    assert 10001 not in found
+    assert found[10002] == mod.MISSING
+    assert found[10003] == mod.SIZE
+    assert found[10004] == mod.CHECKSUM
+    assert 10005 not in found
+    assert verifier.state()[:2] == (0, 1)
+    # Fixed files are cleared in the next pass
+    tmpdir.join('missing.txt').write_binary(DATA)
+    while verifier.run():
+        pass
+    assert 10002 not in problems(verifier)
+    # Only sizes are checked without rehashing
+    verifier.rehash = False
+    while verifier.run():
+        pass
+    assert 10004 not in problems(verifier)
+
+
+def test_resume_from_checkpoint(db, tmpdir):
+    for id in (10011, 10012, 10013):
+        add_entry(db, id, str(tmpdir.join('missing.txt')))
+    db.execute('INSERT INTO verification (name, position) VALUES (?, ?);',
+               (mod.Verifier.NAME, 10011))
+    verifier = mod.Verifier(db, batch_size=1)
+    assert verifier.run() == 1
+    assert verifier.state()[0] == 10012
+    # Another verifier, as after a restart, continues from there
+    assert mod.Verifier(db, batch_size=1).run() == 1
+    assert sorted(problems(verifier)) == [10012, 10013]
+
+
+def test_replicas_skip_verification(db, populated_databases, tmpdir):
+    add_entry(db, 10001, str(tmpdir.join('missing.txt')))
+    config = {'verification.enabled': True,
+              'replication.primary': 'http://primary/',
+              'database.connections': populated_databases}
+    tasks.verify_files(None, config)
+    assert mod.Verifier(db).state() == (0, 0, None)
+    assert problems(mod.Verifier(db)) == {}
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+test_volumes.py: Unit tests for ``registry.content.volumes`` module
+
+Copyright 2014-2016, Outernet Inc.
+Some rights reserved.
+
+This software is free software licensed under the terms of GPLv3. See COPYING
+file that comes with the source code, or http://www.gnu.org/licenses/gpl.txt.
+"""
+
+from __future__ import unicode_literals
+
+import io
+import os
+
+import pytest
+
+from registry.content import utils
+from registry.content import volumes as mod
+from registry.content.manager import ContentManager, ContentException
+from registry.content.uploads import UploadManager
+
+
+@pytest.fixture
+def roots(tmpdir):
+    return [str(tmpdir.mkdir(name)) for name in ('main', 'disk1', 'disk2')]
+
+
+@pytest.fixture
+def config(roots):
+    return {'registry.root_path': roots[0],
+            'storage.volumes': ['{} 2 0'.format(roots[1]),
+                                '{} 1 1000'.format(roots[2])]}
+
+
+def test_from_config(config, roots, db):
+    config['storage.volumes'].append('invalid')
+    volumes = mod.Volumes.from_config(config, db)
+    assert [v.root for v in volumes] == roots
+    assert [(v.weight, v.capacity) for v in volumes] == [(1, 0), (2, 0),
+                                                          (1, 1000)]
+    assert volumes.locate(os.path.join(roots[1], 'a', 'b')).root == roots[1]
+    assert volumes.locate(roots[1] + 'x/a') is None
+
+
+def test_choose(config, roots, db):
+    volumes = mod.Volumes.from_config(config, db)
+    # All volumes are on the same disk, so the weight decides
+    assert volumes.choose(10).root == roots[1]
+    with volumes.busy(roots[1]):
+        with volumes.busy(roots[1]):
+            assert volumes.choose(10).root == roots[0]
+    assert not volumes.load
+    # Capacity of the last volume is used up
+    volumes.record(os.path.join(roots[2], 'file'), 990)
+    assert volumes.available(volumes.get(roots[2]), 990) == 10
+    volumes.volumes = volumes.volumes[2:]
+    assert volumes.choose(10).root == roots[2]
+    assert volumes.choose(11) is None
+
+
+def test_files_on_volumes(config, roots, db):
+    mgr = ContentManager(config, db)
+    path = os.path.join(roots[1], 'file.txt')
+    with open(path, 'w') as fobj:
+        fobj.write('content')
+    entry = mgr.add_file('test', path, {'path': path,
+                                        'serve_path': 'volumes/file.txt'})
+    assert entry['path'] == path
+    assert mgr.volumes.usage()[roots[1]] == (1, 7)
+    mgr.delete_file('test', entry['id'])
+    assert mgr.volumes.usage()[roots[1]] == (0, 0)
+    outside = os.path.join(os.path.dirname(roots[0]), 'outside.txt')
+    with open(outside, 'w') as fobj:
+        fobj.write('content')
+    with pytest.raises(ContentException):
+        mgr.add_file('test', outside, {'path': outside,
+                                       'serve_path': 'volumes/outside.txt'})
+
+
+def test_uploads_are_placed(config, roots, db):
+    upload_mgr = UploadManager(config, db)
+    upload = upload_mgr.create('test', {'serve_path': 'volumes/upload.bin',
+                                        'size': 100})
+    upload_mgr.append(upload['id'], 0, io.BytesIO(b'x' * 100))
+    entry = upload_mgr.complete(upload['id'])
+    assert entry['path'] == os.path.join(roots[1], 'volumes', 'upload.bin')
+    # Usage is recounted from entries
+    db.execute('DELETE FROM volumes;')
+    mgr = ContentManager(config, db)
+    mgr.volumes.recount()
+    assert mgr.volumes.usage()[roots[1]] == (1, 100)
+
+
+def test_prepare_recounts_usage(config, roots, db, populated_databases):
+    mgr = ContentManager(config, db)
+    path = os.path.join(roots[2], 'file.txt')
+    with open(path, 'w') as fobj:
+        fobj.write('content')
+    mgr.add_file('test', path, {'path': path,
+                                'serve_path': 'volumes/prepared.txt'})
+    db.execute('DELETE FROM volumes;')
+    utils.prepare(dict(config, **{'database.shards': 1}),
+                  populated_databases)
+    assert mgr.volumes.usage()[roots[2]] == (1, 7)